@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+# Time how texi2xml's Parser dispatches full-line commands to their
+# handlers, as more commands are added, compared with an if/elif chain
+# over the command names like the one it replaced.
+#
+# Each size registers that many extra (no-op) commands, as
+# _command_NAME methods of a Parser subclass, and dispatches each of
+# them in turn.  The cost per command of the registry should stay
+# roughly the same as the number of commands grows, whereas that of
+# the chain grows with it.
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from texi2xml import Parser
+
+def handle_noop(self, name, line):
+    pass
+
+def make_parser(names):
+    """
+    Make a Parser with a (no-op) handler for each of "names".
+    """
+    methods = {'_command_%s' % name: handle_noop for name in names}
+    return type('BenchParser', (Parser, ), methods)('', [])
+
+def make_chain(names):
+    """
+    Make a function testing "name" against each of "names" in turn.
+    """
+    lines = ['def handle_command(name, line):']
+    for i, name in enumerate(names):
+        lines.append('    %s name == %r:' % ('elif' if i else 'if', name))
+        lines.append('        pass')
+    lines.append('    else:')
+    lines.append('        pass')
+    namespace = {}
+    exec('\n'.join(lines), namespace)
+    return namespace['handle_command']
+
+def measure(handle_command, names, calls, repeat):
+    """
+    Get the best time per call of handle_command, over "repeat" runs of
+    "calls" calls cycling through "names".
+    """
+    sequence = (names * (calls // len(names) + 1))[:calls]
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for name in sequence:
+            handle_command(name, '')
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / calls
+
+parser = argparse.ArgumentParser(description='Time command dispatch')
+parser.add_argument('--sizes', default='10,100,1000',
+                    help='Comma-separated numbers of commands to register')
+parser.add_argument('--calls', type=int, default=100000,
+                    help='Number of commands to dispatch per timing')
+parser.add_argument('--repeat', type=int, default=5,
+                    help='Number of timings to take the best of')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    print('%9s %14s %8s %14s %8s'
+          % ('commands', 'registry ns', 'ratio', 'chain ns', 'ratio'))
+    first = None
+    for size in [int(size) for size in args.sizes.split(',')]:
+        names = ['command%i' % i for i in range(size)]
+        registry = measure(make_parser(names)._handle_command, names,
+                           args.calls, args.repeat)
+        chain = measure(make_chain(names), names, args.calls, args.repeat)
+        if first is None:
+            first = registry, chain
+        print('%9i %14.1f %8.2f %14.1f %8.2f'
+              % (size, registry * 1e9, registry / first[0],
+                 chain * 1e9, chain / first[1]))
+    print('(ratio is the cost per command relative to the first size; '
+          'for the registry it should stay near 1)')
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+# Check that move_nodes scales linearly with the size of the tree, by
+# timing it on documents of doubling size: the time per node should
+# stay roughly constant, rather than doubling with each size as it did
+# when every node was removed from and inserted into its parent one at
+# a time.
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from texi2rst import Context, from_xml_string, move_nodes
+
+def make_xml(count):
+    """
+    Make a document with "count" nodes directly within <texinfo>, each
+    followed by a chapter (as in gcc.xml), plus an anchor within each
+    chapter.
+    """
+    chapters = []
+    for i in range(count):
+        chapters.append('<node name="n%i"><nodename>N %i</nodename></node>'
+                        '<chapter><sectiontitle>C %i</sectiontitle>'
+                        '<para>Text<anchor>a%i</anchor></para>'
+                        '<para>More text</para></chapter>'
+                        % (i, i, i, i))
+    return '<texinfo>%s</texinfo>' % ''.join(chapters)
+
+def measure(count, repeat):
+    best = None
+    for _ in range(repeat):
+        tree = from_xml_string(make_xml(count))
+        start = time.perf_counter()
+        move_nodes(tree, Context())
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+parser = argparse.ArgumentParser(description='Measure how move_nodes scales')
+parser.add_argument('--count', type=int, default=1000,
+                    help='Number of nodes in the smallest document')
+parser.add_argument('--sizes', type=int, default=5,
+                    help='Number of document sizes (each double the last)')
+parser.add_argument('--repeat', type=int, default=3,
+                    help='Number of timings to take the best of')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    print('%10s %10s %14s %8s' % ('nodes', 'seconds', 'usec/node', 'ratio'))
+    last = None
+    for i in range(args.sizes):
+        count = args.count << i
+        elapsed = measure(count, args.repeat)
+        # Each chapter holds a node and an anchor
+        per_node = 1e6 * elapsed / (2 * count)
+        if last:
+            ratio = '%8.2f' % (elapsed / last)
+        else:
+            ratio = '%8s' % '-'
+        print('%10i %10.4f %14.2f %s' % (2 * count, elapsed, per_node, ratio))
+        last = elapsed
+    print('(a ratio of about 2 between successive sizes means linear)')
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+# Measure the memory used per node by node.py's classes, compared with
+# the previous representation (a per-instance __dict__, and an
+# OrderedDict for the attributes of every Element).
+
+from collections import OrderedDict
+import argparse
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from node import Element, Text
+
+class DictElement:
+    def __init__(self, kind, attrs=None):
+        self.kind = kind
+        if attrs:
+            self.attrs = OrderedDict(attrs)
+        else:
+            self.attrs = OrderedDict()
+        self.children = []
+        self.rst_kind = None
+
+class DictText:
+    def __init__(self, data):
+        self.data = data
+
+def build(element_class, text_class, count):
+    """
+    Build "count" <para> elements, each with a Text child, and
+    with one in four of them having an attribute.
+    """
+    root = element_class('texinfo')
+    for i in range(count):
+        if i % 4 == 0:
+            para = element_class('para', {'spaces': ' '})
+        else:
+            para = element_class('para')
+        para.children.append(text_class('text'))
+        root.children.append(para)
+    return root
+
+def measure(element_class, text_class, count):
+    tracemalloc.start()
+    root = build(element_class, text_class, count)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # Each <para> contributes two nodes
+    return size / (2 * count)
+
+parser = argparse.ArgumentParser(description='Measure per-node memory usage')
+parser.add_argument('--count', type=int, default=100000,
+                    help='Number of elements to create')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    old = measure(DictElement, DictText, args.count)
+    new = measure(Element, Text, args.count)
+    print('%-24s %10.1f bytes/node' % ('__dict__ + OrderedDict', old))
+    print('%-24s %10.1f bytes/node' % ('__slots__', new))
+    print('%-24s %10.1f%%' % ('saving', 100.0 * (old - new) / old))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+# Time each phase of converting synthetic gcc.xml-shaped documents (see
+# synthetic.py): parsing (from_xml_string), conversion (convert_to_rst)
+# and writing (RstWriter, to memory), at several sizes, reporting the
+# throughput of each in nodes/s and MB/s of XML.
+#
+# The throughput should stay roughly the same as the size grows; a
+# phase whose throughput drops at the larger sizes is scaling
+# super-linearly.
+
+import argparse
+import gc
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from synthetic import make_document
+from texi2rst import CapturingOpener, GccContext, RstWriter, \
+    convert_to_rst, from_xml_string
+
+def write(tree):
+    w = RstWriter(io.StringIO(), CapturingOpener())
+    w.visit(tree)
+    w.finish()
+
+def measure(xml_src, repeat):
+    """
+    Get the best time for each phase over "repeat" runs, and the number
+    of nodes in the parsed tree.
+    """
+    best = {}
+    for _ in range(repeat):
+        gc.collect()
+        times = {}
+        start = time.perf_counter()
+        tree = from_xml_string(xml_src)
+        times['parse'] = time.perf_counter() - start
+        nodes = sum(1 for _ in tree.iter_depth_first())
+        start = time.perf_counter()
+        tree = convert_to_rst(tree, GccContext())
+        times['convert'] = time.perf_counter() - start
+        start = time.perf_counter()
+        write(tree)
+        times['write'] = time.perf_counter() - start
+        times['total'] = sum(times.values())
+        for phase, elapsed in times.items():
+            best[phase] = min(best.get(phase, elapsed), elapsed)
+    return best, nodes
+
+parser = argparse.ArgumentParser(description='Time each phase of conversion')
+parser.add_argument('--sizes', default='1,4,16',
+                    help='Comma-separated sizes, as multiples of --scale')
+parser.add_argument('--scale', type=int, default=1,
+                    help='Size of the smallest document, in units of 20 chapters')
+parser.add_argument('--seed', type=int, default=0,
+                    help='Seed for generating the documents')
+parser.add_argument('--repeat', type=int, default=3,
+                    help='Number of timings to take the best of')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    print('%6s %8s %9s %8s %10s %12s %8s %8s'
+          % ('size', 'MB', 'nodes', 'phase', 'seconds', 'nodes/s', 'MB/s',
+             'ratio'))
+    first_rates = {}
+    for size in [int(size) for size in args.sizes.split(',')]:
+        xml_src = make_document(size * args.scale, args.seed)
+        mb = len(xml_src.encode('utf-8')) / (1024 * 1024)
+        times, nodes = measure(xml_src, args.repeat)
+        for phase in ('parse', 'convert', 'write', 'total'):
+            elapsed = times[phase]
+            rate = nodes / elapsed
+            # The throughput relative to the smallest size: well below
+            # 1 means super-linear scaling
+            if phase in first_rates:
+                ratio = '%8.2f' % (rate / first_rates[phase])
+            else:
+                first_rates[phase] = rate
+                ratio = '%8s' % '-'
+            print('%6s %8.2f %9i %8s %10.4f %12.0f %8.2f %s'
+                  % ('%ix' % size, mb, nodes, phase, elapsed, rate,
+                     mb / elapsed, ratio))
+    print('(ratio is the throughput relative to the first size; '
+          'it should stay near 1)')
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+# Compare texi2xml's regex-based tokenizer with the character-at-a-time
+# loop it replaced, on texinfo source shaped like gcc's invoke.texi
+# (or on a given file), checking that both give the same tokens.
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from texi2xml import Parser
+
+def tokenize_by_char(text):
+    """
+    The original implementation of Parser._tokenize
+    """
+    SPECIAL_CHARS = '@{}\n'
+    accum = ''
+    for ch in text:
+        if ch in SPECIAL_CHARS:
+            if accum:
+                yield accum
+            accum = ''
+            yield ch
+        else:
+            accum += ch
+    if accum:
+        yield accum
+
+WORDS = ('the', 'compiler', 'option', 'warning', 'function', 'is', 'a',
+         'of', 'for', 'with', 'when', 'this', 'code', 'target', 'enabled',
+         'default', 'type', 'value', 'pointer', 'expression', 'program')
+
+def make_texi(size, seed):
+    """
+    Make roughly "size" bytes of texinfo source, of option tables in
+    the style of invoke.texi.
+    """
+    rng = random.Random(seed)
+    def words(lo, hi):
+        return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(lo, hi)))
+    lines = ['@table @gcctabopt']
+    length = 0
+    while length < size:
+        option = '-W%s-%s' % (rng.choice(WORDS), rng.choice(WORDS))
+        entry = ['@item %s' % option,
+                 '@opindex %s' % option[1:],
+                 '@opindex Wno-%s' % option[2:]]
+        for _ in range(rng.randint(1, 6)):
+            entry.append('%s @code{%s} %s @option{-O%i}, @pxref{%s}.'
+                         % (words(3, 12), rng.choice(WORDS), words(3, 12),
+                            rng.randint(0, 3), words(2, 3)))
+        entry.append('')
+        text = '\n'.join(entry)
+        lines.append(text)
+        length += len(text)
+    lines.append('@end table\n')
+    return '\n'.join(lines)
+
+def measure(tokenize, text, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        tokens = list(tokenize(text))
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, tokens
+
+parser = argparse.ArgumentParser(description='Time the texinfo tokenizer')
+parser.add_argument('--file', help='Texinfo file to tokenize '
+                    '(default: generate about --size bytes)')
+parser.add_argument('--size', type=int, default=1024 * 1024,
+                    help='Size of the generated source, in bytes')
+parser.add_argument('--seed', type=int, default=0,
+                    help='Seed for generating the source')
+parser.add_argument('--repeat', type=int, default=5,
+                    help='Number of timings to take the best of')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.file:
+        with open(args.file) as f_in:
+            text = f_in.read()
+    else:
+        text = make_texi(args.size, args.seed)
+    old_time, old_tokens = measure(tokenize_by_char, text, args.repeat)
+    new_time, new_tokens = measure(Parser('', [])._tokenize, text,
+                                   args.repeat)
+    assert new_tokens == old_tokens
+    print('%i bytes, %i tokens' % (len(text), len(new_tokens)))
+    print('%12s %10s %14s' % ('tokenizer', 'seconds', 'MB/s'))
+    for name, elapsed in (('by char', old_time), ('regex', new_time)):
+        print('%12s %10.4f %14.2f'
+              % (name, elapsed, len(text) / (1024 * 1024) / elapsed))
+    print('speedup: %.1fx' % (old_time / new_time))
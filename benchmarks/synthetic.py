@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+# Generate synthetic documents shaped like makeinfo's XML for gcc.texi,
+# for benchmarking: nested chapters and sections, each preceded by its
+# <node>, with option tables (<tableentry> with <indexcommand>),
+# multitables, xrefs, deftypefn definitions and long <pre> examples.
+#
+# The output depends only on the scale and the seed, so that timings
+# of different versions of the converter can be compared.
+
+import argparse
+import random
+import sys
+
+WORDS = ('the', 'compiler', 'option', 'warning', 'function', 'attribute',
+         'is', 'are', 'a', 'an', 'of', 'for', 'with', 'when', 'this', 'that',
+         'code', 'target', 'register', 'optimization', 'enabled', 'default',
+         'type', 'value', 'pointer', 'array', 'expression', 'statement',
+         'language', 'standard', 'behavior', 'generated', 'program', 'file')
+
+class Generator:
+    def __init__(self, seed):
+        self.random = random.Random(seed)
+        self.parts = []
+        self.node_count = 0
+        self.index_number = 0
+        self.node_names = ['Top']
+
+    def write(self, text):
+        self.parts.append(text)
+
+    def words(self, lo, hi):
+        return ' '.join(self.random.choice(WORDS)
+                        for _ in range(self.random.randint(lo, hi)))
+
+    def title(self):
+        return self.words(2, 5).capitalize()
+
+    def option_name(self):
+        return '-%s%s-%s' % (self.random.choice('fWm'),
+                             self.random.choice(WORDS),
+                             self.random.choice(WORDS))
+
+    def next_index_number(self):
+        self.index_number += 1
+        return self.index_number
+
+    def node(self, name):
+        self.node_count += 1
+        label = name.replace(' ', '-')
+        self.write('<node name="%s" spaces=" "><nodename>%s</nodename>'
+                   '<nodeup automatic="on">Top</nodeup></node>\n'
+                   % (label, name))
+        self.node_names.append(name)
+
+    def para(self):
+        self.write('<para>')
+        for _ in range(self.random.randint(1, 4)):
+            self.write(self.words(5, 20))
+            choice = self.random.random()
+            if choice < 0.2:
+                self.write(' <code>%s</code> ' % self.random.choice(WORDS))
+            elif choice < 0.3:
+                self.write(' <option>%s</option> ' % self.option_name())
+            elif choice < 0.4:
+                target = self.random.choice(self.node_names)
+                self.write(' <xref label="%s"><xrefnodename>%s</xrefnodename>'
+                           '</xref>. ' % (target.replace(' ', '-'), target))
+            elif choice < 0.5:
+                self.write(' <var>%s</var> ' % self.random.choice(WORDS))
+            else:
+                self.write('.\n')
+        self.write('</para>\n')
+
+    def option_table(self):
+        self.write('<table commandarg="gcctabopt" spaces=" " '
+                   'endspaces=" ">\n')
+        for _ in range(self.random.randint(3, 12)):
+            option = self.option_name()
+            self.write('<tableentry><tableterm><item spaces=" ">'
+                       '<itemformat command="gcctabopt">%s</itemformat>'
+                       '</item>\n</tableterm><tableitem>' % option)
+            for name in (option[1:], 'no-' + option[1:]):
+                self.write('<indexcommand command="opindex" index="op" '
+                           'spaces=" "><indexterm index="op" number="%i" '
+                           'incode="1">%s</indexterm></indexcommand>\n'
+                           % (self.next_index_number(), name))
+            for _ in range(self.random.randint(1, 3)):
+                self.para()
+            self.write('</tableitem></tableentry>\n')
+        self.write('</table>\n')
+
+    def multitable(self):
+        columns = self.random.randint(2, 4)
+        self.write('<multitable spaces=" " endspaces=" "><columnprototypes>')
+        for _ in range(columns):
+            self.write('<columnprototype bracketed="on">%s</columnprototype> '
+                       % self.random.choice(WORDS))
+        self.write('</columnprototypes>\n<thead><row>')
+        for i in range(columns):
+            self.write('<entry command="%s" spaces=" "><para>%s</para></entry>'
+                       % ('headitem' if i == 0 else 'tab', self.title()))
+        self.write('</row></thead><tbody>')
+        for _ in range(self.random.randint(2, 10)):
+            self.write('<row>')
+            for i in range(columns):
+                self.write('<entry command="%s" spaces=" "><para><code>%s'
+                           '</code>\n</para></entry>'
+                           % ('item' if i == 0 else 'tab', self.words(1, 3)))
+            self.write('</row>')
+        self.write('</tbody></multitable>\n')
+
+    def deftypefn(self):
+        name = '%s_%s' % (self.random.choice(WORDS), self.random.choice(WORDS))
+        self.write('<deftypefn spaces=" " endspaces=" "><definitionterm>'
+                   '<indexterm index="fn" number="%i" mergedindex="cp">%s'
+                   '</indexterm><defcategory bracketed="on">Function'
+                   '</defcategory> <deftype>tree</deftype> '
+                   '<deffunction>%s</deffunction> '
+                   '<defdelimiter>(</defdelimiter>'
+                   % (self.next_index_number(), name, name))
+        for i in range(self.random.randint(1, 3)):
+            if i:
+                self.write('<defdelimiter>,</defdelimiter> ')
+            self.write('<defparamtype>%s</defparamtype> <defparam>%s'
+                       '</defparam>' % (self.random.choice(('int', 'tree')),
+                                        self.random.choice(WORDS)))
+        self.write('<defdelimiter>)</defdelimiter></definitionterm>\n'
+                   '<definitionitem>')
+        self.para()
+        self.write('</definitionitem></deftypefn>\n')
+
+    def example(self):
+        self.write('<smallexample endspaces=" ">\n<pre xml:space="preserve">')
+        for _ in range(self.random.randint(10, 60)):
+            self.write('%s%s (%s);\n' % (' ' * self.random.randint(0, 8),
+                                         self.random.choice(WORDS),
+                                         self.words(1, 4).replace(' ', ', ')))
+        self.write('</pre></smallexample>\n')
+
+    def body(self):
+        for _ in range(self.random.randint(2, 6)):
+            choice = self.random.random()
+            if choice < 0.5:
+                self.para()
+            elif choice < 0.65:
+                self.option_table()
+            elif choice < 0.75:
+                self.multitable()
+            elif choice < 0.85:
+                self.deftypefn()
+            else:
+                self.example()
+
+    def section(self, kind, depth):
+        title = self.title()
+        self.node('%s %i' % (title, self.node_count))
+        self.write('<%s spaces=" "><sectiontitle>%s</sectiontitle>\n'
+                   % (kind, title))
+        self.write('<cindex index="cp" spaces=" "><indexterm index="cp" '
+                   'number="%i">%s</indexterm></cindex>\n'
+                   % (self.next_index_number(), title))
+        self.body()
+        if depth < 2:
+            subkind = ('section', 'subsection')[depth]
+            for _ in range(self.random.randint(0, 4)):
+                self.section(subkind, depth + 1)
+        self.write('</%s>\n' % kind)
+
+    def document(self, chapters):
+        self.write('<?xml version="1.0"?>\n'
+                   '<!DOCTYPE texinfo PUBLIC "-//GNU//DTD TexinfoML V6.5//EN" '
+                   '"http://www.gnu.org/software/texinfo/dtd/6.5/texinfo.dtd">\n'
+                   '<texinfo xml:lang="en">\n'
+                   '<setfilename file="gcc.xml" spaces=" "></setfilename>\n'
+                   '<node name="Top" spaces=" "><nodename>Top</nodename></node>\n'
+                   '<top spaces=" "><sectiontitle>Introduction</sectiontitle>\n')
+        self.para()
+        self.write('</top>\n')
+        for _ in range(chapters):
+            self.section('chapter', 0)
+        self.write('</texinfo>\n')
+        return ''.join(self.parts)
+
+def make_document(scale=1, seed=0):
+    """
+    Make a document of 20 chapters (of about 40KB each) per unit of
+    "scale", generated from "seed".
+    """
+    return Generator(seed).document(20 * scale)
+
+parser = argparse.ArgumentParser(description='Generate a synthetic gcc.xml')
+parser.add_argument('--scale', type=int, default=1,
+                    help='Size of the document, in units of 20 chapters')
+parser.add_argument('--seed', type=int, default=0,
+                    help='Seed for the random choices')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    sys.stdout.write(make_document(args.scale, args.seed))
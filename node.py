@@ -1,10 +1,32 @@
 #!/usr/bin/env python3
 
 # A minimal IR for transforming texinfo XML into rst
-from collections import OrderedDict
+import io
 import re
+import sys
+import types
+
+ELEMENT_NAME_PATTERN = re.compile('[a-zA-Z0-9-_]+')
+
+# What Element.attrs gives for an element without attributes, so that
+# reading them doesn't allocate a dict for every element
+NO_ATTRS = types.MappingProxyType({})
+
+# The node classes use __slots__ to keep their per-instance overhead
+# down, since there are millions of them for a large manual; any
+# per-node data computed by a pass should be kept in a side-table
+# (e.g. a dict keyed by the node) rather than as an extra attribute.
+
+def escape_xml_text(data):
+    data = data.replace('&', '&amp;')
+    #data = data.replace('"', '&quot;')
+    data = data.replace('>', '&gt;')
+    data = data.replace('<', '&lt;')
+    return data
 
 class Node:
+    __slots__ = ()
+
     def __repr__(self):
         return 'Node()'
 
@@ -19,16 +41,30 @@ class Node:
     def iter_depth_first(self):
         yield self
         if isinstance(self, Element):
-            for child in self.children:
-                for item in child.iter_depth_first():
-                    yield item
+            # Use an explicit stack of iterators over the children,
+            # rather than nested generators
+            stack = [iter(self.children)]
+            while stack:
+                for child in stack[-1]:
+                    yield child
+                    if isinstance(child, Element):
+                        stack.append(iter(child.children))
+                        break
+                else:
+                    stack.pop()
 
     def iter_depth_first_edges(self):
         if isinstance(self, Element):
-            for child in self.children:
-                yield (self, child)
-                for src, dst in child.iter_depth_first_edges():
-                    yield (src, dst)
+            stack = [(self, iter(self.children))]
+            while stack:
+                parent, children = stack[-1]
+                for child in children:
+                    yield (parent, child)
+                    if isinstance(child, Element):
+                        stack.append((child, iter(child.children)))
+                        break
+                else:
+                    stack.pop()
 
     def toxml(self, dtd_line=None):
         """
@@ -36,43 +72,64 @@ class Node:
         (minidom appears to sort the attribute names
         https://hg.python.org/cpython/file/2.7/Lib/xml/dom/minidom.py#l800)
         """
-        def escape(data):
-            data = data.replace('&', '&amp;')
-            #data = data.replace('"', '&quot;')
-            data = data.replace('>', '&gt;')
-            data = data.replace('<', '&lt;')
-            return data
+        f_out = io.StringIO()
+        self.write_xml(f_out, dtd_line)
+        return f_out.getvalue()
 
-        if isinstance(self, Element):
-            if dtd_line:
-                result = '<?xml version="1.0"?>\n'
-                result += '%s\n' % dtd_line
-            else:
-                result = ''
-            result += '<%s' % self.kind
-            for k, v in self.attrs.items():
-                result += ' %s="%s"' % (k, v)
-            if self.children:
-                result += '>'
-                for child in self.children:
-                    result += child.toxml()
-                result += '</%s>' % self.kind
+    def write_xml(self, f_out, dtd_line=None, chunk_size=65536):
+        """
+        Write the XML for this node to f_out, as per toxml, but a chunk
+        of about "chunk_size" characters at a time, rather than building
+        up the whole document as one string.
+        """
+        pieces = []
+        size = 0
+        if dtd_line and isinstance(self, Element):
+            pieces.append('<?xml version="1.0"?>\n%s\n' % dtd_line)
+        # A stack of (element, iterator over its remaining children),
+        # with the element's end tag written when it is popped
+        stack = [(None, iter((self, )))]
+        while stack:
+            element, children = stack[-1]
+            for node in children:
+                if isinstance(node, Element):
+                    piece = '<' + node.kind
+                    if node._attrs:
+                        for k, v in node._attrs.items():
+                            piece += ' %s="%s"' % (k, v)
+                    if node.children:
+                        pieces.append(piece + '>')
+                        stack.append((node, iter(node.children)))
+                        size += len(piece) + 1
+                        break
+                    piece += '/>'
+                elif isinstance(node, Comment):
+                    piece = '<!--%s-->' % node.data
+                elif isinstance(node, Entity):
+                    piece = '&%s;' % node.name
+                else:
+                    assert isinstance(node, Text)
+                    piece = escape_xml_text(node.data)
+                pieces.append(piece)
+                size += len(piece)
+                if size >= chunk_size:
+                    f_out.write(''.join(pieces))
+                    pieces = []
+                    size = 0
             else:
-                result += '/>'
-            return result
-        elif isinstance(self, Comment):
-            return '<!--%s-->' % self.data
-        elif isinstance(self, Entity):
-            return '&%s;' % self.name
-        else:
-            assert isinstance(self, Text)
-            return escape(self.data)
+                stack.pop()
+                if element is not None:
+                    pieces.append('</%s>' % element.kind)
+                    size += len(element.kind) + 3
+        if pieces:
+            f_out.write(''.join(pieces))
 
     def to_dom_node(self, dom_doc):
         if isinstance(self, Element):
             dom_node = dom_doc.createElement(self.kind)
-            for k, v in self.attrs.items():
-                dom_node.setAttribute(k, v)
+            if self._attrs:
+                for k, v in self._attrs.items():
+                    dom_node.setAttribute(k, v)
             for child in self.children:
                 dom_node.appendChild(child.to_dom_node(dom_doc))
             return dom_node
@@ -83,19 +140,50 @@ class Node:
             return dom_doc.createTextNode(self.data)
 
 class Element(Node):
+    __slots__ = ('kind', '_attrs', 'children', 'rst_kind')
+
     def __init__(self, kind, attrs=None):
-        if not re.match('[a-zA-Z0-9-_]+', kind):
+        if not ELEMENT_NAME_PATTERN.match(kind):
             raise ValueError('bad name for element: %r' % kind)
-        self.kind = kind
+        self.kind = sys.intern(kind)
+        # The attribute dict is only allocated when first needed
         if attrs:
-            self.attrs = OrderedDict(attrs)
+            self._attrs = dict(attrs)
         else:
-            self.attrs = OrderedDict()
+            self._attrs = None
         self.children = []
         self.rst_kind = None
 
+    # Elements are pickled (e.g. to render a subtree in another process,
+    # or to cache a tree on disk) as a compact tuple, with the kind
+    # interned again on loading
+
+    def __getstate__(self):
+        return (self.kind, self._attrs, self.children, self.rst_kind)
+
+    def __setstate__(self, state):
+        kind, self._attrs, self.children, self.rst_kind = state
+        self.kind = sys.intern(kind)
+
+    @property
+    def attrs(self):
+        """
+        A read-only view of the attributes of the element; use set_attr
+        to change them.
+        """
+        attrs = self._attrs
+        if attrs is None:
+            return NO_ATTRS
+        return types.MappingProxyType(attrs)
+
+    def set_attr(self, name, value):
+        if self._attrs is None:
+            self._attrs = {}
+        self._attrs[name] = value
+
     def __repr__(self):
-        return 'Element(%r, %r, %r)' % (self.kind, self.attrs, self.rst_kind)
+        return 'Element(%r, %r, %r)' % (self.kind, self._attrs or {},
+                                        self.rst_kind)
 
     def dump(self, f_out, depth=0):
         f_out.write('%s%r\n' %  (' ' * depth, self))
@@ -145,12 +233,13 @@ class Element(Node):
         self.children.append(Comment(data))
 
     def add_text(self, data):
-        if self.children:
-            last_child = self.children[-1]
+        children = self.children
+        if children:
+            last_child = children[-1]
             if isinstance(last_child, Text):
                 last_child.data += data
                 return
-        self.children.append(Text(data))
+        children.append(Text(data))
 
     def prepend_text(self, data):
         if self.children:
@@ -173,41 +262,141 @@ class Element(Node):
         return dom_doc
 
 class Comment(Node):
+    __slots__ = ('data', )
+
     def __init__(self, data):
         self.data = data
 
     def __repr__(self):
         return 'Comment(%r)' % self.data
 
+    def __reduce__(self):
+        return (self.__class__, (self.data, ))
+
 class Text(Node):
+    __slots__ = ('data', )
+
     def __init__(self, data):
         self.data = data
 
     def __repr__(self):
         return 'Text(%r)' % self.data
 
+    def __reduce__(self):
+        return (self.__class__, (self.data, ))
+
 class Entity(Node):
+    __slots__ = ('name', )
+
     def __init__(self, name):
         self.name = name
 
     def __repr__(self):
         return 'Entity(%r)' % self.name
 
+    def __reduce__(self):
+        return (self.__class__, (self.name, ))
+
+class ChildCursor:
+    """
+    Find the positions of elements within their parents' children, for
+    visitors that need to look at an element's siblings.
+
+    A visitor handles the children of an element in order, so each
+    search resumes from the position found last time for that parent,
+    making the cost of finding all of an element's children linear in
+    their number, rather than quadratic as with repeated calls to
+    parent.children.index().  Nodes can be inserted or removed around
+    the positions found; if the child isn't found after the last
+    position, the search falls back to the whole list.
+    """
+    def __init__(self):
+        self.positions = {}
+
+    def index(self, parent, child):
+        children = parent.children
+        try:
+            i = children.index(child, self.positions.get(parent, 0))
+        except ValueError:
+            i = children.index(child)
+        self.positions[parent] = i
+        return i
+
 # Visitor base class
 
 class Visitor:
+    """
+    Traverse a tree, calling:
+      previsit_element(element) before an element's children,
+      postvisit_element(element, parent) after them,
+      visit_comment/visit_text/visit_entity for other nodes.
+
+    A subclass can instead handle a particular kind of element by
+    defining previsit_KIND(element) and/or postvisit_KIND(element, parent)
+    (with any '-' in the kind replaced by '_'), which are then called
+    instead of the generic methods for elements of that kind.
+
+    If the previsit method returns a true value, the element's children
+    (and its postvisit) are skipped.
+
+    The traversal uses an explicit stack rather than recursion, so that
+    deeply-nested trees don't hit the recursion limit.  As before, the
+    children of an element are snapshotted after its previsit.
+    """
     def visit(self, node, parent=None):
-        if isinstance(node, Element):
-            early_exit = self.previsit_element(node)
-            if early_exit:
-                return
-            for child in list(node.children):
-                self.visit(child, node)
-            self.postvisit_element(node, parent)
+        # Cache of kind -> handler (subclasses don't necessarily call
+        # our __init__, so set this up lazily)
+        if not hasattr(self, '_previsit_handlers'):
+            self._previsit_handlers = {}
+            self._postvisit_handlers = {}
+        if not isinstance(node, Element):
+            self._visit_leaf(node)
+            return
+        if self._previsit(node):
+            return
+        stack = [(node, parent, iter(list(node.children)))]
+        while stack:
+            element, parent, children = stack[-1]
+            for child in children:
+                if isinstance(child, Element):
+                    if not self._previsit(child):
+                        stack.append((child, element,
+                                      iter(list(child.children))))
+                        break
+                else:
+                    self._visit_leaf(child)
+            else:
+                stack.pop()
+                self._postvisit(element, parent)
+
+    def _previsit(self, element):
+        try:
+            handler = self._previsit_handlers[element.kind]
+        except KeyError:
+            handler = self._lookup_handler('previsit', element.kind)
+            self._previsit_handlers[element.kind] = handler
+        return handler(element)
+
+    def _postvisit(self, element, parent):
+        try:
+            handler = self._postvisit_handlers[element.kind]
+        except KeyError:
+            handler = self._lookup_handler('postvisit', element.kind)
+            self._postvisit_handlers[element.kind] = handler
+        handler(element, parent)
+
+    def _lookup_handler(self, prefix, kind):
+        name = '%s_%s' % (prefix, kind.replace('-', '_'))
+        handler = getattr(self, name, None)
+        if handler is None:
+            handler = getattr(self, '%s_element' % prefix)
+        return handler
+
+    def _visit_leaf(self, node):
+        if isinstance(node, Text):
+            self.visit_text(node)
         elif isinstance(node, Comment):
             self.visit_comment(node)
-        elif isinstance(node, Text):
-            self.visit_text(node)
         elif isinstance(node, Entity):
             self.visit_entity(node)
         else:
@@ -243,3 +432,86 @@ class NoopVisitor(Visitor):
 
     def visit_entity(self, entity):
         pass
+
+class FusedVisitor(Visitor):
+    """
+    Run several visitors over a tree in a single traversal.
+
+    At each element, the visitors' previsit handlers are called in
+    order, then the element's children are visited, then the visitors'
+    postvisit handlers are called in order.  Handlers that a visitor
+    merely inherits from NoopVisitor are skipped, so that a kind of
+    element that none of the visitors care about costs a dict lookup.
+
+    If a handler changes the element's kind, the remaining visitors
+    see the new kind, as they would if run one after another.
+
+    The values returned by previsit handlers are ignored, so visitors
+    that rely on skipping part of the tree can't be fused.
+    """
+    def __init__(self, visitors):
+        self.visitors = list(visitors)
+        self._previsit_chains = {}
+        self._postvisit_chains = {}
+        self._leaf_chains = {}
+
+    def _previsit(self, element):
+        self._run_chain(self._previsit_chains, 'previsit', element,
+                        (element, ))
+        return False
+
+    def _postvisit(self, element, parent):
+        self._run_chain(self._postvisit_chains, 'postvisit', element,
+                        (element, parent))
+
+    def _run_chain(self, chains, prefix, element, args):
+        kind = element.kind
+        last = -1
+        while True:
+            try:
+                chain = chains[kind]
+            except KeyError:
+                chain = self._make_chain(prefix, kind)
+                chains[kind] = chain
+            for index, handler in chain:
+                if index <= last:
+                    continue
+                handler(*args)
+                last = index
+                if element.kind != kind:
+                    # Pick up the handlers for the new kind
+                    kind = element.kind
+                    break
+            else:
+                return
+
+    def _make_chain(self, prefix, kind):
+        noop = getattr(NoopVisitor, '%s_element' % prefix)
+        chain = []
+        for index, visitor in enumerate(self.visitors):
+            handler = visitor._lookup_handler(prefix, kind)
+            if getattr(handler, '__func__', None) is not noop:
+                chain.append((index, handler))
+        return chain
+
+    def _get_leaf_chain(self, name):
+        try:
+            return self._leaf_chains[name]
+        except KeyError:
+            noop = getattr(NoopVisitor, name)
+            chain = [getattr(visitor, name) for visitor in self.visitors
+                     if getattr(type(visitor), name, None) is not noop]
+            self._leaf_chains[name] = chain
+            return chain
+
+    def visit_comment(self, comment):
+        for handler in self._get_leaf_chain('visit_comment'):
+            handler(comment)
+
+    def visit_text(self, text):
+        for handler in self._get_leaf_chain('visit_text'):
+            handler(text)
+
+    def visit_entity(self, entity):
+        for handler in self._get_leaf_chain('visit_entity'):
+            handler(entity)
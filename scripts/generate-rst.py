@@ -1,27 +1,83 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
+import filecmp
 import os
 import shutil
-import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import texi2rst
 
 parser = argparse.ArgumentParser(description='Convert XML files to RST')
 parser.add_argument('xml_dir', help='Directory with XML files')
 parser.add_argument('output', help='Output directory')
-args = parser.parse_args()
-
-shutil.rmtree(args.output, ignore_errors=True)
-os.mkdir(args.output)
-shutil.copy('templates/baseconf.py', args.output)
-shutil.copy('templates/Makefile.root', os.path.join(args.output, 'Makefile'))
-
-for xml in os.listdir(args.xml_dir):
-    base, _ = os.path.splitext(xml)
-    shutil.rmtree('output', ignore_errors=True)
-    r = subprocess.check_output(f'../texi2rst.py {args.xml_dir}/{xml}', shell=True, encoding='utf8')
-    shutil.move('output', os.path.join(args.output, base))
-    config = f'templates/{base}/conf.py'
-    shutil.copy(config, os.path.join(args.output, base))
-    shutil.copy('templates/Makefile', os.path.join(args.output, base))
-    with open(os.path.join(args.output, base, 'index.rst'), 'w') as w:
-        w.write(open('templates/index.rst').read().replace('__doc__', base))
+parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                    help='Number of manuals to convert at once')
+
+def convert(xml, output_dir):
+    # Each manual is converted into a directory of its own, so that they
+    # can be converted at the same time
+    os.makedirs(output_dir, exist_ok=True)
+    return texi2rst.convert_file(xml, output_dir, keep=['index'])
+
+def copy_if_changed(src, dst):
+    # Leave unchanged files alone, as for texi2rst's FileOpener
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if not os.path.exists(dst) or not filecmp.cmp(src, dst, shallow=False):
+        shutil.copy(src, dst)
+
+def write_if_changed(path, text):
+    if os.path.exists(path):
+        with open(path) as f_in:
+            if f_in.read() == text:
+                return
+    with open(path, 'w') as f_out:
+        f_out.write(text)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    # The output of a previous run is updated in place, rather than
+    # removed, so that Sphinx only needs to re-read what has changed
+    os.makedirs(args.output, exist_ok=True)
+    copy_if_changed('templates/baseconf.py', args.output)
+    copy_if_changed('templates/Makefile.root', os.path.join(args.output, 'Makefile'))
+
+    # Start on the largest manuals (gcc and gccint) first, so that they
+    # aren't left running on their own at the end
+    xmls = sorted((os.path.join(args.xml_dir, xml)
+                   for xml in os.listdir(args.xml_dir)),
+                  key=os.path.getsize, reverse=True)
+    bases = set()
+    with concurrent.futures.ProcessPoolExecutor(args.jobs) as executor:
+        futures = {}
+        for xml in xmls:
+            base, _ = os.path.splitext(os.path.basename(xml))
+            output_dir = os.path.join(args.output, base)
+            bases.add(base)
+            futures[executor.submit(convert, xml, output_dir)] = base
+        for future in concurrent.futures.as_completed(futures):
+            base = futures[future]
+            counts = future.result()
+            output_dir = os.path.join(args.output, base)
+            print(texi2rst.SUMMARY_FORMAT % ((output_dir, ) + counts))
+            config = f'templates/{base}/conf.py'
+            copy_if_changed(config, output_dir)
+            copy_if_changed('templates/Makefile', output_dir)
+            write_if_changed(os.path.join(output_dir, 'index.rst'),
+                             open('templates/index.rst').read().replace('__doc__', base))
+
+    # Remove the directories of manuals which are no longer converted
+    # (recognizable by the manifest texi2rst writes in each), leaving
+    # anything else in the output directory alone
+    for name in sorted(os.listdir(args.output)):
+        path = os.path.join(args.output, name)
+        if (name not in bases
+            and os.path.exists(os.path.join(path,
+                                            texi2rst.FileOpener.MANIFEST))):
+            shutil.rmtree(path)
+            print(f'removed {path}')
@@ -1,34 +1,142 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
+import hashlib
+import json
 import os
+import re
 import subprocess
 
 parser = argparse.ArgumentParser(description='Convert TEXI files to XML')
 parser.add_argument('gcc_dir', help='GCC source directory')
 parser.add_argument('gcc_objdir', help='GCC object directory')
 parser.add_argument('output', help='Output directory')
-args = parser.parse_args()
-
-includes = f'-I{args.gcc_dir}/gcc/doc -I{args.gcc_dir}/gcc/doc/include -I{args.gcc_objdir}/gcc'
-cmd = 'makeinfo --xml'
-
-if not os.path.exists(args.output):
-    os.mkdir(args.output)
-
-subprocess.check_output(f'{cmd} {includes} {args.gcc_dir}/gcc/doc/install.texi -o {args.output}/install.xml', shell=True)
-subprocess.check_output(f'{cmd} {includes} {args.gcc_dir}/gcc/doc/gcc.texi -o {args.output}/gcc.xml', shell=True)
-subprocess.check_output(f'{cmd} {includes} {args.gcc_dir}/gcc/fortran/gfortran.texi -I{args.gcc_dir}/gcc/fortran -o '
-                        f'{args.output}/gfortran.xml', shell=True)
-subprocess.check_output(f'{cmd} {includes} {args.gcc_dir}/gcc/go/gccgo.texi -I{args.gcc_dir}/gcc/go -o {args.output}/gccgo.xml',
-                        shell=True)
-subprocess.check_output(f'{cmd} {includes} {args.gcc_dir}/gcc/doc/cpp.texi -o {args.output}/cpp.xml', shell=True)
-
-for lib in ('libgomp', 'libquadmath', 'libitm'):
-    subprocess.check_output(f'{cmd} {includes} {args.gcc_dir}/{lib}/{lib}.texi -o {args.output}/{lib}.xml', shell=True)
-
-subprocess.check_output(f'{cmd} {includes} {args.gcc_dir}/gcc/doc/gccint.texi -o {args.output}/gccint.xml', shell=True)
-subprocess.check_output(f'{cmd} {includes} {args.gcc_dir}/gcc/doc/cppinternals.texi -o {args.output}/cppinternals.xml', shell=True)
-subprocess.check_output(f'{cmd} {includes} {args.gcc_dir}/gcc/fortran/gfc-internals.texi -o {args.output}/gfc-internals.xml',
-                        shell=True)
-subprocess.check_output(f'{cmd} {includes} {args.gcc_dir}/libiberty/libiberty.texi -o {args.output}/libiberty.xml', shell=True)
+parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                    help='Number of makeinfo processes to run at once')
+parser.add_argument('--force', action='store_true',
+                    help='Regenerate every manual, even if unchanged')
+
+INCLUDE_PATTERN = re.compile(r'^\s*@include\s+(\S+)', re.MULTILINE)
+
+def get_manuals(gcc_dir):
+    """
+    Get (name, texi file, extra include directories) for each manual
+    """
+    manuals = [('install', 'gcc/doc/install.texi', []),
+               ('gcc', 'gcc/doc/gcc.texi', []),
+               ('gfortran', 'gcc/fortran/gfortran.texi', ['gcc/fortran']),
+               ('gccgo', 'gcc/go/gccgo.texi', ['gcc/go']),
+               ('cpp', 'gcc/doc/cpp.texi', [])]
+    for lib in ('libgomp', 'libquadmath', 'libitm'):
+        manuals.append((lib, f'{lib}/{lib}.texi', []))
+    manuals += [('gccint', 'gcc/doc/gccint.texi', []),
+                ('cppinternals', 'gcc/doc/cppinternals.texi', []),
+                ('gfc-internals', 'gcc/fortran/gfc-internals.texi', []),
+                ('libiberty', 'libiberty/libiberty.texi', [])]
+    return [(name, f'{gcc_dir}/{texi}', [f'{gcc_dir}/{d}' for d in dirs])
+            for name, texi, dirs in manuals]
+
+def get_include_closure(texi, include_dirs):
+    """
+    Get the files that makeinfo would read for "texi": the file itself,
+    and everything it @includes (recursively), found as makeinfo would
+    find them, in the directory of the including file or in one of the
+    include directories.  Includes which can't be found are given as
+    None (e.g. if they would be generated by the build).
+    """
+    closure = {}
+    worklist = [texi]
+    while worklist:
+        path = worklist.pop()
+        if path in closure:
+            continue
+        closure[path] = path
+        with open(path, encoding='utf8', errors='replace') as f_in:
+            src = f_in.read()
+        for m in INCLUDE_PATTERN.finditer(src):
+            name = m.group(1)
+            for d in [os.path.dirname(path)] + include_dirs:
+                candidate = os.path.join(d, name)
+                if os.path.exists(candidate):
+                    worklist.append(candidate)
+                    break
+            else:
+                closure[name] = None
+    return closure
+
+def get_hashes(cmd, texi, include_dirs):
+    """
+    Get a dict of the content hashes of the include closure of "texi",
+    plus the command line it is built with, for the manifest.
+    """
+    hashes = {'command': cmd}
+    for name, path in get_include_closure(texi, include_dirs).items():
+        if path is None:
+            hashes[name] = None
+        else:
+            with open(path, 'rb') as f_in:
+                hashes[name] = hashlib.sha256(f_in.read()).hexdigest()
+    return hashes
+
+def generate(cmd):
+    subprocess.check_output(cmd, shell=True)
+
+def write_manifest(path, manifest):
+    # Replace the manifest atomically, so that an interrupted run leaves
+    # either the old or the new one
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f_out:
+        json.dump(manifest, f_out, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    includes = f'-I{args.gcc_dir}/gcc/doc -I{args.gcc_dir}/gcc/doc/include -I{args.gcc_objdir}/gcc'
+    include_dirs = [f'{args.gcc_dir}/gcc/doc', f'{args.gcc_dir}/gcc/doc/include', f'{args.gcc_objdir}/gcc']
+    cmd = 'makeinfo --xml'
+
+    if not os.path.exists(args.output):
+        os.mkdir(args.output)
+
+    # The hashes of the inputs of each manual as of its last successful
+    # generation, kept next to the output directory
+    manifest_path = os.path.normpath(args.output) + '.manifest.json'
+    manifest = {}
+    if os.path.exists(manifest_path) and not args.force:
+        with open(manifest_path) as f_in:
+            manifest = json.load(f_in)
+
+    futures = {}
+    with concurrent.futures.ThreadPoolExecutor(args.jobs) as executor:
+        for name, texi, extra_dirs in get_manuals(args.gcc_dir):
+            extra_includes = ''.join(f' -I{d}' for d in extra_dirs)
+            output = f'{args.output}/{name}.xml'
+            manual_cmd = f'{cmd} {includes} {texi}{extra_includes} -o {output}'
+            hashes = get_hashes(manual_cmd, texi, extra_dirs + include_dirs)
+            if manifest.get(name) == hashes and os.path.exists(output):
+                print(f'unchanged: {name}')
+                continue
+            futures[executor.submit(generate, manual_cmd)] = (name, hashes)
+        failed = []
+        for future in concurrent.futures.as_completed(futures):
+            name, hashes = futures[future]
+            # (OSError covers e.g. makeinfo being missing)
+            try:
+                future.result()
+            except (subprocess.CalledProcessError, OSError) as e:
+                print(f'failed: {name}: {e}')
+                if manifest.pop(name, None) is not None:
+                    write_manifest(manifest_path, manifest)
+                failed.append(name)
+                continue
+            print(f'generated: {name}')
+            # Record each manual as soon as it is done, so that an
+            # interrupted run only has to redo the rest
+            manifest[name] = hashes
+            write_manifest(manifest_path, manifest)
+
+    write_manifest(manifest_path, manifest)
+    if failed:
+        raise SystemExit(f'failed to generate: {" ".join(sorted(failed))}')
@@ -46,3 +46,133 @@ class NodeTests(unittest.TestCase):
             '''<?xml version="1.0"?>
 <!DOCTYPE texinfo PUBLIC "-//GNU//DTD TexinfoML V5.0//EN" "http://www.gnu.org/software/texinfo/dtd/5.0/texinfo.dtd">
 <A/>''')
+
+    def test_compact_nodes(self):
+        a = self.make_tree()
+        for node in a.iter_depth_first():
+            self.assertFalse(hasattr(node, '__dict__'))
+        with self.assertRaises(AttributeError):
+            a.rows = []
+
+    def test_lazy_attrs(self):
+        a = Element('A')
+        self.assertIsNone(a._attrs)
+        self.assertEqual(a.toxml(), '<A/>')
+        self.assertIsNone(a._attrs)
+        # Reading the attributes doesn't allocate them either
+        self.assertIsNone(a.attrs.get('x'))
+        self.assertNotIn('x', a.attrs)
+        self.assertIsNone(a._attrs)
+        with self.assertRaises(TypeError):
+            a.attrs['x'] = '1'
+        a.set_attr('x', '1')
+        a.set_attr('a', '2')
+        self.assertEqual(a.toxml(), '<A x="1" a="2"/>')
+        self.assertEqual(dict(a.attrs), {'x': '1', 'a': '2'})
+        # The attributes are only written via set_attr, whether or not
+        # the element already has any
+        for element in (Element('A'), Element('A', {'y': '1'})):
+            with self.assertRaises(TypeError):
+                element.attrs['x'] = '1'
+            element.set_attr('x', '2')
+            self.assertEqual(element.attrs['x'], '2')
+
+    def test_deep_tree(self):
+        root = Element('A')
+        element = root
+        for i in range(10000):
+            child = Element('A')
+            element.children = [Text('x'), child]
+            element = child
+        class Counter(NoopVisitor):
+            def __init__(self):
+                self.count = 0
+            def postvisit_element(self, element, parent):
+                self.count += 1
+        v = Counter()
+        v.visit(root)
+        self.assertEqual(v.count, 10001)
+        self.assertEqual(len(list(root.iter_depth_first())), 20001)
+        self.assertEqual(len(list(root.iter_depth_first_edges())), 20000)
+
+    def test_per_kind_handlers(self):
+        a = self.make_tree()
+        events = []
+        class KindVisitor(NoopVisitor):
+            def previsit_element(self, element):
+                events.append(('pre', element.kind))
+            def previsit_B(self, element):
+                events.append(('pre B', element.kind))
+                return True
+            def postvisit_C(self, element, parent):
+                events.append(('post C', parent.kind))
+        KindVisitor().visit(a)
+        self.assertEqual(events,
+                         [('pre', 'A'), ('pre B', 'B'), ('pre', 'C'),
+                          ('post C', 'A')])
+
+    def test_fused_visitor(self):
+        a = self.make_tree()
+        events = []
+        class First(NoopVisitor):
+            def previsit_B(self, element):
+                events.append(('first', element.kind))
+                element.kind = 'D'
+            def visit_text(self, text):
+                events.append(('first', text.data))
+        class Second(NoopVisitor):
+            def previsit_element(self, element):
+                events.append(('second', element.kind))
+            def postvisit_C(self, element, parent):
+                events.append(('second post', element.kind))
+        FusedVisitor([First(), Second()]).visit(a)
+        self.assertEqual(events,
+                         [('second', 'A'),
+                          ('first', 'B'), ('second', 'D'),
+                          ('first', 'within b'), ('first', 'also within b'),
+                          ('first', 'foo'),
+                          ('second', 'C'), ('second post', 'C')])
+
+    def test_child_cursor(self):
+        a = self.make_tree()
+        b, foo, c = a.children
+        cursor = ChildCursor()
+        self.assertEqual(cursor.index(a, b), 0)
+        self.assertEqual(cursor.index(a, c), 2)
+        # Insertions before the last position found are allowed for
+        a.children.insert(0, Text('bar'))
+        self.assertEqual(cursor.index(a, foo), 2)
+        self.assertEqual(cursor.index(a, b), 1)
+        with self.assertRaises(ValueError):
+            cursor.index(a, Text('baz'))
+
+    def test_write_xml(self):
+        a = self.make_tree()
+        a.set_attr('x', '1')
+        a.children.append(Entity('lbrace'))
+        a.children.append(Text('<&>'))
+        class ChunkRecorder:
+            def __init__(self):
+                self.chunks = []
+            def write(self, chunk):
+                self.chunks.append(chunk)
+        f_out = ChunkRecorder()
+        a.write_xml(f_out, dtd_line='<!DOCTYPE A>', chunk_size=16)
+        self.assertEqual(''.join(f_out.chunks),
+                         '<?xml version="1.0"?>\n<!DOCTYPE A>\n'
+                         '<A x="1"><B>within b<!--ignore-->also within b</B>'
+                         'foo<C/>&lbrace;&lt;&amp;&gt;</A>')
+        self.assertEqual(''.join(f_out.chunks),
+                         a.toxml(dtd_line='<!DOCTYPE A>'))
+        self.assertGreater(len(f_out.chunks), 1)
+        self.assertTrue(all(len(chunk) < 64 for chunk in f_out.chunks))
+
+    def test_write_xml_deep_tree(self):
+        root = Element('A')
+        element = root
+        for i in range(10000):
+            child = Element('A')
+            element.children = [child]
+            element = child
+        xml = root.toxml()
+        self.assertEqual(xml, '<A>' * 10000 + '<A/>' + '</A>' * 10000)
@@ -2,6 +2,9 @@
 
 from texi2rst import *
 
+import contextlib
+import json
+import tempfile
 import unittest
 
 class Texi2RstTests(unittest.TestCase):
@@ -79,6 +82,45 @@ class CommentTests(Texi2RstTests):
         out = self.make_rst_string(doc)
         self.assertEqual(u'.. First line\n   Second line\n\n', out)
 
+class ParsingTests(Texi2RstTests):
+    def test_attribute_order(self):
+        doc = from_xml_string('<texinfo><node name="Top" spaces=" "/></texinfo>')
+        node = doc.children[0].children[0]
+        self.assertEqual(list(node.attrs.items()),
+                         [('name', 'Top'), ('spaces', ' ')])
+
+    def test_text_is_merged(self):
+        doc = from_xml_string('<para>a &amp; b &lt; c &lbrace;</para>')
+        para = doc.children[0]
+        self.assertEqual(len(para.children), 1)
+        self.assertEqual(para.children[0].data, 'a & b < c {')
+
+    def test_entities(self):
+        doc = from_xml_string('<para>&lbrace;x&rbrace;&dots;</para>')
+        self.assertEqual(doc.children[0].children[0].data, '{x}...')
+
+    def test_entities_with_dtd(self):
+        xml_src = ('<?xml version="1.0"?>\n'
+                   '<!DOCTYPE texinfo PUBLIC "-//GNU//DTD TexinfoML V5.0//EN"'
+                   ' "http://www.gnu.org/software/texinfo/dtd/5.0/texinfo.dtd">\n'
+                   '<texinfo><!-- c &arobase;foo --><para>&arobase;</para></texinfo>')
+        doc = from_xml_string(xml_src)
+        texinfo = doc.children[0]
+        self.assertEqual(texinfo.children[0].data, ' c @foo')
+        self.assertEqual(texinfo.children[1].children[0].data, '@')
+
+    def test_unhandled_entity(self):
+        with self.assertRaises(ValueError):
+            from_xml_string('<para>&bogus;</para>')
+
+    def test_extra_entities(self):
+        doc = from_xml_string('<para>&bogus;</para>', {'bogus': 'BOGUS'})
+        self.assertEqual(doc.children[0].children[0].data, 'BOGUS')
+
+    def test_processing_instruction(self):
+        with self.assertRaises(ValueError):
+            from_xml_string('<texinfo><?foo bar?></texinfo>')
+
 class PruningTests(Texi2RstTests):
     def test_command(self):
         xml_src = '<texinfo><filename/></texinfo>'
@@ -90,6 +132,17 @@ class PruningTests(Texi2RstTests):
         out = self.make_rst_string(doc)
         self.assertEqual(u'', out)
 
+    def test_pruned_xref(self):
+        # The later passes don't see the pruned content
+        xml_src = ('<texinfo><titlepage><para>See <xref label="x"/>.</para>'
+                   '</titlepage><para>Text.</para></texinfo>')
+        doc = from_xml_string(xml_src)
+        xref = [node for node in doc.iter_depth_first()
+                if isinstance(node, Element) and node.kind == 'xref'][0]
+        doc = convert_to_rst(doc, Context())
+        self.assertEqual(xref.rst_kind, None)
+        self.assertEqual(self.make_rst_string(doc), 'Text.\n\n')
+
 class MenuTests(Texi2RstTests):
     def test_menu(self):
         xml_src = u'''
@@ -128,6 +181,24 @@ class MenuTests(Texi2RstTests):
         self.assertEqual(u'.. _c-implementation:\n',
                          out)
 
+    def test_move_nodes(self):
+        xml_src = (u'<texinfo>'
+                   u'<node name="A"><nodename>A</nodename></node>'
+                   u'<chapter><sectiontitle>A</sectiontitle></chapter>'
+                   u'<para>x<anchor>B</anchor>y</para>'
+                   u'<para>z</para>'
+                   u'<anchor>C</anchor>'
+                   u'</texinfo>')
+        doc = from_xml_string(xml_src)
+        doc = fixup_nodes(doc, self.ctxt)
+        self.assertEqual(doc.toxml(),
+                         '<document><texinfo>'
+                         '<chapter><node name="A"/><sectiontitle>A</sectiontitle></chapter>'
+                         '<para>xy</para>'
+                         '<para><anchor/>z</para>'
+                         '<anchor/>'
+                         '</texinfo></document>')
+
 class InlineMarkupTests(Texi2RstTests):
     def test_command(self):
         xml_src = '<texinfo>Before <command>gcc</command> after</texinfo>'
@@ -197,6 +268,25 @@ some chapter text
 ''',
                          out)
 
+    def test_title_with_markup(self):
+        xml_src = ('<chapter><sectiontitle>The <code>-O</code> option'
+                   + '</sectiontitle><para>some text</para></chapter>')
+        doc = from_xml_string(xml_src)
+        doc = fixup_titles(doc)
+        doc = fixup_inline_markup(doc)
+        out = self.make_rst_string(doc)
+        self.assertEqual(u'The ``-O`` option\n-----------------\n\n'
+                         + 'some text\n\n', out)
+
+    def test_title_spanning_lines(self):
+        xml_src = ('<texinfo><sectiontitle>A long\ntitle</sectiontitle>'
+                   + '<para>some text</para></texinfo>')
+        doc = from_xml_string(xml_src)
+        doc = fixup_titles(doc)
+        out = self.make_rst_string(doc)
+        self.assertEqual(u'A long\ntitle\n============\n\nsome text\n\n',
+                         out)
+
     def test_subsubheading(self):
         xml_src = ('<texinfo><subsubheading>A sub-sub-heading</subsubheading>'
                    + '<para>some text</para></texinfo>')
@@ -220,6 +310,25 @@ some chapter text
         out = self.make_rst_string(doc)
         self.assertEqual('See also :option:`-Walloca-larger-than`:samp:`={byte-size}`.\n\n', out)
 
+    def test_option_ref_with_trailing_sign(self):
+        xml_src = '<para>Use <option>-std=</option></para>'
+        doc = from_xml_string(xml_src)
+        doc = convert_to_rst(doc, self.ctxt)
+        out = self.make_rst_string(doc)
+        self.assertEqual('Use :option:`-std=`\n\n', out)
+
+    def test_many_option_refs(self):
+        xml_src = ('<para>'
+                   + ''.join('<option>-f%i=<var>n</var></option>, ' % i
+                             for i in range(1000))
+                   + '</para>')
+        doc = from_xml_string(xml_src)
+        doc = convert_to_rst(doc, self.ctxt)
+        out = self.make_rst_string(doc)
+        self.assertTrue(out.startswith(':option:`-f0`:samp:`={n}` ,'
+                                       ' :option:`-f1`:samp:`={n}` ,'))
+        self.assertEqual(out.count(':option:'), 1000)
+
 class OptionTests(Texi2RstTests):
     def test_valid_option_ref(self):
         xml_src = ('<texinfo><option>--some-opt</option></texinfo>')
@@ -971,6 +1080,56 @@ Some text about goto labels.
                 print(repr(dict_[k]))
                 print(dict_[k])
 
+    def test_splitting_in_parallel(self):
+        xml_src = u'''<texinfo>
+<top><sectiontitle>Top-level title</sectiontitle></top>
+<chapter>
+  <sectiontitle>Chapter 1 title</sectiontitle>
+  <para>Chapter 1 text.</para>
+  <section><sectiontitle>Chapter 1 Section 1 title</sectiontitle></section>
+</chapter>
+Unterminated <code>text</code><chapter><sectiontitle>Chapter 2 title</sectiontitle></chapter>
+<chapter><sectiontitle>Chapter 3 title</sectiontitle></chapter>
+</texinfo>
+'''
+        tree = from_xml_string(xml_src)
+        tree = convert_to_rst(tree, self.ctxt)
+        def get_files(opener, f_out):
+            return ([('gcc', f_out.getvalue())]
+                    + [(output_file.name, text)
+                       for output_file, text in opener.get_files()])
+        opener = CapturingOpener()
+        f_out = io.StringIO()
+        w = RstWriter(f_out, opener)
+        w.visit(tree)
+        w.flush()
+        expected = get_files(opener, f_out)
+        self.assertEqual(len(expected), 5)
+        opener = CapturingOpener()
+        f_out = io.StringIO()
+        write_rst_parallel(tree, f_out, opener, 2)
+        result = get_files(opener, f_out)
+        self.assertEqual(expected, result)
+
+    def test_splitting_in_parallel_deeply_nested(self):
+        # A chapter nested too deeply to be pickled for a worker should
+        # still be written, by this process
+        depth = 3000
+        xml_src = (u'<texinfo><chapter><sectiontitle>Deep</sectiontitle>'
+                   + u'<quotation>' * depth + u'<para>Text.</para>'
+                   + u'</quotation>' * depth + u'</chapter></texinfo>')
+        tree = from_xml_string(xml_src)
+        tree = convert_to_rst(tree, self.ctxt)
+        opener = CapturingOpener()
+        w = RstWriter(io.StringIO(), opener)
+        w.visit(tree)
+        w.flush()
+        expected = [text for _, text in opener.get_files()]
+        opener = CapturingOpener()
+        write_rst_parallel(tree, io.StringIO(), opener, 2)
+        result = [text for _, text in opener.get_files()]
+        self.assertEqual(expected, result)
+
     def test_nodes_placed_before_section_titles(self):
         # Make sure that nodes get placed with their sections, with links
         # appearing before section titles
@@ -1028,6 +1187,304 @@ First para of attributes
 
 ''')
 
+class StreamingTests(Texi2RstTests):
+    def assert_same_as_batch(self, xml_src):
+        expected = self.make_rst_strings(
+            convert_to_rst(from_xml_string(xml_src), Context()))
+
+        class StringOpener(RstOpener):
+            def __init__(self):
+                self.dict_ = OrderedDict()
+            def open(self, output_file):
+                f_out = io.StringIO()
+                self.dict_[output_file.name] = f_out
+                return f_out
+            def close(self, f_out):
+                pass
+        opener = StringOpener()
+        f_out = io.StringIO()
+        convert_to_rst_streaming(io.StringIO(xml_src), Context(), f_out,
+                                 opener)
+        result = OrderedDict([('gcc', f_out.getvalue())])
+        for name, f in opener.dict_.items():
+            result[name] = f.getvalue()
+        self.assertEqual(sorted(expected.items()), sorted(result.items()))
+
+    def test_units_written_as_parsed(self):
+        # Each unit's file should be complete before the next unit is
+        # read, rather than any of it being held back until the end
+        chunks = [u'<texinfo><chapter><sectiontitle>Chapter 1</sectiontitle>'
+                  + u'<para>Text.</para>' * 1000 + u'</chapter>',
+                  u'<chapter><sectiontitle>Chapter 2</sectiontitle>'
+                  + u'</chapter>',
+                  u'</texinfo>']
+        opener = CapturingOpener()
+        snapshots = []
+        class ChunkReader:
+            def read(self, size):
+                snapshots.append(opener.get_files())
+                return chunks.pop(0) if chunks else u''
+        convert_to_rst_streaming(ChunkReader(), Context(), io.StringIO(),
+                                 opener)
+        files = opener.get_files()
+        self.assertEqual(len(files), 2)
+        self.assertEqual(snapshots[1], files[:1])
+
+    def test_chapters(self):
+        self.assert_same_as_batch(u'''<texinfo>
+<node name="Top"><nodename>Top</nodename></node>
+<top>
+   <sectiontitle>Top-level title</sectiontitle>
+   <para>Top-level text.</para>
+</top>
+<node name="Chapter-1"><nodename>Chapter 1</nodename></node>
+<chapter>
+  <sectiontitle>Chapter 1 title</sectiontitle>
+  <para>Chapter 1 text.</para>
+  <section spaces=" ">
+     <sectiontitle>Chapter 1 Section 1 title</sectiontitle>
+     <para>Chapter 1 Section 1 text.</para>
+  </section>
+</chapter>
+<!-- some comment -->
+<node name="Chapter-2"><nodename>Chapter 2</nodename></node>
+<chapter>
+  <sectiontitle>Chapter 2 title</sectiontitle>
+  <subsection><sectiontitle>Subsection</sectiontitle></subsection>
+</chapter>
+<appendix>
+  <sectiontitle>Appendix title</sectiontitle>
+</appendix>
+</texinfo>
+''')
+
+class WriterTests(Texi2RstTests):
+    def test_write(self):
+        w = RstWriter(io.StringIO())
+        w.write('a\n\n\n\nb ')
+        w.indent += 1
+        w.write('\n \nc\nd')
+        w.indent -= 1
+        w.write('\n\n')
+        w.write('e')
+        self.assertEqual(w.f_out.getvalue(), '')
+        w.finish()
+        # No repeated blank lines, and no whitespace-only lines
+        self.assertEqual(w.f_out.getvalue(), 'a\n\nb \n\n  c\n  d\n\ne')
+
+    def test_batched_writes(self):
+        class StringOpener(RstOpener):
+            def __init__(self):
+                self.f_out = io.StringIO()
+            def open(self, output_file):
+                return self.f_out
+            def close(self, f_out):
+                pass
+        opener = StringOpener()
+        w = RstWriter(io.StringIO(), opener)
+        w.write('before\n')
+        output_file = OutputFile('other')
+        w.push_output_file(output_file)
+        for i in range(1000):
+            w.write('line %i\n' % i)
+        self.assertNotEqual(opener.f_out.getvalue(), '')
+        w.write('end\n')
+        w.pop_output_file(output_file)
+        w.write('after\n')
+        w.finish()
+        self.assertEqual(w.f_out.getvalue(), 'before\nafter\n')
+        self.assertEqual(opener.f_out.getvalue(),
+                         ''.join('line %i\n' % i for i in range(1000))
+                         + 'end\n')
+
+class TreeCacheTests(Texi2RstTests):
+    def test_cached_tree(self):
+        xml_src = (u'<texinfo><chapter><sectiontitle>A</sectiontitle>'
+                   + '<para>Some &lbrace;text&rbrace;</para></chapter>'
+                   + '<!-- c comment --></texinfo>')
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = TreeCache(cache_dir)
+            tree = from_xml_string_cached(xml_src, cache)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            cached_tree = from_xml_string_cached(xml_src, cache)
+            self.assertIsNot(tree, cached_tree)
+            self.assertEqual(tree.toxml(), cached_tree.toxml())
+            self.assertEqual(
+                self.make_rst_strings(convert_to_rst(tree, self.ctxt)),
+                self.make_rst_strings(convert_to_rst(cached_tree, Context())))
+
+    def test_eviction(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = TreeCache(cache_dir)
+            keys = []
+            for i in range(3):
+                xml_src = u'<texinfo><para>%s</para></texinfo>' % ('x' * i)
+                keys.append(cache.get_key(xml_src))
+                from_xml_string_cached(xml_src, cache)
+                os.utime(cache.get_path(keys[-1]), (i, i))
+            self.assertEqual(len(os.listdir(cache_dir)), 3)
+            # Using the first entry makes it the most recently used...
+            self.assertIsNotNone(cache.load(keys[0]))
+            # ...so that the second is evicted first
+            cache.max_size = sum(os.path.getsize(cache.get_path(key))
+                                 for key in (keys[0], keys[2]))
+            cache.evict()
+            self.assertEqual(sorted(os.listdir(cache_dir)),
+                             sorted(os.path.basename(cache.get_path(key))
+                                    for key in (keys[0], keys[2])))
+
+    def test_corrupt_entry(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = TreeCache(cache_dir)
+            key = cache.get_key(u'<texinfo/>')
+            with open(cache.get_path(key), 'wb') as f_out:
+                f_out.write(b'truncated')
+            self.assertIsNone(cache.load(key))
+            self.assertEqual(os.listdir(cache_dir), [])
+            self.assertIsNone(cache.load(key))
+
+    def test_corrupt_entry_verbose(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = TreeCache(cache_dir, verbose=True)
+            key = cache.get_key(u'<texinfo/>')
+            with open(cache.get_path(key), 'wb') as f_out:
+                f_out.write(b'truncated')
+            f_err = io.StringIO()
+            with contextlib.redirect_stderr(f_err):
+                self.assertIsNone(cache.load(key))
+            self.assertIn(cache.get_path(key), f_err.getvalue())
+
+class FileOpenerTests(Texi2RstTests):
+    def write_files(self, output_dir, files):
+        opener = FileOpener(output_dir, keep=['index'])
+        for name, text in files.items():
+            f_out = opener.open(OutputFile(name))
+            f_out.write(text)
+            opener.close(f_out)
+        counts = opener.finish()
+        self.assertEqual(counts, (len(opener.written), len(opener.unchanged),
+                                  len(opener.removed)))
+        return opener.written, opener.unchanged, opener.removed
+
+    def test_unchanged_files(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            def path(name):
+                return os.path.join(output_dir, name)
+            with open(path('index.rst'), 'w') as f_out:
+                f_out.write('index')
+            with open(path('conf.py'), 'w') as f_out:
+                f_out.write('conf')
+            # A file which wasn't written by a previous conversion
+            with open(path('extra.rst'), 'w') as f_out:
+                f_out.write('extra')
+            written, unchanged, removed = \
+                self.write_files(output_dir, {'a': 'A', 'b': 'B', 'c': 'C'})
+            self.assertEqual(written, [path('a.rst'), path('b.rst'),
+                                       path('c.rst')])
+            self.assertEqual(unchanged, [])
+            self.assertEqual(removed, [])
+            # Backdate the files, to see which are rewritten
+            for name in ('a.rst', 'b.rst', 'c.rst'):
+                os.utime(path(name), (0, 0))
+
+            written, unchanged, removed = \
+                self.write_files(output_dir, {'a': 'A', 'b': 'B2'})
+            self.assertEqual(written, [path('b.rst')])
+            self.assertEqual(unchanged, [path('a.rst')])
+            self.assertEqual(removed, ['c.rst'])
+            self.assertEqual(os.path.getmtime(path('a.rst')), 0)
+            with open(path('b.rst')) as f_in:
+                self.assertEqual(f_in.read(), 'B2')
+            self.assertEqual(sorted(os.listdir(output_dir)),
+                             [FileOpener.MANIFEST, 'a.rst', 'b.rst',
+                              'conf.py', 'extra.rst', 'index.rst'])
+
+class PipelineTests(Texi2RstTests):
+    def test_traversals(self):
+        pm = PassManager(PIPELINE)
+        self.assertLess(len(pm.traversals), len(PIPELINE))
+        pm = PassManager(PIPELINE, fuse=False)
+        self.assertEqual(len(pm.traversals), len(PIPELINE))
+
+    def test_fused_same_as_unfused(self):
+        xml_src = u'''<texinfo>
+<node name="Top"><nodename>Top</nodename></node>
+<top>
+<sectiontitle>Top</sectiontitle>
+<menu endspaces=" ">
+<menuentry leadingtext="* "><menunode separator="::  ">Invoking GCC</menunode><menudescription><pre xml:space="preserve">Command options.
+</pre></menudescription></menuentry>
+</menu>
+</top>
+<node name="Invoking-GCC"><nodename>Invoking GCC</nodename></node>
+<chapter spaces=" ">
+<sectiontitle>Invoking GCC</sectiontitle>
+<!-- c first -->
+<!-- c second -->
+<para>See <xref label="Top"><xrefnodename>Top</xrefnodename></xref>; use <option>-O2</option>, <var>file</var> or <code>x</code>.</para>
+<smallexample endspaces=" ">
+<pre xml:space="preserve">-Wall <option>-O2</option> -Wextra
+</pre></smallexample>
+<table commandarg="gcctabopt" spaces=" " endspaces=" ">
+<tableentry><tableterm><item spaces=" "><itemformat command="gcctabopt">-fdump-foo</itemformat></item>
+</tableterm><tableitem><indexcommand command="opindex" index="op" spaces=" "><indexterm index="op" number="1" incode="1">fdump-foo</indexterm></indexcommand>
+<para>Dump foo; see <option>-fbar</option>=<var>n</var>.</para>
+</tableitem></tableentry>
+<tableentry><tableterm><item spaces=" "><itemformat command="code"><var>file</var>.c</itemformat></item>
+</tableterm><tableitem><para>C source code.</para>
+</tableitem></tableentry>
+</table>
+<itemize commandarg="bullet" endspaces=" "><listitem><prepend>&bullet;</prepend><para>An item.</para></listitem></itemize>
+</chapter>
+</texinfo>'''
+        def convert(fuse):
+            doc = convert_to_rst(from_xml_string(xml_src), Context(), fuse)
+            return self.make_rst_strings(doc)
+        self.assertEqual(convert(fuse=True), convert(fuse=False))
+
+    def test_profile(self):
+        xml_src = u'''<texinfo>
+<chapter><sectiontitle>Chapter</sectiontitle><para>Text</para>
+<section><sectiontitle>Section</sectiontitle><para>Text</para></section>
+</chapter>
+</texinfo>'''
+        profiler = Profiler()
+        stage = profiler.start('from_xml_string')
+        tree = from_xml_string(xml_src)
+        profiler.finish(stage, tree)
+        # Every node is new
+        self.assertEqual(stage['mutated'], len(list(tree.iter_depth_first())))
+        tree = convert_to_rst(tree, self.ctxt, fuse=False, profiler=profiler)
+        names = [stage['name'] for stage in profiler.stages]
+        self.assertEqual(names,
+                         ['from_xml_string'] + [pass_.name
+                                                for pass_ in PIPELINE])
+        stages = dict((stage['name'], stage) for stage in profiler.stages)
+        # split only sets the rst_kind of the chapter and section
+        self.assertEqual(stages['split']['mutated'], 2)
+        self.assertIsNone(stages['move_nodes']['visited'])
+        self.assertGreater(stages['fixup_titles']['visited'], 0)
+
+        opener = CapturingOpener()
+        w = ProfilingRstWriter(io.StringIO(), opener, profiler, 'gcc')
+        w.visit(tree)
+        w.flush()
+        w.finish_profile()
+        names = [stage['name'] for stage in profiler.stages]
+        self.assertEqual(names[-3:], ['write gcc.rst', 'write chapter.rst',
+                                      'write section.rst'])
+        # Each node is visited while writing exactly one of the files
+        self.assertEqual(sum(stage['visited']
+                             for stage in profiler.stages[-3:]),
+                         len(list(tree.iter_depth_first())))
+        out = io.StringIO()
+        profiler.write_table(out)
+        self.assertIn('write section.rst', out.getvalue())
+        out = io.StringIO()
+        profiler.write_json(out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(len(report['stages']), len(profiler.stages))
+
 class TestIter(Texi2RstTests):
     def test_traversal(self):
         xml_src = u'''<A>
@@ -1100,6 +1557,26 @@ Operand  masm=att  masm=intel
 ''',
             out)
 
+    def test_multitable_renders_entries_once(self):
+        xml_src = u'''<multitable spaces=" " endspaces=" ">
+<thead><row><entry command="headitem"><para>A</para></entry><entry command="tab"><para>B</para></entry></row></thead>
+<tbody><row><entry command="item"><para>a</para></entry><entry command="tab"><para>b</para></entry></row>
+<row><entry command="item"><para>c</para></entry><entry command="tab"><para>d</para></entry></row></tbody></multitable>'''
+        tree = from_xml_string(xml_src)
+        tree = convert_to_rst(tree, self.ctxt)
+        rendered = []
+        class CountingTableLayout(TableLayout):
+            def _render_entry(self, entry):
+                rendered.append(entry)
+                return TableLayout._render_entry(self, entry)
+        table = tree.first_element_named('multitable')
+        w = RstWriter(io.StringIO())
+        CountingTableLayout(table, False).render(w)
+        w.finish()
+        self.assertEqual(w.f_out.getvalue(), self.make_rst_string(tree))
+        self.assertEqual(len(rendered), 6)
+        self.assertEqual(len(set(rendered)), 6)
+
     def test_multitable_without_header(self):
         xml_src = u'''<multitable spaces=" " endspaces=" ">
         <columnfractions line=" .25 .75">
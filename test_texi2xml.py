@@ -2,6 +2,9 @@
 
 from texi2xml import *
 
+import contextlib
+import io
+import tempfile
 import unittest
 
 class Texi2XmlTests(unittest.TestCase):
@@ -22,6 +25,114 @@ class Texi2XmlTests(unittest.TestCase):
         self.assertMultiLineEqual(expectedxmlstr, xmlstr)
 
 
+class TokenizerTests(unittest.TestCase):
+    def test_tokenize(self):
+        p = Parser('', [])
+        self.assertEqual(list(p._tokenize('')), [])
+        self.assertEqual(list(p._tokenize('text')), ['text'])
+        self.assertEqual(list(p._tokenize('@code{x}, @@ and @{\n\nend')),
+                         ['@', 'code', '{', 'x', '}', ', ', '@', '@',
+                          ' and ', '@', '{', '\n', '\n', 'end'])
+        self.assertEqual(list(p._tokenize('\n@}caf\u00e9 \t')),
+                         ['\n', '@', '}', 'caf\u00e9 \t'])
+
+    def test_token_stream(self):
+        tokens = TokenStream()
+        ended = []
+        tokens.push(['a', 'b', 'c'], lambda: ended.append('abc'))
+        self.assertEqual(tokens.consume(), 'a')
+        tokens.push(['x'])
+        tokens.push(['y', 'z'], lambda: ended.append('yz'))
+        self.assertEqual(tokens.lookahead(), ['y', 'z', 'x'])
+        self.assertEqual(tokens.peek(3), 'b')
+        self.assertEqual(tokens.peek(5), None)
+        self.assertEqual([tokens.consume() for _ in range(5)],
+                         ['y', 'z', 'x', 'b', 'c'])
+        self.assertEqual(ended, ['yz'])
+        self.assertEqual(tokens.consume(), None)
+        self.assertEqual(ended, ['yz', 'abc'])
+        self.assertEqual(tokens.lookahead(), [None, None, None])
+
+    def test_nested_includes(self):
+        with tempfile.TemporaryDirectory() as path:
+            def write(name, content):
+                with open(os.path.join(path, name), 'w') as f_out:
+                    f_out.write(content)
+            write('a.texi', 'A1\n@include b.texi\nA2 @code{a}\n')
+            write('b.texi', 'B1\n@include c.texi\n@include c.texi\nB2\n')
+            write('c.texi', '@c comment\nC @var{c}\n')
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                tree = Parser(path, [], verbose=True).parse_file(
+                    os.path.join(path, 'a.texi'))
+            self.assertEqual(out.getvalue().replace(path, ''),
+                             "opening '/b.texi' (for 'b.texi')\n"
+                             "opening '/c.texi' (for 'c.texi')\n"
+                             "end of '/c.texi' (for 'c.texi')\n"
+                             "opening '/c.texi' (for 'c.texi')\n"
+                             "end of '/c.texi' (for 'c.texi')\n"
+                             "end of '/b.texi' (for 'b.texi')\n")
+        expected = Parser('', []).parse_str('A1\nB1\n@c comment\nC @var{c}\n'
+                                            '@c comment\nC @var{c}\nB2\n'
+                                            'A2 @code{a}\n')
+        self.assertEqual(tree.toxml(), expected.toxml())
+
+    def test_include_cache(self):
+        cache = IncludeCache()
+        with tempfile.TemporaryDirectory() as path:
+            include_path = os.path.join(path, 'include')
+            os.mkdir(include_path)
+            def write(name, content):
+                with open(os.path.join(path, name), 'w') as f_out:
+                    f_out.write(content)
+            def parse():
+                p = Parser(path, [include_path], include_cache=cache)
+                return p.parse_str('@include fdl.texi\n').toxml()
+            write('include/fdl.texi', 'FDL\n')
+            self.assertEqual(parse(), '<texinfo><para>FDL\n</para>\n</texinfo>')
+            tokens = cache.files[os.path.join(include_path, 'fdl.texi')][2]
+            self.assertEqual(parse(), '<texinfo><para>FDL\n</para>\n</texinfo>')
+            self.assertIs(
+                cache.files[os.path.join(include_path, 'fdl.texi')][2],
+                tokens)
+            # Changing the file invalidates its tokens
+            write('include/fdl.texi', 'GFDL\n')
+            self.assertEqual(parse(), '<texinfo><para>GFDL\n</para>\n</texinfo>')
+            # As does removing it
+            os.remove(os.path.join(include_path, 'fdl.texi'))
+            write('fdl.texi', 'Local FDL\n')
+            self.assertEqual(parse(),
+                             '<texinfo><para>Local FDL\n</para>\n</texinfo>')
+
+class DispatchTests(unittest.TestCase):
+    def test_new_commands(self):
+        # Support for more commands can be added by defining methods
+        class SubsectionParser(Parser):
+            full_line_commands = FULL_LINE_COMMANDS | {'subsection'}
+
+            def _command_subsection(self, name, line):
+                subsection = self.stack_top.add_element(name)
+                add_stripped_text(subsection, line)
+
+            def _inline_kbd(self, command, inner):
+                self.stack_top.add_element('kbd').add_text(inner.upper())
+
+        p = SubsectionParser('', [])
+        tree = p.parse_str('@subsection Foo\nPress @kbd{x}\n')
+        self.assertEqual(tree.toxml(),
+                         '<texinfo><subsection spaces=" ">Foo</subsection>'
+                         '<para>Press <kbd>X</kbd>\n</para>\n'
+                         '</texinfo>')
+        # The dispatch tables only hold the commands with methods
+        self.assertIs(p._dispatch_inline['kbd'].__func__,
+                      SubsectionParser._inline_kbd)
+        self.assertNotIn('code', p._dispatch_inline)
+        # The base class handles neither
+        tree = Parser('', []).parse_str('@subsection Foo\nPress @kbd{x}\n')
+        self.assertEqual(tree.toxml(),
+                         '<texinfo><subsection></subsection><para> Foo\n'
+                         'Press <kbd>x</kbd>\n</para>\n</texinfo>')
+
 class CommentTests(Texi2XmlTests):
     def test_comment(self):
         self.assert_xml_conversion(
@@ -568,6 +679,23 @@ ISO C and ISO C++, e.g.&noeos; request for implicit conversion from
 </para>
 </texinfo>''')
 
+    def test_entities(self):
+        p = Parser('', [])
+        para = Element('para')
+        p._insert_text_with_entities(para, "'''@@@{@@{---`` a--b")
+        self.assertEqual([(type(child).__name__,
+                           getattr(child, 'data', getattr(child, 'name', None)))
+                          for child in para.children],
+                         [('Entity', 'textrdquo'),
+                          ('Entity', 'textrsquo'),
+                          ('Entity', 'arobase'),
+                          ('Entity', 'lbrace'),
+                          ('Entity', 'arobase'),
+                          ('Text', '{'),
+                          ('Entity', 'textmdash'),
+                          ('Entity', 'textldquo'),
+                          ('Text', ' a--b')])
+
 
 class NodeTests(Texi2XmlTests):
     def test_four_args(self):
@@ -2,13 +2,22 @@
 
 from collections import OrderedDict
 import argparse
+import concurrent.futures
+import contextlib
+import gc
+import hashlib
 import io
+import json
 import os
+import pickle
 import re
 import sys
-import xml.dom.minidom
+import time
+import tracemalloc
+import xml.parsers.expat
 
-from node import Node, Element, Comment, Text, Visitor, NoopVisitor
+from node import Node, Element, Comment, Text, Visitor, NoopVisitor, \
+    FusedVisitor, ChildCursor
 
 """
 gcc.xml created from a gcc build/gcc tree using:
@@ -21,162 +30,380 @@ TODO:
 
 args = None
 
-# Convert from XML nodes to our easier-to-work-with data structure
+# Replacement text for the texinfo entities, e.g. "&lbrace;".
+# FIXME: use correct unicode chars for the results
+ENTITIES = OrderedDict([
+    ('arobase', '@'),
+    ('bullet', '*'),
+    ('copyright', '(C)'),
+    ('dots', '...'),
+    ('enddots', '…'),
+    ('eosperiod', '.'),
+    ('comma', ','),
+    ('equiv', '=='),
+    ('lbrace', '{'),
+    ('linebreak', '\n'),
+    ('rbrace', '}'),
+    ('slashbreak', '/'),
+    ('minus', '-'),
+    ('nbsp', ' '),
+    ('noeos', ''),
+    ('tex', 'Tex'),
+    ('textmdash', '-'),
+    ('textndash', '-'),
+    ('textldquo', "'"),
+    ('textrdquo', "'"),
+    ('textlsquo', "'"),
+    ('textrsquo', "'"),
+    ('eosquest', '?'),
+    ('expansion', '→'),
+    ('result', '⇒'),
+    ('errorglyph', 'error'),
+])
+
+BUILTIN_XML_ENTITIES = ('quot', 'amp', 'apos', 'lt', 'gt')
+
+def make_entity_declarations(entities):
+    """
+    Generate DTD text declaring each of the given entities.
+    """
+    def escape(value):
+        return ''.join('&#%i;' % ord(ch) if ch in '&%"<' else ch
+                       for ch in value)
+    return ''.join('<!ENTITY %s "%s">\n' % (name, escape(value))
+                   for name, value in entities.items())
 
-def convert_attrs_from_xml(namednodemap):
-    result = OrderedDict()
-    if namednodemap:
-        for i in range(namednodemap.length):
-            attr = namednodemap.item(i)
-            result[attr.name] = attr.value
-    return result
+# Build our easier-to-work-with data structure directly from the
+# expat events for the XML, without going through a DOM
 
-def convert_from_xml(xmlnode):
-    kind = xmlnode.nodeType
-    if kind == xmlnode.ELEMENT_NODE:
-        new_node = Element(xmlnode.tagName,
-                           convert_attrs_from_xml(xmlnode.attributes))
-    elif kind == xmlnode.ATTRIBUTE_NODE:
-        pass
-    elif kind == xmlnode.TEXT_NODE:
-        new_node = Text(xmlnode.data)
-    elif kind == xmlnode.CDATA_SECTION_NODE:
-        return None
-    elif kind == xmlnode.ENTITY_NODE:
-        # FIXME: xml.dom.minidom appears to be discarding entities,
-        # which is a problem since the texinfo xml contains numerous
-        # &lbrace; and &brace; in code examples
-        raise ValueError()
-    elif kind == xmlnode.PROCESSING_INSTRUCTION_NODE:
-        raise ValueError()
-    elif kind == xmlnode.COMMENT_NODE:
-        new_node = Comment(xmlnode.data)
-    elif kind == xmlnode.DOCUMENT_NODE:
-        new_node = Element('document',
-                           convert_attrs_from_xml(xmlnode.attributes))
-    elif kind == xmlnode.DOCUMENT_TYPE_NODE:
-        return None
-    elif kind == xmlnode.NOTATION_NODE:
-        raise ValueError()
-
-    if xmlnode.hasChildNodes():
-        for child_xmlnode in xmlnode.childNodes:
-            child = convert_from_xml(child_xmlnode)
-            if child:
-                new_node.children.append(child)
-    return new_node
-
-def from_xml_string(xml_src):
-    # Hack: not sure how to correctly handle entities using
-    # xml.dom.minidom (if it is indeed possible), so do a textual
-    # substitution first:
-    # FIXME: use correct unicode chars for the results
-    xml_src = xml_src.replace('&arobase;', "@")
-    xml_src = xml_src.replace('&bullet;', '*')
-    xml_src = xml_src.replace('&copyright;', "(C)")
-    xml_src = xml_src.replace('&dots;', '...')
-    xml_src = xml_src.replace('&enddots;', '…')
-    xml_src = xml_src.replace('&eosperiod;', '.')
-    xml_src = xml_src.replace('&comma;', ',')
-    xml_src = xml_src.replace('&equiv;', '==')
-    xml_src = xml_src.replace('&lbrace;', '{')
-    xml_src = xml_src.replace('&linebreak;', "\n")
-    xml_src = xml_src.replace('&rbrace;', '}')
-    xml_src = xml_src.replace('&slashbreak;', "/")
-    xml_src = xml_src.replace('&minus;', '-')
-    xml_src = xml_src.replace('&nbsp;', ' ')
-    xml_src = xml_src.replace('&noeos;', '')
-    xml_src = xml_src.replace('&tex;', 'Tex')
-    xml_src = xml_src.replace('&textmdash;', '-')
-    xml_src = xml_src.replace('&textndash;', '-')
-    xml_src = xml_src.replace('&textldquo;', "'")
-    xml_src = xml_src.replace('&textrdquo;', "'")
-    xml_src = xml_src.replace('&textlsquo;', "'")
-    xml_src = xml_src.replace('&textrsquo;', "'")
-    xml_src = xml_src.replace('&eosquest;', "?")
-    xml_src = xml_src.replace('&expansion;', '→')
-    xml_src = xml_src.replace('&result;', '⇒')
-    xml_src = xml_src.replace('&errorglyph;', 'error')
-
-    # Complain about any entities still present
-    for m in re.finditer('(&[a-z]+;)', xml_src):
-        BUILTIN_XML_ENTITIES = ('&quot;', '&amp;', '&apos;', '&lt;', '&gt;')
-        if m.group(1) not in BUILTIN_XML_ENTITIES:
-            raise ValueError('Unhandled entity: %r' % m.group(1))
-
-    dom = xml.dom.minidom.parseString(xml_src)
-    tree = convert_from_xml(dom)
+class TreeBuilder:
+    """
+    Build a tree of Node instances from a stream of expat events.
+
+    The result is an Element('document') wrapping the root element
+    (and any comments outside of it), as per the old DOM-based
+    conversion.
+
+    Entities are resolved by expat itself: we don't load the texinfo
+    DTD, but instead supply declarations for the entries in "entities"
+    as the document's external subset.  References to any other
+    entity are reported to skipped_entity, which rejects them.
+    """
+    def __init__(self, entities=ENTITIES):
+        self.document = Element('document')
+        self.stack = [self.document]
+        self.entities = entities
+        self.entity_pattern = re.compile('&([a-zA-Z]+);')
+
+    def parse(self, xml_src):
+        parser = self._make_parser()
+        parser.Parse(xml_src, True)
+        return self.document
+
+    def _make_parser(self):
+        parser = xml.parsers.expat.ParserCreate()
+        parser.ordered_attributes = True
+        parser.buffer_text = True
+        parser.UseForeignDTD(True)
+        parser.SetParamEntityParsing(
+            xml.parsers.expat.XML_PARAM_ENTITY_PARSING_UNLESS_STANDALONE)
+        parser.ExternalEntityRefHandler = self.external_entity_ref
+        parser.SkippedEntityHandler = self.skipped_entity
+        parser.StartElementHandler = self.start_element
+        parser.EndElementHandler = self.end_element
+        parser.CharacterDataHandler = self.character_data
+        parser.CommentHandler = self.comment
+        parser.ProcessingInstructionHandler = self.processing_instruction
+        self.parser = parser
+        return parser
+
+    def external_entity_ref(self, context, base, system_id, public_id):
+        # Called for the DTD (whether or not the document has a
+        # DOCTYPE); supply our own entity declarations instead.
+        dtd_parser = self.parser.ExternalEntityParserCreate(context)
+        dtd_parser.Parse(make_entity_declarations(self.entities), True)
+        return 1
+
+    def skipped_entity(self, name, is_parameter_entity):
+        raise ValueError('Unhandled entity: %r' % ('&%s;' % name))
+
+    def start_element(self, name, attrs):
+        if attrs:
+            attrs = zip(attrs[0::2], attrs[1::2])
+        element = Element(name, attrs)
+        self.stack[-1].children.append(element)
+        self.stack.append(element)
+
+    def end_element(self, name):
+        self.stack.pop()
+
+    def character_data(self, data):
+        # Consecutive runs of character data are merged into one Text
+        self.stack[-1].add_text(data)
+
+    def comment(self, data):
+        # expat doesn't expand entities within comments
+        if '&' in data:
+            data = self.entity_pattern.sub(self._expand_entity, data)
+        self.stack[-1].add_comment(data)
+
+    def _expand_entity(self, m):
+        name = m.group(1)
+        if name in self.entities:
+            return self.entities[name]
+        if name in BUILTIN_XML_ENTITIES:
+            return m.group(0)
+        raise ValueError('Unhandled entity: %r' % m.group(0))
+
+    def processing_instruction(self, target, data):
+        raise ValueError('unhandled processing instruction: %r' % target)
+
+class UnitTreeBuilder(TreeBuilder):
+    """
+    Variant of TreeBuilder for incrementally parsing a file.
+
+    Each time a sectioning element directly below the root element is
+    closed, the children of the root so far (the sectioning element,
+    plus whatever preceded it, such as its <node>) are detached as a
+    "unit", so that they can be converted and freed before the rest of
+    the document is parsed.
+    """
+    UNIT_KINDS = ('top', 'chapter', 'section', 'unnumbered', 'appendix')
+
+    def __init__(self, entities=ENTITIES):
+        TreeBuilder.__init__(self, entities)
+        self.units = []
+
+    def end_element(self, name):
+        element = self.stack.pop()
+        if len(self.stack) == 2 and element.kind in self.UNIT_KINDS:
+            root = self.stack[1]
+            self.units.append((root, root.children))
+            root.children = []
+
+    def iter_units(self, f_in, chunk_size=65536):
+        """
+        Parse the XML from f_in, yielding (root, children) pairs, where
+        "children" is a list of nodes that were directly below "root"
+        (the <texinfo> element), with the final pair holding whatever
+        followed the last unit.
+        """
+        parser = self._make_parser()
+        while True:
+            data = f_in.read(chunk_size)
+            parser.Parse(data, not data)
+            for root, children in self.units:
+                yield root, children
+            self.units = []
+            if not data:
+                break
+        for root in self.document.children:
+            if isinstance(root, Element):
+                yield root, root.children
+                root.children = []
+
+def from_xml_string(xml_src, extra_entities=None):
+    """
+    Parse makeinfo's XML output into a Node tree.
+
+    "extra_entities" can supply a dict of additional (or overridden)
+    entity replacements, for manuals using entities not in ENTITIES.
+    """
+    entities = ENTITIES
+    if extra_entities:
+        entities = OrderedDict(ENTITIES)
+        entities.update(extra_entities)
+    tree = TreeBuilder(entities).parse(xml_src)
     tree = fixup_whitespace(tree)
     return tree
 
-def for_each_node_below(node):
-    if isinstance(node, Element):
-        for child in node.children:
-            yield child
-            for node in for_each_node_below(child):
-                yield node
-
-def fixup_whitespace(tree):
-    class WhitespaceFixer(NoopVisitor):
+class TreeCache:
+    """
+    An on-disk cache of the trees built by from_xml_string, so that
+    repeated conversions of the same XML can skip parsing it.
+
+    Trees are pickled, keyed by a hash of the XML and of the source of
+    the converter (so that changes to the parser invalidate them).
+    Once the files in "cache_dir" take up more than "max_size" bytes,
+    the least recently used are removed.  If "verbose", entries which
+    can't be loaded are reported on stderr as they are discarded.
+    """
+    def __init__(self, cache_dir, max_size=1024 * 1024 * 1024,
+                 verbose=False):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.verbose = verbose
+
+    @staticmethod
+    def get_default_dir():
+        cache_home = os.environ.get('XDG_CACHE_HOME',
+                                    os.path.expanduser('~/.cache'))
+        return os.path.join(cache_home, 'texi2rst')
+
+    def get_key(self, xml_src, extra_entities=None):
+        h = hashlib.sha256()
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        for filename in ('node.py', 'texi2rst.py'):
+            with open(os.path.join(base_dir, filename), 'rb') as f_in:
+                h.update(f_in.read())
+        h.update(repr(sorted((extra_entities or {}).items())).encode('utf-8'))
+        h.update(xml_src.encode('utf-8'))
+        return h.hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, '%s.pickle' % key)
+
+    def load(self, key):
         """
-        Strip redundant Text nodes
+        Get the cached tree for "key", or None.
         """
-        def previsit_element(self, element):
-            if element.kind == 'pre':
-                return
+        path = self.get_path(key)
+        # Unpickling creates millions of objects, none of them garbage,
+        # so don't let them trigger the cycle collector
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            with open(path, 'rb') as f_in:
+                tree = pickle.load(f_in)
+        except FileNotFoundError:
+            return None
+        except (pickle.UnpicklingError, EOFError, AttributeError,
+                ImportError) as e:
+            # e.g. a truncated file, or one referring to a class which has
+            # since been renamed; drop it (unless another process already
+            # has)
+            if self.verbose:
+                print('discarding cache entry %s: %r' % (path, e),
+                      file=sys.stderr)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return None
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+        # Mark the entry as recently used (another process may have
+        # evicted it since, in which case the tree is still fine)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return tree
 
-            if element.kind == 'para':
-                # Strip trailing whitespace within <para>
-                text = element.get_sole_text()
-                if text:
-                    text.data = text.data.rstrip()
-                return
+    def store(self, key, tree):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.get_path(key)
+        tmp_path = '%s.%i.tmp' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f_out:
+                pickle.dump(tree, f_out, pickle.HIGHEST_PROTOCOL)
+        except RecursionError:
+            # Too deeply nested to pickle; don't cache it
+            os.remove(tmp_path)
+            return
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.pickle'):
+                try:
+                    st = os.stat(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    # (removed by another process)
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        # Remove the least recently used first
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+def from_xml_string_cached(xml_src, cache, extra_entities=None):
+    """
+    Equivalent to from_xml_string, but using the given TreeCache.
+    """
+    key = cache.get_key(xml_src, extra_entities)
+    tree = cache.load(key)
+    if tree is None:
+        tree = from_xml_string(xml_src, extra_entities)
+        cache.store(key, tree)
+    return tree
 
-            # Within other kinds of element, fully strip
-            # pure-whitespace text nodes.
-            new_children = []
-            for child in element.children:
-                if isinstance(child, Text):
-                    if child.data.isspace():
-                        continue
-                new_children.append(child)
-            element.children = new_children
+def for_each_node_below(node):
+    nodes = node.iter_depth_first()
+    next(nodes)
+    return nodes
 
-        def visit_comment(self, comment):
-            comment.data = comment.data.rstrip()
+class WhitespaceFixer(NoopVisitor):
+    """
+    Strip redundant Text nodes
+    """
+    def previsit_element(self, element):
+        if element.kind == 'pre':
+            return
 
+        if element.kind == 'para':
+            # Strip trailing whitespace within <para>
+            text = element.get_sole_text()
+            if text:
+                text.data = text.data.rstrip()
+            return
+
+        # Within other kinds of element, fully strip
+        # pure-whitespace text nodes.
+        new_children = []
+        for child in element.children:
+            if isinstance(child, Text):
+                if child.data.isspace():
+                    continue
+            new_children.append(child)
+        element.children = new_children
+
+    def visit_comment(self, comment):
+        comment.data = comment.data.rstrip()
+
+def fixup_whitespace(tree):
     v = WhitespaceFixer()
     v.visit(tree)
     return tree
 
 # Conversion pipeline
 
+class CommentConverter(NoopVisitor):
+    def visit_comment(self, comment):
+        if comment.data.startswith(' c '):
+            comment.data = comment.data[3:]
+
 def convert_comments(tree):
-    class CommentConverter(NoopVisitor):
-        def visit_comment(self, comment):
-            if comment.data.startswith(' c '):
-                comment.data = comment.data[3:]
     CommentConverter().visit(tree)
     return tree
 
-def combine_commments(tree):
-    class CommentCombiner(NoopVisitor):
-        def previsit_element(self, element):
-            # Attempt to merge
-            #   COMMENT(x) COMMENT(y)
-            # into
-            #   COMMENT(x + '\n' + y)
-            new_children = []
-            for child in element.children:
-                if isinstance(child, Comment):
-                    if len(new_children) >= 1:
-                        last = new_children[-1]
-                        if isinstance(last, Comment):
-                            last.data = last.data + '\n' + child.data
-                            continue
-                new_children.append(child)
-            element.children = new_children
+class CommentCombiner(NoopVisitor):
+    def previsit_element(self, element):
+        # Attempt to merge
+        #   COMMENT(x) COMMENT(y)
+        # into
+        #   COMMENT(x + '\n' + y)
+        new_children = []
+        for child in element.children:
+            if isinstance(child, Comment):
+                if len(new_children) >= 1:
+                    last = new_children[-1]
+                    if isinstance(last, Comment):
+                        last.data = last.data + '\n' + child.data
+                        continue
+            new_children.append(child)
+        element.children = new_children
 
+def combine_commments(tree):
     v = CommentCombiner()
     v.visit(tree)
     return tree
@@ -186,30 +413,30 @@ def fixup_comments(tree):
     tree = combine_commments(tree)
     return tree
 
-def prune(tree):
-    class Pruner(NoopVisitor):
-        def previsit_element(self, element):
-            new_children = []
-            for child in element.children:
-                if self.should_strip(child):
-                    continue
-                new_children.append(child)
-            element.children = new_children
-
-        def should_strip(self, child):
-            if not isinstance(child, Element):
-                return False
-            if child.kind in ('filename', 'preamble', 'setfilename', 'clear',
-                              'dircategory', 'direntry', 'vskip',
-                              'titlepage',
-                              'set', 'macro', 'settitle',
-                              'defcodeindex', 'syncodeindex',
-                              'paragraphindent',
-                              'nodenext', 'nodeprev', 'nodeup'):
-                return True
-            else:
-                return False
+class Pruner(NoopVisitor):
+    def previsit_element(self, element):
+        new_children = []
+        for child in element.children:
+            if self.should_strip(child):
+                continue
+            new_children.append(child)
+        element.children = new_children
+
+    def should_strip(self, child):
+        if not isinstance(child, Element):
+            return False
+        if child.kind in ('filename', 'preamble', 'setfilename', 'clear',
+                          'dircategory', 'direntry', 'vskip',
+                          'titlepage',
+                          'set', 'macro', 'settitle',
+                          'defcodeindex', 'syncodeindex',
+                          'paragraphindent',
+                          'nodenext', 'nodeprev', 'nodeup'):
+            return True
+        else:
+            return False
 
+def prune(tree):
     v = Pruner()
     v.visit(tree)
     return tree
@@ -221,6 +448,26 @@ def convert_text_to_label(data):
     data = data.lower()
     return data
 
+class MenuFixer(NoopVisitor):
+    def previsit_menu(self, element):
+        element.rst_kind = Directive('toctree', None)
+
+    def previsit_menuentry(self, element):
+        menunode = element.first_element_named('menunode')
+        menudescription = element.first_element_named('menudescription')
+        if menunode and menudescription:
+            # Prune the menuentry, giving it an explicit title.
+            element.rst_kind = ToctreeEntry()
+            element.children = menudescription.children
+            for node in for_each_node_below(element):
+                if isinstance(node, Text):
+                    if node.data.endswith('\n'):
+                        node.data = node.data[:-1]
+            # FIXME: express this cross-reference at the Node level:
+            data = menunode.get_all_text()
+            label = convert_text_to_label(data)
+            element.children += [Text(' <%s>' % label)]
+
 def fixup_menus(tree):
     """
     Given:
@@ -237,77 +484,54 @@ def fixup_menus(tree):
       * the <menuentry> elements are pruned and tagged with ToctreeEntry, to
         be rendered using the given descriptions.
     """
-    class MenuFixer(NoopVisitor):
-        def previsit_element(self, element):
-            if element.kind == 'menu':
-                element.rst_kind = Directive('toctree', None)
-
-            if element.kind == 'menuentry':
-                menunode = element.first_element_named('menunode')
-                menudescription = element.first_element_named('menudescription')
-                if menunode and menudescription:
-                    # Prune the menuentry, giving it an explicit title.
-                    element.rst_kind = ToctreeEntry()
-                    element.children = menudescription.children
-                    for node in for_each_node_below(element):
-                        if isinstance(node, Text):
-                            if node.data.endswith('\n'):
-                                node.data = node.data[:-1]
-                    # FIXME: express this cross-reference at the Node level:
-                    data = menunode.get_all_text()
-                    label = convert_text_to_label(data)
-                    element.children += [Text(' <%s>' % label)]
-
     v = MenuFixer()
     v.visit(tree)
     return tree
 
-def split(tree):
-    class Splitter(NoopVisitor):
-        def __init__(self):
-            self.split_kinds = ('chapter', 'section', )
-
-        def previsit_element(self, element):
-            if element.kind in self.split_kinds:
-                sectiontitle = element.first_element_named('sectiontitle')
-                if sectiontitle:
-                    text = sectiontitle.get_all_text()
-                    text = text.lower()
-                    for c in ' /':
-                        text = text.replace(c, '-')
-                    for c in '()?\',.:_':
-                        text = text.replace(c, '')
-                    text = text.strip('+')
-                    element.rst_kind = OutputFile(text)
-
-    class ToctreeAdder(NoopVisitor):
-        """
-        Add toctree directives referencing the split content
-        """
-        def previsit_element(self, element):
-            new_children = []
-            toctree = None
-            for child in element.children:
-                if isinstance(child, Element):
-                    if child.kind == 'toctree':
-                        toctree = child
-                    if isinstance(child.rst_kind, OutputFile):
-                        toctree_element = Element('toctree-element', {})
-                        toctree_element.rst_kind = ToctreeEntry()
-                        toctree_element.children = [Text(child.rst_kind.name)]
-                        # Try to consolidate all toctree entries into one
-                        # toctree:
-                        if toctree:
-                            toctree.children.append(toctree_element)
-                        else:
-                            toctree = Element('toctree', {})
-                            toctree.rst_kind = Directive('toctree', None)
-                            toctree.children = [toctree_element]
-                            new_children.append(toctree)
+class Splitter(NoopVisitor):
+    def previsit_chapter(self, element):
+        sectiontitle = element.first_element_named('sectiontitle')
+        if sectiontitle:
+            text = sectiontitle.get_all_text()
+            text = text.lower()
+            for c in ' /':
+                text = text.replace(c, '-')
+            for c in '()?\',.:_':
+                text = text.replace(c, '')
+            text = text.strip('+')
+            element.rst_kind = OutputFile(text)
+
+    previsit_section = previsit_chapter
+
+class ToctreeAdder(NoopVisitor):
+    """
+    Add toctree directives referencing the split content
+    """
+    def previsit_element(self, element):
+        new_children = []
+        toctree = None
+        for child in element.children:
+            if isinstance(child, Element):
+                if child.kind == 'toctree':
+                    toctree = child
+                if isinstance(child.rst_kind, OutputFile):
+                    toctree_element = Element('toctree-element', {})
+                    toctree_element.rst_kind = ToctreeEntry()
+                    toctree_element.children = [Text(child.rst_kind.name)]
+                    # Try to consolidate all toctree entries into one
+                    # toctree:
+                    if toctree:
+                        toctree.children.append(toctree_element)
+                    else:
+                        toctree = Element('toctree', {})
+                        toctree.rst_kind = Directive('toctree', None)
+                        toctree.children = [toctree_element]
+                        new_children.append(toctree)
 
-                new_children.append(child)
-            element.children = new_children
+            new_children.append(child)
+        element.children = new_children
 
+def split(tree):
     v = Splitter()
     v.visit(tree)
 
@@ -315,6 +539,79 @@ def split(tree):
     v.visit(tree)
     return tree
 
+class NodeFixer(NoopVisitor):
+    def previsit_node(self, element):
+        nodename = element.first_element_named('nodename')
+        text = nodename.get_sole_text()
+        if nodename and text:
+            element.children = []
+            label = convert_text_to_label(text.data)
+            element.rst_kind = Label(label)
+
+    def previsit_anchor(self, element):
+        text = element.get_sole_text()
+        if text:
+            element.children = []
+            label = convert_text_to_label(text.data)
+            element.rst_kind = Label(label)
+
+def move_nodes(tree, ctxt):
+    """
+    Move each <node> and <anchor> to the start of the element that
+    follows it in document order.
+
+    This is done in a single sweep over the (parent, child) pairs of the
+    tree: removing and inserting the nodes one at a time would be
+    quadratic for an element with many of them as children.  The result
+    is as if each node were removed from its parent and inserted at the
+    start of its new parent in turn.
+    """
+    if ctxt.debug:
+        for node in tree.iter_depth_first():
+            print(node)
+
+    # Gather a list of (parent, child) pairs
+    edges = list(tree.iter_depth_first_edges())
+
+    # For each pair, find the next element after the child
+    next_elements = [None] * len(edges)
+    next_element = None
+    for i in range(len(edges) - 1, -1, -1):
+        next_elements[i] = next_element
+        child = edges[i][1]
+        if isinstance(child, Element):
+            next_element = child
+
+    # Find the nodes to move
+    removed = set()
+    old_parents = []
+    new_parents = OrderedDict()
+    for i, (parent, child) in enumerate(edges):
+        if ctxt.debug:
+            print(i, parent, child)
+        if child.is_element('node') or child.is_element('anchor'):
+            next_parent = next_elements[i]
+            if next_parent:
+                if ctxt.debug:
+                    print('\nMOVING %r from %r to %r\n'
+                          % (child, parent, next_parent))
+                removed.add(child)
+                old_parents.append(parent)
+                new_parents.setdefault(next_parent, []).append(child)
+
+    # Rebuild the children of the affected elements, all based on their
+    # children before any moves
+    new_children = {}
+    for element in old_parents + list(new_parents):
+        if element not in new_children:
+            moved_in = new_parents.get(element, [])
+            new_children[element] = (moved_in[::-1]
+                                     + [child for child in element.children
+                                        if child not in removed])
+    for element, children in new_children.items():
+        element.children = children
+    return tree
+
 def fixup_nodes(tree, ctxt):
     """
     Given:
@@ -372,48 +669,6 @@ def fixup_nodes(tree, ctxt):
         <anchor>
         ...content...
     """
-    class NodeFixer(NoopVisitor):
-        def previsit_element(self, element):
-            if element.kind == 'node':
-                nodename = element.first_element_named('nodename')
-                text = nodename.get_sole_text()
-                if nodename and text:
-                    element.children = []
-                    label = convert_text_to_label(text.data)
-                    element.rst_kind = Label(label)
-
-            if element.kind == 'anchor':
-                text = element.get_sole_text()
-                if text:
-                    element.children = []
-                    label = convert_text_to_label(text.data)
-                    element.rst_kind = Label(label)
-
-    def move_nodes(tree):
-        # Gather a list of (parent, child) pairs
-        if ctxt.debug:
-            for node in tree.iter_depth_first():
-                print(node)
-
-        edges = list(tree.iter_depth_first_edges())
-        for i, (parent, child) in enumerate(edges):
-                if ctxt.debug:
-                    print(i, parent, child)
-                if child.is_element('node') or child.is_element('anchor'):
-
-                    def get_next_child_element():
-                        for cand_parent, cand_child in edges[i + 1:]:
-                            if isinstance(cand_child, Element):
-                                return cand_child
-
-                    next_parent = get_next_child_element()
-                    if next_parent:
-                        if ctxt.debug:
-                            print('\nMOVING %r from %r to %r\n'
-                                  % (child, parent, next_parent))
-                        parent.children.remove(child)
-                        next_parent.children.insert(0, child)
-
     v = NodeFixer()
     v.visit(tree)
 
@@ -421,7 +676,7 @@ def fixup_nodes(tree, ctxt):
         print
         tree.dump(sys.stdout)
         print
-    move_nodes(tree)
+    move_nodes(tree, ctxt)
     if ctxt.debug:
         print
         tree.dump(sys.stdout)
@@ -429,100 +684,263 @@ def fixup_nodes(tree, ctxt):
 
     return tree
 
-def fixup_option_refs(tree):
-    class OptionRefFixer(NoopVisitor):
-        # We'd like to handle texinfo "<option>" using sphinx's
-        # inline ":option:" markup but Sphinx requires that the option
-        # have a leading dash.
-        # Conditionally retain options (or else they will be
-        # stripped at output)
-        def previsit_element(self, element):
-            if element.kind == 'option':
-                firstchild = element.children[0]
-                if isinstance(firstchild, Text):
-                    if firstchild.data.startswith('-'):
-                        element.rst_kind = InlineMarkup('option')
+class OptionRefFixer(NoopVisitor):
+    # We'd like to handle texinfo "<option>" using sphinx's
+    # inline ":option:" markup but Sphinx requires that the option
+    # have a leading dash.
+    # Conditionally retain options (or else they will be
+    # stripped at output)
+    def previsit_option(self, element):
+        firstchild = element.children[0]
+        if isinstance(firstchild, Text):
+            if firstchild.data.startswith('-'):
+                element.rst_kind = InlineMarkup('option')
 
+def fixup_option_refs(tree):
     v = OptionRefFixer()
     v.visit(tree)
     return tree
 
-def fixup_empty_texts(tree):
-    class EmptyTextFixer(NoopVisitor):
-        # Remove all empty Text elements.
-        def previsit_element(self, element):
-            element.children = [c for c in element.children if not isinstance(c, Text) or c.data]
+class EmptyTextFixer(NoopVisitor):
+    # Remove all empty Text elements.
+    def previsit_element(self, element):
+        element.children = [c for c in element.children if not isinstance(c, Text) or c.data]
 
+def fixup_empty_texts(tree):
     v = EmptyTextFixer()
     v.visit(tree)
     return tree
 
-def fixup_element_spacing(tree):
-    class ElementSpacingFixer(NoopVisitor):
-        ALLOWED_CHARS = (' ', '\n', '.')
-        # Wrap option and var elements with a space character
-        def postvisit_element(self, element, parent):
-            if element.kind in ('option', 'var'):
-                i = parent.children.index(element)
-                if i + 1 < len(parent.children):
-                    rsibling = parent.children[i + 1]
-                    if isinstance(rsibling, Text):
-                        if not rsibling.data[0] in self.ALLOWED_CHARS:
-                            rsibling.data = ' ' + rsibling.data
-                    elif rsibling.is_element('r'):
-                        parent.children.insert(i + 1, Text(' '))
-                if i > 0:
-                    lsibling = parent.children[i - 1]
-                    if isinstance(lsibling, Text):
-                        if not lsibling.data[-1] in self.ALLOWED_CHARS:
-                            lsibling.data += ' '
-                    elif lsibling.is_element('r'):
-                        parent.children.insert(i - 1, Text(' '))
+class ElementSpacingFixer(NoopVisitor):
+    ALLOWED_CHARS = (' ', '\n', '.')
+
+    def __init__(self):
+        self.cursor = ChildCursor()
+
+    # Wrap option and var elements with a space character
+    def postvisit_option(self, element, parent):
+        i = self.cursor.index(parent, element)
+        if i + 1 < len(parent.children):
+            rsibling = parent.children[i + 1]
+            if isinstance(rsibling, Text):
+                if not rsibling.data[0] in self.ALLOWED_CHARS:
+                    rsibling.data = ' ' + rsibling.data
+            elif rsibling.is_element('r'):
+                parent.children.insert(i + 1, Text(' '))
+        if i > 0:
+            lsibling = parent.children[i - 1]
+            if isinstance(lsibling, Text):
+                if not lsibling.data[-1] in self.ALLOWED_CHARS:
+                    lsibling.data += ' '
+            elif lsibling.is_element('r'):
+                parent.children.insert(i - 1, Text(' '))
+
+    postvisit_var = postvisit_option
 
+def fixup_element_spacing(tree):
     v = ElementSpacingFixer()
     v.visit(tree)
     return tree
 
 
-def fixup_wrapped_options(tree):
-    class WrapperOptionFixer(NoopVisitor):
-        # Move out all inner elements in option nodes as siblings:
-        # <option>-foo=<var>n</var></option>.
-        def postvisit_element(self, element, parent):
-            if element.kind == 'option':
-                i = parent.children.index(element)
-                parent.children = parent.children[:i + 1] + element.children[1:] + parent.children[i + 1:]
-                element.children = element.children[:1]
+class WrapperOptionFixer(NoopVisitor):
+    # Move out all inner elements in option nodes as siblings:
+    # <option>-foo=<var>n</var></option>.
+    def __init__(self):
+        self.cursor = ChildCursor()
 
+    def postvisit_option(self, element, parent):
+        i = self.cursor.index(parent, element)
+        parent.children[i + 1:i + 1] = element.children[1:]
+        element.children = element.children[:1]
+
+def fixup_wrapped_options(tree):
     v = WrapperOptionFixer()
     v.visit(tree)
     return tree
 
-def fixup_trailing_sign_for_options(tree):
-    class TrailingSignForOptionFixer(NoopVisitor):
-        # Move trailing '=' character to sibling, otherwise options
-        # link is not generated.
-        def postvisit_element(self, element, parent):
-            if element.kind == 'option' and element.children:
-                firstchild = element.children[0]
-                if isinstance(firstchild, Text) and firstchild.data.endswith('='):
-                    firstchild.data = firstchild.data[:-1]
-                    i = parent.children.index(element)
-                    if i + 1 < len(parent.children):
-                        sibling = parent.children[i + 1]
-                        if isinstance(sibling, Text):
-                            sibling.data = ' =' + sibling.data
-                        else:
-                            sibling.prepend_text('=')
-                            return
+class TrailingSignForOptionFixer(NoopVisitor):
+    # Move trailing '=' character to sibling, otherwise options
+    # link is not generated.
+    def __init__(self):
+        self.cursor = ChildCursor()
+
+    def postvisit_option(self, element, parent):
+        if element.children:
+            firstchild = element.children[0]
+            if isinstance(firstchild, Text) and firstchild.data.endswith('='):
+                firstchild.data = firstchild.data[:-1]
+                i = self.cursor.index(parent, element)
+                if i + 1 < len(parent.children):
+                    sibling = parent.children[i + 1]
+                    if isinstance(sibling, Text):
+                        sibling.data = ' =' + sibling.data
                     else:
-                        element.children.add(Text('='))
+                        sibling.prepend_text('=')
+                        return
+                else:
+                    element.add_text('=')
 
+def fixup_trailing_sign_for_options(tree):
     v = TrailingSignForOptionFixer()
     v.visit(tree)
     return tree
 
 
+class TableEntryFixer(NoopVisitor):
+    def previsit_element(self, element):
+        # Convert:
+        #   <itemformat command="COMMAND">TEXT</itemformat>
+        # into:
+        #   <COMMAND>TEXT</command>
+        # which will typically be later converted to an
+        # appropriate markup form.
+        if element.kind == 'itemformat':
+            if 'command' in element.attrs:
+                command = element.attrs['command']
+                # Typically we can't nest inline markup, but
+                # Sphinx's "samp" supports this syntax:
+                #   :samp:`print 1+{variable}`
+                # (http://sphinx-doc.org/markup/inline.html#role-samp)
+                # which we can use to fake it to one level
+                # of nesting.  Hence given e.g.
+                #   <itemformat command="code">-misel=<var>yes/no</var></itemformat>
+                # we can turn it into:
+                #   <itemformat><samp>-misel={yes/no}</samp></itemformat>
+                if len(element.children) > 1:
+                    max_child_len = 0
+                    for child in element.children:
+                        if isinstance(child, Element):
+                            if len(child.children) > max_child_len:
+                                max_child_len = len(child.children)
+                    if max_child_len == 1:
+                        if 0:
+                            old_xml = element.toxml()
+                        element.kind = 'samp'
+                        new_text = ''
+                        for child in element.children:
+                            if isinstance(child, Element):
+                                new_text += '{%s}' % child.get_all_text()
+                            elif isinstance(child, Text):
+                                new_text += child.data
+                        element.children = [Text(new_text)]
+                        if 0:
+                            print('flattened %s to %s'
+                                  % (old_xml, element.toxml()))
+                    else:
+                        if 0:
+                            print('itemformat was too complex to flatten: %s'
+                                  % element.toxml())
+                else:
+                    element.kind = command
+                    text = element.get_all_text().rstrip()
+                    element.children = [Text(text)]
+                return
+
+        if element.kind == 'tableentry':
+            tableterm = element.first_element_named('tableterm')
+            tableitem = element.first_element_named('tableitem')
+            if tableterm and tableitem:
+                item = tableterm.first_element_named('item')
+                if item:
+                    itemformat = item.first_element_named('itemformat')
+                    if itemformat:
+                        # Detect:
+                        #   <itemformat>
+                        #     TEXT
+                        #     <r>TEXT</r>
+                        #   </itemformat>
+                        # and move the <r>TEXT</r> to be a ".. note::"
+                        # within the <tableitem>
+                        if len(itemformat.children) == 2:
+                            if itemformat.children[1].is_element('r'):
+                                r = itemformat.children[1]
+                                itemformat.children = \
+                                    itemformat.children[:-1]
+                                note = Element('note', {})
+                                note.rst_kind = Directive('note', None)
+                                note.children = [r]
+
+                                tableitem.children = \
+                                    [note] + tableitem.children
+
+                        if self.convert_to_option(element, tableitem,
+                                                  itemformat):
+                            return
+                        else:
+                            self.convert_to_definition_list(tableterm,
+                                                            tableitem)
+
+    def convert_to_option(self, tableentry, tableitem,
+                          itemformat):
+        text = itemformat.get_all_text()
+        if text:
+            options = [text]
+        else:
+            options = []
+
+        # This might be a description of an option.
+        # Scan below <tableitem> looking for <indexcommand>,
+        # gathering options, and preparing a list of children
+        # with the <indexcommand> instances purged.
+        new_children = []
+        found_indexcommand = False
+        for child in tableitem.children:
+            if isinstance(child, Element):
+                if child.kind == 'indexcommand':
+                    found_indexcommand = True
+                    indexterm = child.first_element_named('indexterm')
+                    if indexterm:
+                        text = indexterm.get_sole_text()
+                        if text:
+                            option = text.data
+                            if not option.startswith('-'):
+                                option = '-' + option
+                            if option not in options:
+                                options.append(option)
+                            # Drop this <indexcommand>
+                            continue
+            new_children.append(child)
+
+        # If the initial option (from "text") is of the form
+        # "-option=value", then don't add all the extra options
+        # from the <indexcommand>.
+        if len(options) > 1:
+            if '=' in options[0]:
+                options = [options[0]]
+
+        if found_indexcommand:
+            # Then it is a description of an option, mark it as such,
+            # using all the option names found, and purge the
+            # <indexcommand> instances:
+            tableentry.kind = 'option'
+            tableentry.rst_kind = Directive('option',
+                                            ', '.join(options))
+            tableentry.children = new_children
+            return True
+
+        # Otherwise, if it's all uppercase/underscores, make it
+        # an "envvar" directive.
+        if text and len(text) > 3 and re.match('^[A-Z][_A-Z]+$', text):
+            tableentry.rst_kind = Directive('envvar', text)
+            tableentry.children = new_children
+            # The "envvar" directive will add it to the index; strip
+            # any <findex> element below <tableitem>.
+            tableentry.delete_children_named('findex')
+            return True
+
+    def convert_to_definition_list(self, tableterm, tableitem):
+        tableterm.rst_kind = DefinitionListHeader()
+        tableitem.rst_kind = DefinitionListBody()
+
+        # Add whitespace before <itemx> items
+        new_children = []
+        for child in tableterm.children:
+            if child.is_element('itemx'):
+                new_children.append(Text(' '))
+            new_children.append(child)
+        tableterm.children = new_children
+
 def fixup_table_entry(tree):
     """
     Fixup <tableentry> elements.
@@ -568,164 +986,20 @@ def fixup_table_entry(tree):
 
     Transform this to a definition list.
     """
-    class TableEntryFixer(NoopVisitor):
-        def previsit_element(self, element):
-            # Convert:
-            #   <itemformat command="COMMAND">TEXT</itemformat>
-            # into:
-            #   <COMMAND>TEXT</command>
-            # which will typically be later converted to an
-            # appropriate markup form.
-            if element.kind == 'itemformat':
-                if 'command' in element.attrs:
-                    command = element.attrs['command']
-                    # Typically we can't nest inline markup, but
-                    # Sphinx's "samp" supports this syntax:
-                    #   :samp:`print 1+{variable}`
-                    # (http://sphinx-doc.org/markup/inline.html#role-samp)
-                    # which we can use to fake it to one level
-                    # of nesting.  Hence given e.g.
-                    #   <itemformat command="code">-misel=<var>yes/no</var></itemformat>
-                    # we can turn it into:
-                    #   <itemformat><samp>-misel={yes/no}</samp></itemformat>
-                    if len(element.children) > 1:
-                        max_child_len = 0
-                        for child in element.children:
-                            if isinstance(child, Element):
-                                if len(child.children) > max_child_len:
-                                    max_child_len = len(child.children)
-                        if max_child_len == 1:
-                            if 0:
-                                old_xml = element.toxml()
-                            element.kind = 'samp'
-                            new_text = ''
-                            for child in element.children:
-                                if isinstance(child, Element):
-                                    new_text += '{%s}' % child.get_all_text()
-                                elif isinstance(child, Text):
-                                    new_text += child.data
-                            element.children = [Text(new_text)]
-                            if 0:
-                                print('flattened %s to %s'
-                                      % (old_xml, element.toxml()))
-                        else:
-                            if 0:
-                                print('itemformat was too complex to flatten: %s'
-                                      % element.toxml())
-                    else:
-                        element.kind = command
-                        text = element.get_all_text().rstrip()
-                        element.children = [Text(text)]
-                    return
-
-            if element.kind == 'tableentry':
-                tableterm = element.first_element_named('tableterm')
-                tableitem = element.first_element_named('tableitem')
-                if tableterm and tableitem:
-                    item = tableterm.first_element_named('item')
-                    if item:
-                        itemformat = item.first_element_named('itemformat')
-                        if itemformat:
-                            # Detect:
-                            #   <itemformat>
-                            #     TEXT
-                            #     <r>TEXT</r>
-                            #   </itemformat>
-                            # and move the <r>TEXT</r> to be a ".. note::"
-                            # within the <tableitem>
-                            if len(itemformat.children) == 2:
-                                if itemformat.children[1].is_element('r'):
-                                    r = itemformat.children[1]
-                                    itemformat.children = \
-                                        itemformat.children[:-1]
-                                    note = Element('note', {})
-                                    note.rst_kind = Directive('note', None)
-                                    note.children = [r]
-
-                                    tableitem.children = \
-                                        [note] + tableitem.children
-
-                            if self.convert_to_option(element, tableitem,
-                                                      itemformat):
-                                return
-                            else:
-                                self.convert_to_definition_list(tableterm,
-                                                                tableitem)
-
-        def convert_to_option(self, tableentry, tableitem,
-                              itemformat):
-            text = itemformat.get_all_text()
-            if text:
-                options = [text]
-            else:
-                options = []
-
-            # This might be a description of an option.
-            # Scan below <tableitem> looking for <indexcommand>,
-            # gathering options, and preparing a list of children
-            # with the <indexcommand> instances purged.
-            new_children = []
-            found_indexcommand = False
-            for child in tableitem.children:
-                if isinstance(child, Element):
-                    if child.kind == 'indexcommand':
-                        found_indexcommand = True
-                        indexterm = child.first_element_named('indexterm')
-                        if indexterm:
-                            text = indexterm.get_sole_text()
-                            if text:
-                                option = text.data
-                                if not option.startswith('-'):
-                                    option = '-' + option
-                                if option not in options:
-                                    options.append(option)
-                                # Drop this <indexcommand>
-                                continue
-                new_children.append(child)
-
-            # If the initial option (from "text") is of the form
-            # "-option=value", then don't add all the extra options
-            # from the <indexcommand>.
-            if len(options) > 1:
-                if '=' in options[0]:
-                    options = [options[0]]
-
-            if found_indexcommand:
-                # Then it is a description of an option, mark it as such,
-                # using all the option names found, and purge the
-                # <indexcommand> instances:
-                tableentry.kind = 'option'
-                tableentry.rst_kind = Directive('option',
-                                                ', '.join(options))
-                tableentry.children = new_children
-                return True
-
-            # Otherwise, if it's all uppercase/underscores, make it
-            # an "envvar" directive.
-            if text and len(text) > 3 and re.match('^[A-Z][_A-Z]+$', text):
-                tableentry.rst_kind = Directive('envvar', text)
-                tableentry.children = new_children
-                # The "envvar" directive will add it to the index; strip
-                # any <findex> element below <tableitem>.
-                tableentry.delete_children_named('findex')
-                return True
-
-        def convert_to_definition_list(self, tableterm, tableitem):
-            tableterm.rst_kind = DefinitionListHeader()
-            tableitem.rst_kind = DefinitionListBody()
-
-            # Add whitespace before <itemx> items
-            new_children = []
-            for child in tableterm.children:
-                if child.is_element('itemx'):
-                    new_children.append(Text(' '))
-                new_children.append(child)
-            tableterm.children = new_children
-
     v = TableEntryFixer()
     v.visit(tree)
     return tree
 
+class MultitableFixer(NoopVisitor):
+    def __init__(self, ctxt):
+        self.ctxt = ctxt
+
+    def previsit_multitable(self, element):
+        element.rst_kind = Table(element, self.ctxt)
+        element.delete_children_named('columnprototypes')
+        if self.ctxt.debug:
+            element.dump(sys.stdout)
+
 def fixup_multitables(tree, ctxt):
     """
     Given:
@@ -789,22 +1063,78 @@ def fixup_multitables(tree, ctxt):
           </multitable>
     convert to a .rst table
     """
-    class MultitableFixer(NoopVisitor):
-        def previsit_element(self, element):
-            if element.kind == 'multitable':
-                element.rst_kind = Table(element, ctxt)
-            element.delete_children_named('columnprototypes')
-
-        def postvisit_element(self, element, parent):
-            if ctxt.debug:
-                if element.kind == 'multitable':
-                    element.dump(sys.stdout)
-
-    v = MultitableFixer()
+    v = MultitableFixer(ctxt)
     v.visit(tree)
     return tree
 
-def fixup_examples(tree):
+class ExampleFixer(NoopVisitor):
+    def __init__(self, ctxt=None):
+        self.default_lang_stack = [args.default_language if args else 'c++']
+        self.default_languages = ctxt.default_languages if ctxt else {}
+
+    def previsit_element(self, element):
+        if element in self.default_languages:
+            self.default_lang_stack.append(self.default_languages[element])
+
+        if element.kind in ('example', 'smallexample'):
+            example = element
+            # There could be a "group" holding the "pre"
+            group = element.first_element_named('group')
+            if group:
+                element = group
+            pre = element.first_element_named('pre')
+            if pre:
+                text = pre.get_first_text()
+                if text:
+                    if text.data.startswith('-') or text.data.lstrip().startswith('-W'):
+                        self.handle_option_listing(element, pre)
+                        return
+                    lang = self.guess_language(text.data)
+                    example.rst_kind = Directive('code-block', lang)
+
+    def postvisit_element(self, element, parent):
+        if element in self.default_languages:
+            self.default_lang_stack.pop()
+
+    def guess_language(self, data):
+        if 'DO ' in data:
+            return 'fortran'
+        if data.startswith('gcc ') or data.startswith('% gcc '):
+            return 'bash'
+        if data.startswith('--'):
+            return 'bash'
+        return self.default_lang_stack[-1]
+
+    def handle_option_listing(self, element, pre):
+        class OptionWrappingVisitor(NoopVisitor):
+            def postvisit_element(self, element, parent):
+                if element.kind == 'var':
+                    return
+                new_children = []
+                for child in element.children:
+                    if isinstance(child, Text):
+                        new_children += self.split_text(child)
+                    else:
+                        new_children.append(child)
+                element.children = new_children
+            def split_text(self, text):
+                result = []
+                last_idx = 0
+                for m in re.finditer(r'(-\S+)', text.data):
+                    if m.start(1) > 0:
+                        result.append(Text(text.data[last_idx:m.start(1)]))
+                    option = Element('option', {})
+                    option.rst_kind = InlineMarkup('option')
+                    option.children = [Text(m.group(1))]
+                    last_idx = m.end(1)
+                    result.append(option)
+                # Any trailing content?
+                if last_idx or not result:
+                    result.append(Text(text.data[last_idx:]))
+                return result
+        OptionWrappingVisitor().visit(pre)
+
+def fixup_examples(tree, ctxt=None):
     """
     Handle:
       <example>
@@ -824,284 +1154,221 @@ def fixup_examples(tree):
     We special-case where <smallexample> has been used to
     list a set of options (e.g. to describe "-O2").
     """
-    class ExampleFixer(NoopVisitor):
-        def __init__(self):
-            self.default_lang_stack = [args.default_language if args else 'c++']
-
-        def previsit_element(self, element):
-            if hasattr(element, 'default_language'):
-                self.default_lang_stack.append(element.default_language)
-
-            if element.kind in ('example', 'smallexample'):
-                example = element
-                # There could be a "group" holding the "pre"
-                group = element.first_element_named('group')
-                if group:
-                    element = group
-                pre = element.first_element_named('pre')
-                if pre:
-                    text = pre.get_first_text()
-                    if text:
-                        if text.data.startswith('-') or text.data.lstrip().startswith('-W'):
-                            self.handle_option_listing(element, pre)
-                            return
-                        lang = self.guess_language(text.data)
-                        example.rst_kind = Directive('code-block', lang)
-
-        def postvisit_element(self, element, parent):
-            if hasattr(element, 'default_language'):
-                self.default_lang_stack.pop()
-
-        def guess_language(self, data):
-            if 'DO ' in data:
-                return 'fortran'
-            if data.startswith('gcc ') or data.startswith('% gcc '):
-                return 'bash'
-            if data.startswith('--'):
-                return 'bash'
-            return self.default_lang_stack[-1]
-
-        def handle_option_listing(self, element, pre):
-            class OptionWrappingVisitor(NoopVisitor):
-                def postvisit_element(self, element, parent):
-                    if element.kind == 'var':
-                        return
-                    new_children = []
-                    for child in element.children:
-                        if isinstance(child, Text):
-                            new_children += self.split_text(child)
-                        else:
-                            new_children.append(child)
-                    element.children = new_children
-                def split_text(self, text):
-                    result = []
-                    last_idx = 0
-                    for m in re.finditer(r'(-\S+)', text.data):
-                        if m.start(1) > 0:
-                            result.append(Text(text.data[last_idx:m.start(1)]))
-                        option = Element('option', {})
-                        option.rst_kind = InlineMarkup('option')
-                        option.children = [Text(m.group(1))]
-                        last_idx = m.end(1)
-                        result.append(option)
-                    # Any trailing content?
-                    if last_idx or not result:
-                        result.append(Text(text.data[last_idx:]))
-                    return result
-            OptionWrappingVisitor().visit(pre)
-
-    v = ExampleFixer()
+    v = ExampleFixer(ctxt)
     v.visit(tree)
     return tree
 
-def fixup_titles(tree):
-    class TitleFixer(NoopVisitor):
-        def __init__(self):
-            self.cur_section_level = None
-            self.section_kinds = {
-                'top'           : '=',
-                'chapter'       : '-',
-                'section'       : '*',
-                'subsection'    : '^',
-                'subsubsection' : '~',
-                'unnumbered'    : '=',
-                'unnumberedsec' : '='}
-
-        def previsit_element(self, element):
-            if element.kind in self.section_kinds:
-                self.cur_section_level = element.kind
-
-            if element.kind == 'sectiontitle':
-                if self.cur_section_level:
-                    underline = self.section_kinds[self.cur_section_level]
-                else:
-                    underline = '='
-                element.rst_kind = Title(element, underline)
+class TitleFixer(NoopVisitor):
+    def __init__(self, ctxt=None):
+        # Continue from the level at the end of any previous
+        # part of the document (see convert_to_rst_streaming)
+        self.ctxt = ctxt
+        self.cur_section_level = ctxt.section_level if ctxt else None
+        self.section_kinds = {
+            'top'           : '=',
+            'chapter'       : '-',
+            'section'       : '*',
+            'subsection'    : '^',
+            'subsubsection' : '~',
+            'unnumbered'    : '=',
+            'unnumberedsec' : '='}
+
+    def previsit_element(self, element):
+        if element.kind in self.section_kinds:
+            self.cur_section_level = element.kind
+            if self.ctxt:
+                self.ctxt.section_level = element.kind
+
+        if element.kind == 'sectiontitle':
+            if self.cur_section_level:
+                underline = self.section_kinds[self.cur_section_level]
+            else:
+                underline = '='
+            element.rst_kind = Title(element, underline)
 
-            elif element.kind == 'subsubheading':
-                element.rst_kind = Title(element, '^')
+        elif element.kind == 'subsubheading':
+            element.rst_kind = Title(element, '^')
 
-    v = TitleFixer()
+def fixup_titles(tree, ctxt=None):
+    v = TitleFixer(ctxt)
     v.visit(tree)
     return tree
 
+class IndexFixer(NoopVisitor):
+    """
+    Look for <cindex><indexterm>TEXT</indexterm></cindex>
+    """
+    def previsit_indexterm(self, element):
+        text = element.get_all_text()
+        if text:
+            element.rst_kind = Directive('index', text)
+            element.children = []
+
 def fixup_index(tree):
-    class IndexFixer(NoopVisitor):
-        """
-        Look for <cindex><indexterm>TEXT</indexterm></cindex>
-        """
-        def previsit_element(self, element):
-            if isinstance(element, Element):
-                if element.kind == 'indexterm':
-                    text = element.get_all_text()
-                    if text:
-                        element.rst_kind = Directive('index', text)
-                        element.children = []
     v = IndexFixer()
     v.visit(tree)
     return tree
 
-def fixup_xrefs(tree):
-    class XRefFixer(NoopVisitor):
-        """
-        Given:
-          <xref label="C-Dialect-Options">
-            <xrefnodename>C Dialect Options</xrefnodename>
-            <xrefprinteddesc>Options Controlling C Dialect</xrefprinteddesc>
-          </xref>
-        generate:
-          Element("xref")
-            Text("See ")
-            Element(Ref(REF_DESC, REF_NAME))
-        giving this .rst text:
-          See :ref:`REF_DESC <REF_NAME>`
-        (see http://sphinx-doc.org/markup/inline.html#role-ref)
-        Note that the XML already contains a trailing period.
-        """
-        def previsit_element(self, element):
-            if element.kind in ('xref', 'pxref'):
-                xrefnodename = element.first_element_named('xrefnodename')
-                xrefprinteddesc = element.first_element_named('xrefprinteddesc')
-                ref_desc = self.get_desc(element)
-                ref_name = convert_text_to_label(xrefnodename.get_all_text())
-                ref = Element('ref', {})
-                ref.rst_kind = Ref(ref_desc, ref_name)
-                if element.kind == 'xref':
-                    text = 'See '
-                else:
-                    assert element.kind == 'pxref'
-                    text = 'see '
-                element.children = [Text(text), ref]
-
-        def get_desc(self, element):
-            xrefprinteddesc = element.first_element_named('xrefprinteddesc')
-            if not xrefprinteddesc:
-                return None
-            desc = xrefprinteddesc.get_sole_text()
-            if not desc:
-                return None
-            return desc.data
+class XRefFixer(NoopVisitor):
+    """
+    Given:
+      <xref label="C-Dialect-Options">
+        <xrefnodename>C Dialect Options</xrefnodename>
+        <xrefprinteddesc>Options Controlling C Dialect</xrefprinteddesc>
+      </xref>
+    generate:
+      Element("xref")
+        Text("See ")
+        Element(Ref(REF_DESC, REF_NAME))
+    giving this .rst text:
+      See :ref:`REF_DESC <REF_NAME>`
+    (see http://sphinx-doc.org/markup/inline.html#role-ref)
+    Note that the XML already contains a trailing period.
+    """
+    def previsit_xref(self, element):
+        xrefnodename = element.first_element_named('xrefnodename')
+        xrefprinteddesc = element.first_element_named('xrefprinteddesc')
+        ref_desc = self.get_desc(element)
+        ref_name = convert_text_to_label(xrefnodename.get_all_text())
+        ref = Element('ref', {})
+        ref.rst_kind = Ref(ref_desc, ref_name)
+        if element.kind == 'xref':
+            text = 'See '
+        else:
+            assert element.kind == 'pxref'
+            text = 'see '
+        element.children = [Text(text), ref]
+
+    previsit_pxref = previsit_xref
+
+    def get_desc(self, element):
+        xrefprinteddesc = element.first_element_named('xrefprinteddesc')
+        if not xrefprinteddesc:
+            return None
+        desc = xrefprinteddesc.get_sole_text()
+        if not desc:
+            return None
+        return desc.data
 
+def fixup_xrefs(tree):
     v = XRefFixer()
     v.visit(tree)
     return tree
 
-def fixup_lists(tree):
-    class ListFixer(NoopVisitor):
-        """
-        Convert:
-          <listitem>
-             <prepend>&bullet;</prepend>
-             ...ELEMENTS...
-          </listitem>
-        to:
-          <listitem rst_kind=ListItem(BULLET)>
-             ...ELEMENTS...
-          </listitem>
-        """
-        def previsit_element(self, element):
-            if element.kind == 'listitem':
-                new_children = []
-                element.rst_kind = ListItem('*')
-                skip_ws = True
-                for child in element.children:
-                    if isinstance(child, Element):
-                        if child.kind == 'prepend':
-                            continue
-                    if isinstance(child, Text):
-                        if child.data.isspace():
-                            if skip_ws:
-                                continue
-                    skip_ws = False
-                    new_children.append(child)
-                element.children = new_children
+class ListFixer(NoopVisitor):
+    """
+    Convert:
+      <listitem>
+         <prepend>&bullet;</prepend>
+         ...ELEMENTS...
+      </listitem>
+    to:
+      <listitem rst_kind=ListItem(BULLET)>
+         ...ELEMENTS...
+      </listitem>
+    """
+    def previsit_listitem(self, element):
+        new_children = []
+        element.rst_kind = ListItem('*')
+        skip_ws = True
+        for child in element.children:
+            if isinstance(child, Element):
+                if child.kind == 'prepend':
+                    continue
+            if isinstance(child, Text):
+                if child.data.isspace():
+                    if skip_ws:
+                        continue
+            skip_ws = False
+            new_children.append(child)
+        element.children = new_children
 
+def fixup_lists(tree):
     v = ListFixer()
     v.visit(tree)
     return tree
 
-def fixup_inline_markup(tree):
-    class InlineMarkupFixer(NoopVisitor):
-        """
-        Inline markup conversions:
-        =========================  ==================
-        XML INPUT                  .rst OUTPUT
-        =========================  ==================
-        <accent>TEXT</accent>      TEXT + diacritic
-        <command>TEXT</command>    :command:`TEXT`
-        <var>TEXT</var>            ``TEXT``
-        <code>TEXT</code>          ``TEXT``
-        <dfn>TEXT</dfn>            :dfn:`TEXT`
-        <env>TEXT</env>            :envvar:`TEXT`
-        <emph>TEXT</emph>          *TEXT*
-        <samp>TEXT</samp>          :samp:`TEXT`
-        =========================  ==================
-        """
-        def previsit_element(self, element):
-            if element.kind == 'command':
-                element.rst_kind = InlineMarkup('command')
-            elif element.kind == 'var':
-                element.rst_kind = InlineMarkup('samp')
-                # wrap the variable in braces
-                element.prepend_text('{')
-                element.add_text('}')
-            elif element.kind == 'code':
-                element.rst_kind = MatchedInlineMarkup('``')
-            elif element.kind == 'dfn':
-                element.rst_kind = InlineMarkup('dfn')
-            elif element.kind == 'env':
-                element.rst_kind = InlineMarkup('envvar')
-            elif element.kind == 'emph':
-                element.rst_kind = MatchedInlineMarkup('*')
-            elif element.kind == 'samp':
-                element.rst_kind = InlineMarkup('samp')
-
-            new_children = []
-            for child in element.children:
-                if child.is_element('accent'):
-                    if len(child.children) != 1:
-                        raise ValueError()
-                    grandchild = child.children[0]
-                    if not isinstance(grandchild, Text):
-                        raise ValueError()
-                    new_children.append(grandchild)
-                    ACCENTS = {'acute': u'\u0301',
-                               'circ': u'\u0302',
-                               'grave': u'\u0304',
-                               'cedil': u'\u0327',
-                               'tilde': u'\u0303',
-                               'uml':   u'\u0308'}
-                    type_ = child.attrs['type']
-                    grandchild.data += ACCENTS[type_]
-                    continue
-                new_children.append(child)
-            element.children = new_children
+class InlineMarkupFixer(NoopVisitor):
+    """
+    Inline markup conversions:
+    =========================  ==================
+    XML INPUT                  .rst OUTPUT
+    =========================  ==================
+    <accent>TEXT</accent>      TEXT + diacritic
+    <command>TEXT</command>    :command:`TEXT`
+    <var>TEXT</var>            ``TEXT``
+    <code>TEXT</code>          ``TEXT``
+    <dfn>TEXT</dfn>            :dfn:`TEXT`
+    <env>TEXT</env>            :envvar:`TEXT`
+    <emph>TEXT</emph>          *TEXT*
+    <samp>TEXT</samp>          :samp:`TEXT`
+    =========================  ==================
+    """
+    def previsit_element(self, element):
+        if element.kind == 'command':
+            element.rst_kind = InlineMarkup('command')
+        elif element.kind == 'var':
+            element.rst_kind = InlineMarkup('samp')
+            # wrap the variable in braces
+            element.prepend_text('{')
+            element.add_text('}')
+        elif element.kind == 'code':
+            element.rst_kind = MatchedInlineMarkup('``')
+        elif element.kind == 'dfn':
+            element.rst_kind = InlineMarkup('dfn')
+        elif element.kind == 'env':
+            element.rst_kind = InlineMarkup('envvar')
+        elif element.kind == 'emph':
+            element.rst_kind = MatchedInlineMarkup('*')
+        elif element.kind == 'samp':
+            element.rst_kind = InlineMarkup('samp')
+
+        new_children = []
+        for child in element.children:
+            if child.is_element('accent'):
+                if len(child.children) != 1:
+                    raise ValueError()
+                grandchild = child.children[0]
+                if not isinstance(grandchild, Text):
+                    raise ValueError()
+                new_children.append(grandchild)
+                ACCENTS = {'acute': u'\u0301',
+                           'circ': u'\u0302',
+                           'grave': u'\u0304',
+                           'cedil': u'\u0327',
+                           'tilde': u'\u0303',
+                           'uml':   u'\u0308'}
+                type_ = child.attrs['type']
+                grandchild.data += ACCENTS[type_]
+                continue
+            new_children.append(child)
+        element.children = new_children
 
+def fixup_inline_markup(tree):
     v = InlineMarkupFixer()
     v.visit(tree)
     return tree
 
+class DefTypeFixup(NoopVisitor):
+    """
+    Look for <deftypefn> elements..
+    """
+    def previsit_deftypefn(self, element):
+        declaration = ''
+        for child in element.first_element_named('definitionterm').children:
+            text = child.get_all_text()
+            if child.kind in ('deftype', 'defparamtype'):
+                declaration += text + ' '
+            elif child.kind in ('deffunction', 'defdelimiter', 'defparamtype', 'defparam'):
+                declaration += text
+
+        definitionitem = element.first_element_named('definitionitem')
+        element.children = []
+        if definitionitem:
+            element.children.append(definitionitem)
+        element.rst_kind = Directive('function', declaration)
+
 def fixup_deftype(tree):
-    class DefTypeFixup(NoopVisitor):
-        """
-        Look for <deftypefn> elements..
-        """
-        def previsit_element(self, element):
-            if isinstance(element, Element):
-                if element.kind == 'deftypefn':
-                    declaration = ''
-                    for child in element.first_element_named('definitionterm').children:
-                        text = child.get_all_text()
-                        if child.kind in ('deftype', 'defparamtype'):
-                            declaration += text + ' '
-                        elif child.kind in ('deffunction', 'defdelimiter', 'defparamtype', 'defparam'):
-                            declaration += text
-
-                    definitionitem = element.first_element_named('definitionitem')
-                    element.children = []
-                    if definitionitem:
-                        element.children.append(definitionitem)
-                    element.rst_kind = Directive('function', declaration)
     v = DefTypeFixup()
     v.visit(tree)
     return tree
@@ -1109,28 +1376,297 @@ def fixup_deftype(tree):
 
 # Top-level conversion routine
 
-def convert_to_rst(tree, ctxt):
-    tree = ctxt.preprocess(tree)
-    tree = fixup_comments(tree)
-    tree = prune(tree)
-    tree = fixup_nodes(tree, ctxt)
-    tree = fixup_menus(tree)
-    tree = split(tree)
-    tree = fixup_option_refs(tree)
-    tree = fixup_table_entry(tree)
-    tree = fixup_multitables(tree, ctxt)
-    tree = fixup_examples(tree)
-    tree = fixup_titles(tree)
-    tree = fixup_index(tree)
-    tree = fixup_xrefs(tree)
-    tree = fixup_deftype(tree)
-    tree = fixup_lists(tree)
-    tree = fixup_inline_markup(tree)
-    tree = fixup_empty_texts(tree)
-    tree = fixup_wrapped_options(tree)
-    tree = fixup_trailing_sign_for_options(tree)
-    tree = fixup_element_spacing(tree)
-    return tree
+class Pass:
+    """
+    A stage of the conversion pipeline.
+
+    Either "visitor" is a callable taking the Context and returning a
+    Visitor to run over the tree, or "function" is a callable taking
+    (tree, ctxt) and returning the new tree.
+
+    "after" names the visitor passes that must have finished with the
+    whole tree before this pass starts, typically because this pass
+    looks at the children of an element for changes made by the other
+    pass.  Otherwise adjacent visitor passes are assumed to be safe to
+    run together at each element.
+    """
+    def __init__(self, name, visitor=None, function=None, after=()):
+        assert (visitor is None) != (function is None)
+        self.name = name
+        self.visitor = visitor
+        self.function = function
+        self.after = after
+
+    def __repr__(self):
+        return 'Pass(%r)' % self.name
+
+class PassManager:
+    """
+    Run a list of passes over a tree, fusing runs of adjacent visitor
+    passes into a single traversal of the tree (via FusedVisitor).
+
+    Function passes act as barriers between traversals, as does a
+    visitor pass that has to run "after" one in the current traversal.
+    """
+    def __init__(self, passes, fuse=True):
+        self.passes = passes
+        self.fuse = fuse
+        self.traversals = self._group_passes()
+
+    def _group_passes(self):
+        traversals = []
+        for pass_ in self.passes:
+            if (self.fuse
+                and pass_.visitor
+                and traversals
+                and traversals[-1][0].visitor
+                and not any(other.name in pass_.after
+                            for other in traversals[-1])):
+                traversals[-1].append(pass_)
+            else:
+                traversals.append([pass_])
+        return traversals
+
+    def run(self, tree, ctxt, profiler=None):
+        for traversal in self.traversals:
+            if profiler:
+                stage = profiler.start('+'.join(pass_.name
+                                                for pass_ in traversal),
+                                       tree)
+            if traversal[0].function:
+                tree = traversal[0].function(tree, ctxt)
+                if profiler:
+                    profiler.finish(stage, tree)
+                continue
+            visitors = [pass_.visitor(ctxt) for pass_ in traversal]
+            if len(visitors) == 1:
+                visitor = visitors[0]
+            else:
+                visitor = FusedVisitor(visitors)
+            if profiler:
+                profiler.count_visits(stage, visitor)
+            visitor.visit(tree)
+            if profiler:
+                profiler.finish(stage, tree)
+        return tree
+
+PIPELINE = [
+    Pass('preprocess', function=lambda tree, ctxt: ctxt.preprocess(tree)),
+
+    Pass('convert_comments', visitor=lambda ctxt: CommentConverter()),
+    Pass('combine_comments', visitor=lambda ctxt: CommentCombiner(),
+         after=('convert_comments', )),
+    Pass('prune', visitor=lambda ctxt: Pruner()),
+    Pass('fixup_nodes', visitor=lambda ctxt: NodeFixer()),
+    Pass('move_nodes', function=move_nodes),
+
+    Pass('fixup_menus', visitor=lambda ctxt: MenuFixer()),
+    Pass('split', visitor=lambda ctxt: Splitter()),
+    Pass('add_toctrees', visitor=lambda ctxt: ToctreeAdder(),
+         after=('split', )),
+    Pass('fixup_option_refs', visitor=lambda ctxt: OptionRefFixer()),
+    Pass('fixup_table_entry', visitor=lambda ctxt: TableEntryFixer()),
+    Pass('fixup_multitables', visitor=MultitableFixer),
+    # (the option listings in examples wrap the text of any <option>
+    # elements already marked up by fixup_option_refs)
+    Pass('fixup_examples', visitor=ExampleFixer,
+         after=('fixup_option_refs', )),
+    Pass('fixup_titles', visitor=TitleFixer),
+    Pass('fixup_index', visitor=lambda ctxt: IndexFixer()),
+    Pass('fixup_xrefs', visitor=lambda ctxt: XRefFixer()),
+    Pass('fixup_deftype', visitor=lambda ctxt: DefTypeFixup()),
+    Pass('fixup_lists', visitor=lambda ctxt: ListFixer()),
+    Pass('fixup_inline_markup', visitor=lambda ctxt: InlineMarkupFixer()),
+    Pass('fixup_empty_texts', visitor=lambda ctxt: EmptyTextFixer()),
+    Pass('fixup_wrapped_options', visitor=lambda ctxt: WrapperOptionFixer()),
+    Pass('fixup_trailing_sign_for_options',
+         visitor=lambda ctxt: TrailingSignForOptionFixer(),
+         after=('fixup_wrapped_options', )),
+    Pass('fixup_element_spacing', visitor=lambda ctxt: ElementSpacingFixer()),
+]
+
+def convert_to_rst(tree, ctxt, fuse=True, profiler=None):
+    return PassManager(PIPELINE, fuse).run(tree, ctxt, profiler)
+
+class Profiler:
+    """
+    Record statistics about each stage of a conversion (for --profile):
+      the wall-clock and CPU time taken,
+      the number of nodes visited,
+      the number of nodes modified, added or removed,
+      the peak memory allocated during the stage, beyond what was
+      allocated at its start (if tracemalloc is tracing).
+
+    Spotting the modified nodes means comparing a summary of the whole
+    tree before and after the stage, which is done outside the timing
+    of the stage, but is still slow.
+    """
+    def __init__(self):
+        self.stages = []
+
+    def start(self, name, tree=None):
+        stage = OrderedDict([('name', name),
+                             ('wall_ms', None),
+                             ('cpu_ms', None),
+                             ('visited', None),
+                             ('mutated', None),
+                             ('peak_kb', None)])
+        self.stages.append(stage)
+        self._signatures = get_node_signatures(tree)
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+            self._start_memory = tracemalloc.get_traced_memory()[0]
+        self._start_cpu = time.process_time()
+        self._start_wall = time.perf_counter()
+        return stage
+
+    def finish(self, stage, tree):
+        stage['wall_ms'] = 1000 * (time.perf_counter() - self._start_wall)
+        stage['cpu_ms'] = 1000 * (time.process_time() - self._start_cpu)
+        if tracemalloc.is_tracing():
+            peak = tracemalloc.get_traced_memory()[1]
+            stage['peak_kb'] = (peak - self._start_memory) // 1024
+        before = self._signatures
+        after = get_node_signatures(tree)
+        self._signatures = None
+        mutated = 0
+        for key, (node, signature) in after.items():
+            if key not in before or before[key][1] != signature:
+                mutated += 1
+        mutated += sum(1 for key in before if key not in after)
+        stage['mutated'] = mutated
+
+    def count_visits(self, stage, visitor):
+        """
+        Count the nodes that "visitor" visits, into stage['visited'].
+        """
+        stage['visited'] = 0
+        previsit = visitor._previsit
+        visit_leaf = visitor._visit_leaf
+        def counting_previsit(element):
+            stage['visited'] += 1
+            return previsit(element)
+        def counting_visit_leaf(node):
+            stage['visited'] += 1
+            return visit_leaf(node)
+        # (Visitor.visit looks these up on the instance)
+        visitor._previsit = counting_previsit
+        visitor._visit_leaf = counting_visit_leaf
+
+    def write_table(self, f_out):
+        columns = ('name', 'wall_ms', 'cpu_ms', 'visited', 'mutated',
+                   'peak_kb')
+        width = max([len(stage['name']) for stage in self.stages] + [5])
+        f_out.write('%-*s %10s %10s %10s %10s %10s\n'
+                    % ((width, 'stage') + columns[1:]))
+        for stage in self.stages + [self.get_total()]:
+            values = []
+            for column in columns[1:]:
+                value = stage[column]
+                if value is None:
+                    values.append('-')
+                elif isinstance(value, float):
+                    values.append('%.1f' % value)
+                else:
+                    values.append('%i' % value)
+            f_out.write('%-*s %10s %10s %10s %10s %10s\n'
+                        % ((width, stage['name']) + tuple(values)))
+
+    def get_total(self):
+        total = OrderedDict([('name', 'total')])
+        for column in ('wall_ms', 'cpu_ms', 'visited', 'mutated'):
+            total[column] = sum(stage[column] or 0 for stage in self.stages)
+        peaks = [stage['peak_kb'] for stage in self.stages
+                 if stage['peak_kb'] is not None]
+        total['peak_kb'] = max(peaks) if peaks else None
+        return total
+
+    def write_json(self, f_out):
+        json.dump({'stages': self.stages, 'total': self.get_total()},
+                  f_out, indent=2)
+        f_out.write('\n')
+
+def get_node_signatures(tree):
+    """
+    Get a dict of id(node) -> (node, hash of the node's own content),
+    for each node in "tree" (which may be None), for Profiler.
+    """
+    result = {}
+    if tree is None:
+        return result
+    for node in tree.iter_depth_first():
+        if isinstance(node, Element):
+            signature = (node.kind,
+                         tuple(node._attrs.items()) if node._attrs else None,
+                         tuple(map(id, node.children)),
+                         id(node.rst_kind))
+        else:
+            signature = (type(node), getattr(node, 'data', None),
+                         getattr(node, 'name', None))
+        result[id(node)] = (node, hash(signature))
+    return result
+
+def convert_to_rst_streaming(f_in, ctxt, f_out, opener, extra_entities=None):
+    """
+    Chapter-at-a-time equivalent of from_xml_string, convert_to_rst and
+    writing the result with RstWriter(f_out, opener), so that peak
+    memory usage depends on the largest unit (see UnitTreeBuilder),
+    rather than the whole document.
+
+    Each unit is converted as it is parsed; any OutputFile elements
+    directly within it are written out and freed.  The rest of the
+    top-level content is kept, and written to f_out at the end, since
+    the toctree for it isn't complete until all units are seen.
+
+    Unlike convert_to_rst, a <node> or <anchor> at the very end of a
+    unit stays there, rather than moving into the following unit.
+    """
+    entities = ENTITIES
+    if extra_entities:
+        entities = OrderedDict(ENTITIES)
+        entities.update(extra_entities)
+    builder = UnitTreeBuilder(entities)
+    kept = []
+    toctree = None
+    for root, children in builder.iter_units(f_in):
+        # Temporarily make the unit the sole content of the root
+        # (which may already hold the start of the next unit)
+        live_children = root.children
+        root.children = children
+        unit = Element('document')
+        unit.children = [root]
+        unit = fixup_whitespace(unit)
+        unit = convert_to_rst(unit, ctxt)
+        children = root.children
+        root.children = live_children
+        ctxt.default_languages.clear()
+        for child in children:
+            if isinstance(child, Element):
+                if isinstance(child.rst_kind, OutputFile):
+                    w = RstWriter(io.StringIO(), opener)
+                    w.visit(child)
+                    # Write out all of the unit now, rather than holding
+                    # any of it until the end
+                    w.flush()
+                    # Any unfinished line is written to the parent
+                    # file when not streaming; preserve this.
+                    if w.curline:
+                        kept.append(Text(w.curline))
+                    continue
+                if child.kind == 'toctree':
+                    # Consolidate into one toctree, as split does
+                    if toctree:
+                        toctree.children += child.children
+                        continue
+                    toctree = child
+            kept.append(child)
+    # Write out what remains, within the original document and root
+    for child in builder.document.children:
+        if isinstance(child, Element):
+            child.children = kept
+    w = RstWriter(f_out, opener)
+    w.visit(builder.document)
+    w.finish()
 
 # Policies for converting elements to rst (element.rst_kind):
 
@@ -1197,13 +1733,19 @@ class Title(RstKind):
 
     def before(self, w):
         w.write('\n')
+        self.start = w.start_span()
 
     def after(self, w):
-        tmpw = RstWriter(io.StringIO())
-        for child in self.element.children:
-            tmpw.visit(child)
-        tmpw.finish()
-        w.write('\n%s\n\n' % (self.underline * len(tmpw.f_out.getvalue())))
+        width = w.span_width(self.start)
+        if width is None:
+            # The title spilled onto more than one line; render it again
+            # to measure all of it
+            tmpw = RstWriter(io.StringIO())
+            for child in self.element.children:
+                tmpw.visit(child)
+            tmpw.finish()
+            width = len(tmpw.f_out.getvalue())
+        w.write('\n%s\n\n' % (self.underline * width))
 
 class Directive(RstKind):
     def __init__(self, name, args):
@@ -1309,64 +1851,74 @@ class TableLayout:
 
         self.needs_grid_table = False
 
+        # Side-tables, keyed by thead/tbody/row element
+        self.rows = {}
+        self.entries = {}
+        self.columns = {}
+        self.height_needed_for_y = {}
+
+        # The rendered lines of each entry, so that each is only
+        # rendered once, for both the requisition and the drawing
+        self.lines_for_entry = {}
+
         for comp in self.components:
-            comp.rows = []
+            self.rows[comp] = []
             for child in comp.children:
                 if child.is_element('row'):
-                    comp.rows.append(child)
+                    self.rows[comp].append(child)
             if debug:
-                print('comp.rows: %r' % (comp.rows, ))
+                print('comp.rows: %r' % (self.rows[comp], ))
 
-            for row in comp.rows:
-                row.entries = []
+            for row in self.rows[comp]:
+                self.entries[row] = []
                 for child in row.children:
                     if child.is_element('entry'):
-                        row.entries.append(child)
+                        self.entries[row].append(child)
                     if self._entry_needs_grid_table(child):
                         self.needs_grid_table = True
                 if debug:
-                    print('row.entries: %r' % (row.entries, ))
+                    print('row.entries: %r' % (self.entries[row], ))
 
         # If we just have a body, turn the first row into a header:
         if len(self.components) == 1:
             thead = Element('thead', {})
-            first_row = self.components[0].rows[0]
-            thead.rows = [first_row]
-            self.components[0].rows = self.components[0].rows[1:]
+            first_row = self.rows[self.components[0]][0]
+            self.rows[thead] = [first_row]
+            self.rows[self.components[0]] = self.rows[self.components[0]][1:]
             self.components.insert(0, thead)
 
-        self.num_columns = len(self.components[0].rows[0].entries)
+        self.num_columns = len(self.entries[self.rows[self.components[0]][0]])
         if debug:
             print('self.num_columns: %r' % self.num_columns)
         for comp in self.components:
-            comp.columns = []
+            self.columns[comp] = []
             for idx in range(self.num_columns):
                 column = []
-                for row in comp.rows:
-                    if idx < len(row.entries):
-                        column.append(row.entries[idx])
+                for row in self.rows[comp]:
+                    if idx < len(self.entries[row]):
+                        column.append(self.entries[row][idx])
                 if debug:
                     print('column: %r' % (column, ))
-                comp.columns.append(column)
+                self.columns[comp].append(column)
             if debug:
-                print('comp.columns: %r' % (comp.columns, ))
+                print('comp.columns: %r' % (self.columns[comp], ))
 
         # Requisition:
         self.width_needed_for_x = {}
         for x in range(self.num_columns):
             for comp in self.components:
-                for y, entry in enumerate(comp.columns[x]):
+                for y, entry in enumerate(self.columns[comp][x]):
                     w, h = self._get_requisition(entry)
                     if w > self.width_needed_for_x.get(x, 0):
                         self.width_needed_for_x[x] = w
 
         for comp in self.components:
-            comp.height_needed_for_y = {}
+            self.height_needed_for_y[comp] = {}
             for x in range(self.num_columns):
-                for y, entry in enumerate(comp.columns[x]):
+                for y, entry in enumerate(self.columns[comp][x]):
                     w, h = self._get_requisition(entry)
-                    if h > comp.height_needed_for_y.get(y, 0):
-                        comp.height_needed_for_y[y] = h
+                    if h > self.height_needed_for_y[comp].get(y, 0):
+                        self.height_needed_for_y[comp][y] = h
 
     def _entry_needs_grid_table(self, entry):
         for desc in entry.iter_depth_first():
@@ -1376,15 +1928,22 @@ class TableLayout:
         return False
 
     def _get_requisition(self, entry):
-        text = self._render_entry(entry)
-        if text:
-            lines = text.splitlines()
+        lines = self._get_lines(entry)
+        if lines:
             w = max([len(line) for line in lines])
             h = len(lines)
             return w, h
         else:
             return 0, 0
 
+    def _get_lines(self, entry):
+        try:
+            return self.lines_for_entry[entry]
+        except KeyError:
+            lines = self._render_entry(entry).splitlines()
+            self.lines_for_entry[entry] = lines
+            return lines
+
     def _render_entry(self, entry):
         # Nested writer
         w = RstWriter(io.StringIO())
@@ -1405,16 +1964,15 @@ class TableLayout:
     def render_grid_table(self, w):
         self.draw_grid_table_border(w, '-')
         for comp_idx, comp in enumerate(self.components):
-            for y, row in enumerate(comp.rows):
+            for y, row in enumerate(self.rows[comp]):
                 # Cope with newlines in "text":
                 lines_at_x = {}
-                for x, entry in enumerate(row.entries):
-                    lines_at_x[x] = (
-                        self._render_entry(entry).splitlines())
+                for x, entry in enumerate(self.entries[row]):
+                    lines_at_x[x] = self._get_lines(entry)
 
-                for line_idx in range(comp.height_needed_for_y[y]):
+                for line_idx in range(self.height_needed_for_y[comp][y]):
                     w.write('|')
-                    for x, entry in enumerate(row.entries):
+                    for x, entry in enumerate(self.entries[row]):
                         lines = lines_at_x[x]
                         if line_idx < len(lines):
                             text = lines[line_idx]
@@ -1440,23 +1998,23 @@ class TableLayout:
     def render_simple_table(self, w):
         self.draw_simple_table_border(w)
         for comp in self.components:
-            for y, row in enumerate(comp.rows):
+            for y, row in enumerate(self.rows[comp]):
                 # Cope with newlines in "text":
                 lines_at_x = {}
-                for x, entry in enumerate(row.entries):
-                    lines_at_x[x] = self._render_entry(entry).splitlines()
+                for x, entry in enumerate(self.entries[row]):
+                    lines_at_x[x] = self._get_lines(entry)
 
-                for line_idx in range(comp.height_needed_for_y[y]):
+                for line_idx in range(self.height_needed_for_y[comp][y]):
                     # Determine within this line which is the final
                     # non-empty entry, to avoid surplus whitespace
                     # to the right of it.
                     final_x_with_text = 0
-                    for x, entry in enumerate(row.entries):
+                    for x, entry in enumerate(self.entries[row]):
                         if line_idx < len(lines_at_x[x]):
                             if lines_at_x[x][line_idx]:
                                 final_x_with_text = x
 
-                    for x, entry in enumerate(row.entries):
+                    for x, entry in enumerate(self.entries[row]):
                         if x and x <= final_x_with_text:
                             w.write('  ')
                         lines = lines_at_x[x]
@@ -1481,10 +2039,14 @@ class TableLayout:
 class Table(RstKind):
     def __init__(self, element, ctxt):
         self.element = element
-        self.ctxt = ctxt
+        # Only the debug flag is kept, rather than the whole Context,
+        # so that pickling a table (see write_rst_parallel) doesn't
+        # also pickle the Context's tables, and the elements they refer
+        # to elsewhere in the tree
+        self.debug = ctxt.debug
 
     def before(self, w):
-        table_layout = TableLayout(self.element, self.ctxt.debug)
+        table_layout = TableLayout(self.element, self.debug)
         table_layout.render(w)
 
         # Don't traverse children; we've already rendered them
@@ -1493,6 +2055,10 @@ class Table(RstKind):
 # Output of a converted tree to .rst file
 
 class RstWriter(Visitor):
+    # Completed lines are gathered up, and written to the file when
+    # there are this many of them
+    MAX_PENDING = 256
+
     def __init__(self, f_out, opener=None):
         self.f_out = f_out
         self.indent = 0
@@ -1502,35 +2068,81 @@ class RstWriter(Visitor):
         if self.f_out is None:
             self.f_out = self.opener.open(None)
         self.output_file_stack = [self.f_out]
+        self.pending = []
+        self.indent_strings = ['']
+        # The number of newlines written so far, so that start_span and
+        # span_width can tell whether text stayed on a single line
+        self.line_count = 0
 
     def finish(self):
         self._flush_line()
+        self.flush()
+
+    def flush(self):
+        """
+        Write any completed lines to the current file.
+        """
+        if self.pending:
+            self.f_out.write(''.join(self.pending))
+            self.pending = []
 
     def write(self, text):
-        text = text.replace('\n',
-                            '\n%s' % ('  ' * self.indent))
-        for ch in text:
-            if ch == '\n':
-                nonempty_line = self._flush_line()
-                # Avoid repeated blank lines:
-                if nonempty_line or self.had_nonempty_line:
-                    self.f_out.write('\n')
-                self.had_nonempty_line = nonempty_line
-            else:
-                self.curline += ch
+        if '\n' not in text:
+            self.curline += text
+            return
+        try:
+            indent = self.indent_strings[self.indent]
+        except IndexError:
+            while len(self.indent_strings) <= self.indent:
+                self.indent_strings.append('  ' * len(self.indent_strings))
+            indent = self.indent_strings[self.indent]
+        lines = text.split('\n')
+        self.curline += lines[0]
+        self.line_count += len(lines) - 1
+        # Each newline is followed by the indentation, as the start of
+        # the next line
+        for line in lines[1:]:
+            nonempty_line = self._flush_line()
+            # Avoid repeated blank lines:
+            if nonempty_line or self.had_nonempty_line:
+                self.pending.append('\n')
+            self.had_nonempty_line = nonempty_line
+            self.curline = indent + line
+        if len(self.pending) >= self.MAX_PENDING:
+            self.flush()
+
+    def start_span(self):
+        """
+        Get a marker for the current position, for use by span_width.
+        """
+        return (self.line_count, len(self.curline))
+
+    def span_width(self, start):
+        """
+        Get the width of what has been written since start_span returned
+        "start", or None if it isn't all on the current line.
+        """
+        line_count, col = start
+        if line_count != self.line_count:
+            return None
+        text = self.curline[col:]
+        # A whitespace-only line would not be written
+        if text.isspace():
+            return 0
+        return len(text)
 
     def _flush_line(self):
         # Don't print lines containing purely whitespace
         # (just print their newlines)
-        if not self.curline:
+        curline = self.curline
+        if not curline:
             return False
 
-        if self.curline.isspace():
-            self.curline = ''
+        self.curline = ''
+        if curline.isspace():
             return False
 
-        self.f_out.write(self.curline)
-        self.curline = ''
+        self.pending.append(curline)
         return True
 
     def previsit_element(self, element):
@@ -1557,14 +2169,85 @@ class RstWriter(Visitor):
         self.write(text.data)
 
     def push_output_file(self, output_file):
+        self.flush()
         self.f_out = self.opener.open(output_file)
         self.output_file_stack.append(self.f_out)
 
     def pop_output_file(self, output_file):
+        self.flush()
         self.opener.close(self.f_out)
         self.output_file_stack.pop()
         self.f_out = self.output_file_stack[-1]
 
+class ProfilingRstWriter(RstWriter):
+    """
+    RstWriter which records a Profiler stage for each file it writes,
+    named "write NAME.rst", covering the rendering of the file, but not
+    of any files nested within it.
+
+    Call finish_profile after visiting the tree, to finish the stage
+    for the initial file.
+    """
+    def __init__(self, f_out, opener, profiler, name):
+        RstWriter.__init__(self, f_out, opener)
+        self.profiler = profiler
+        # (stage, traced memory at its start) for each open file
+        self.stages = []
+        self._start_stage(name)
+
+    def _start_stage(self, name):
+        stage = OrderedDict([('name', 'write %s.rst' % name),
+                             ('wall_ms', 0.0),
+                             ('cpu_ms', 0.0),
+                             ('visited', 0),
+                             ('mutated', 0),
+                             ('peak_kb', None)])
+        self.profiler.stages.append(stage)
+        start_memory = 0
+        if tracemalloc.is_tracing():
+            start_memory = tracemalloc.get_traced_memory()[0]
+            stage['peak_kb'] = 0
+        self.stages.append((stage, start_memory))
+        self._resume()
+
+    def _resume(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        self.resume_cpu = time.process_time()
+        self.resume_wall = time.perf_counter()
+
+    def _pause(self):
+        stage, start_memory = self.stages[-1]
+        stage['wall_ms'] += 1000 * (time.perf_counter() - self.resume_wall)
+        stage['cpu_ms'] += 1000 * (time.process_time() - self.resume_cpu)
+        if tracemalloc.is_tracing():
+            peak = tracemalloc.get_traced_memory()[1]
+            stage['peak_kb'] = max(stage['peak_kb'],
+                                   (peak - start_memory) // 1024)
+
+    def _previsit(self, element):
+        self.stages[-1][0]['visited'] += 1
+        return RstWriter._previsit(self, element)
+
+    def _visit_leaf(self, node):
+        self.stages[-1][0]['visited'] += 1
+        return RstWriter._visit_leaf(self, node)
+
+    def push_output_file(self, output_file):
+        self._pause()
+        self._start_stage(output_file.name)
+        RstWriter.push_output_file(self, output_file)
+
+    def pop_output_file(self, output_file):
+        RstWriter.pop_output_file(self, output_file)
+        self._pause()
+        self.stages.pop()
+        self._resume()
+
+    def finish_profile(self):
+        self._pause()
+        self.stages.pop()
+
 class RstOpener:
     """
     Policy for how RstWriter should handle OutputFile instances
@@ -1577,26 +2260,201 @@ class RstOpener:
 class Context:
     def __init__(self):
         self.debug = False
+        # The kind of the most recent sectioning element seen by
+        # fixup_titles
+        self.section_level = None
+        # Side-table of Element -> default language for code examples
+        # within it, for use by fixup_examples
+        self.default_languages = {}
 
     def preprocess(self, tree):
         return tree
 
+def file_has_content(path, data):
+    """
+    Does the file at "path" exist and hold exactly the bytes "data"?
+    """
+    try:
+        if os.path.getsize(path) != len(data):
+            return False
+        h = hashlib.sha256()
+        with open(path, 'rb') as f_in:
+            for chunk in iter(lambda: f_in.read(65536), b''):
+                h.update(chunk)
+    except FileNotFoundError:
+        return False
+    return h.digest() == hashlib.sha256(data).digest()
+
 class FileOpener(RstOpener):
-    def __init__(self, output_dir):
+    """
+    Write each file as "output_dir/NAME.rst", leaving a file untouched
+    if it already has the right content (so that Sphinx doesn't need to
+    re-read it), and atomically replacing it otherwise.
+
+    Call finish once everything is written, to remove the .rst files
+    written by the previous run that this one didn't write (e.g. for
+    sections which no longer exist), apart from those named in "keep".
+    The files written by each run are recorded in a manifest in
+    output_dir, so that other files there (such as ones added by hand)
+    are never removed.
+    """
+    MANIFEST = '.texi2rst-manifest.json'
+
+    def __init__(self, output_dir, keep=()):
         self.output_dir = output_dir
+        self.keep = set('%s.rst' % name for name in keep)
+        # Path of each file currently being written
+        self.paths = {}
+        self.written = []
+        self.unchanged = []
+        self.removed = []
 
     def open(self, output_file):
-        path = os.path.join(self.output_dir, '%s.rst' % output_file.name)
-        print('opening: %s' % path)
-        f_out = open(path, 'w')
+        f_out = io.StringIO()
+        self.paths[f_out] = os.path.join(self.output_dir,
+                                         '%s.rst' % output_file.name)
         return f_out
 
     def close(self, f_out):
-        print('closing')
-        f_out.close()
+        path = self.paths.pop(f_out)
+        data = f_out.getvalue().encode('utf-8')
+        if file_has_content(path, data):
+            self.unchanged.append(path)
+            return
+        tmp_path = os.path.join(self.output_dir,
+                                '.%s.tmp' % os.path.basename(path))
+        with open(tmp_path, 'wb') as f_tmp:
+            f_tmp.write(data)
+        os.replace(tmp_path, path)
+        self.written.append(path)
+
+    def finish(self):
+        """
+        Remove the stale files and update the manifest, returning the
+        numbers of files written, left unchanged and removed.
+        """
+        names = set(os.path.basename(path)
+                    for path in self.written + self.unchanged)
+        manifest_path = os.path.join(self.output_dir, self.MANIFEST)
+        try:
+            with open(manifest_path) as f_in:
+                previous = json.load(f_in)
+        except FileNotFoundError:
+            previous = []
+        for name in sorted(previous):
+            if name not in names and name not in self.keep:
+                try:
+                    os.remove(os.path.join(self.output_dir, name))
+                except FileNotFoundError:
+                    continue
+                self.removed.append(name)
+        tmp_path = manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f_out:
+            json.dump(sorted(names), f_out, indent=1)
+        os.replace(tmp_path, manifest_path)
+        return len(self.written), len(self.unchanged), len(self.removed)
+
+class CapturingOpener(RstOpener):
+    """
+    Opener which keeps the content of each file in memory, as a list
+    of (OutputFile, text) pairs in the order the files were opened.
+    """
+    def __init__(self):
+        self.f_outs = []
+
+    def open(self, output_file):
+        f_out = io.StringIO()
+        self.f_outs.append((output_file, f_out))
+        return f_out
+
+    def close(self, f_out):
+        pass
+
+    def get_files(self):
+        return [(output_file, f_out.getvalue())
+                for output_file, f_out in self.f_outs]
+
+def render_output_file(element):
+    """
+    Render an element with an OutputFile rst_kind (and any nested
+    within it) with a fresh RstWriter, for write_rst_parallel.
+
+    Return the (OutputFile, text) pairs for the files, and the state
+    the writer was left in, to be carried on by the parent's writer.
+    """
+    opener = CapturingOpener()
+    w = RstWriter(io.StringIO(), opener)
+    w.visit(element)
+    w.flush()
+    return (opener.get_files(), w.curline, w.had_nonempty_line, w.line_count)
+
+class ParallelRstWriter(RstWriter):
+    """
+    RstWriter which uses the results of render_output_file for
+    elements in "rendered", rather than visiting them.
+
+    These were rendered starting from the state of a fresh RstWriter;
+    if this writer is in some other state when it reaches one of them
+    (e.g. part-way through a line), it is visited as usual instead.
+    """
+    def __init__(self, f_out, opener, rendered):
+        RstWriter.__init__(self, f_out, opener)
+        self.rendered = rendered
+
+    def previsit_element(self, element):
+        result = self.rendered.pop(element, None)
+        if (result is not None
+            and self.indent == 0
+            and not self.curline
+            and not self.had_nonempty_line):
+            files, self.curline, self.had_nonempty_line, line_count = result
+            self.line_count += line_count
+            self.flush()
+            for output_file, text in files:
+                f_out = self.opener.open(output_file)
+                f_out.write(text)
+                self.opener.close(f_out)
+            return True
+        return RstWriter.previsit_element(self, element)
+
+def write_rst_parallel(tree, f_out, opener, jobs):
+    """
+    Equivalent to writing "tree" with RstWriter(f_out, opener), but
+    with the outermost OutputFile elements (as marked by split) each
+    pickled and rendered by a pool of "jobs" worker processes.  The
+    rest of the tree, including the toctrees referencing them, is
+    written by this process.
+
+    An element which can't be rendered by a worker (e.g. one nested
+    too deeply to be pickled) is written by this process instead.
+    """
+    output_elements = []
+    stack = [tree]
+    while stack:
+        element = stack.pop()
+        if isinstance(element.rst_kind, OutputFile):
+            output_elements.append(element)
+            continue
+        stack.extend(child for child in reversed(element.children)
+                     if isinstance(child, Element))
+    rendered = {}
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+        futures = [(element, executor.submit(render_output_file, element))
+                   for element in output_elements]
+        for element, future in futures:
+            try:
+                rendered[element] = future.result()
+            except RecursionError:
+                # (ParallelRstWriter visits elements not in "rendered")
+                pass
+    w = ParallelRstWriter(f_out, opener, rendered)
+    w.visit(tree)
+    w.flush()
 
 class GccContext(Context):
     def preprocess(self, tree):
+        default_languages = self.default_languages
+
         class GccVisitor(NoopVisitor):
             def previsit_element(self, element):
                 if element.kind == 'chapter':
@@ -1605,7 +2463,7 @@ class GccContext(Context):
                             text = child.get_sole_text()
                             if text:
                                 if text.data == 'GNU Objective-C Features':
-                                    element.default_language = 'objective-c'
+                                    default_languages[element] = 'objective-c'
                 # Fixups for issue #1:
                 if element.kind == 'option':
                     all_text = element.get_all_text()
@@ -1617,25 +2475,112 @@ class GccContext(Context):
         v.visit(tree)
         return tree
 
+def convert_file(xml_file, output_dir, jobs=1, keep=(), cache=None,
+                 profiler=None):
+    """
+    Convert the TEXINFO xml file "xml_file" into RST files within
+    "output_dir" (e.g. gcc.xml into gcc.rst, plus a file for each chapter
+    and section), rendering them with "jobs" processes, and using the
+    TreeCache "cache" (if any) for the parsed XML.
+
+    With a Profiler, each stage of the conversion is recorded in it,
+    with each pass run separately (and "jobs" must be 1).
+
+    Files which are unchanged are left alone, and those written by the
+    previous conversion into output_dir that are no longer produced are
+    removed, apart from those named in "keep" (see FileOpener).
+
+    Return the numbers of files written, left unchanged and removed.
+    """
+    base, _ = os.path.splitext(os.path.basename(xml_file))
+    with open(xml_file) as f_in:
+        xml_src = f_in.read()
+    if profiler:
+        stage = profiler.start('from_xml_string')
+    if cache:
+        tree = from_xml_string_cached(xml_src, cache)
+    else:
+        tree = from_xml_string(xml_src)
+    if profiler:
+        profiler.finish(stage, tree)
+        tree = convert_to_rst(tree, GccContext(), fuse=False,
+                              profiler=profiler)
+    else:
+        tree = convert_to_rst(tree, GccContext())
+    opener = FileOpener(output_dir, keep)
+    f_out = opener.open(OutputFile(base))
+    if profiler:
+        assert jobs == 1
+        w = ProfilingRstWriter(f_out, opener, profiler, base)
+        w.visit(tree)
+        w.flush()
+        w.finish_profile()
+    elif jobs > 1:
+        write_rst_parallel(tree, f_out, opener, jobs)
+    else:
+        w = RstWriter(f_out, opener)
+        w.visit(tree)
+        w.flush()
+    opener.close(f_out)
+    return opener.finish()
+
+# The summary printed after converting into a directory, from the
+# directory and the counts returned by convert_file
+SUMMARY_FORMAT = '%s: %i written, %i unchanged, %i removed'
+
 parser = argparse.ArgumentParser(description='Convert TEXINFO xml file into RST files')
 parser.add_argument('xml_file', help='Input XML file')
 parser.add_argument('--default-language', default='c++', help='Default language for code blocks')
+parser.add_argument('--streaming', action='store_true',
+                    help='Convert one chapter at a time, to reduce memory usage')
+parser.add_argument('-j', '--jobs', type=int, default=1,
+                    help='Number of processes to render the output files with')
+parser.add_argument('--cache-dir', nargs='?',
+                    const=TreeCache.get_default_dir(),
+                    help='Cache parsed XML files in this directory (%s if '
+                    'none is given), to speed up converting the same XML '
+                    'again; off by default' % TreeCache.get_default_dir())
+parser.add_argument('--cache-size', type=int, default=1024,
+                    help='Maximum size of the --cache-dir cache, in megabytes')
+parser.add_argument('--verbose', action='store_true',
+                    help='Report entries discarded from the --cache-dir cache')
+parser.add_argument('--profile', action='store_true',
+                    help='Report the time and memory used by each stage')
+parser.add_argument('--profile-json', default='profile.json',
+                    help='File to write the --profile report to, as JSON')
 
 # Entrypoint
 
 if __name__ == '__main__':
     args = parser.parse_args()
+    if args.jobs > 1 and args.streaming:
+        parser.error('--jobs cannot be used with --streaming')
+    if args.profile and (args.jobs > 1 or args.streaming):
+        parser.error('--profile cannot be used with --jobs or --streaming')
     base, _ = os.path.splitext(os.path.basename(args.xml_file))
-    with open(args.xml_file) as f_in:
-        xml_src = f_in.read()
-        tree = from_xml_string(xml_src)
-    tree = convert_to_rst(tree, GccContext())
-    if 1:
-        if not os.path.exists('output'):
-            os.mkdir('output')
-        with open('output/' + base + '.rst', 'w') as f_out:
-            w = RstWriter(f_out, FileOpener('output'))
-            w.visit(tree)
-    else:
-        w = RstWriter(sys.stdout)
-        w.visit(tree)
+    if not os.path.exists('output'):
+        os.mkdir('output')
+    if args.streaming:
+        opener = FileOpener('output')
+        f_out = opener.open(OutputFile(base))
+        with open(args.xml_file) as f_in:
+            convert_to_rst_streaming(f_in, GccContext(), f_out, opener)
+        opener.close(f_out)
+        print(SUMMARY_FORMAT % (('output', ) + opener.finish()))
+        sys.exit(0)
+    cache = None
+    if args.cache_dir:
+        cache = TreeCache(args.cache_dir, args.cache_size * 1024 * 1024,
+                          args.verbose)
+    profiler = None
+    if args.profile:
+        profiler = Profiler()
+        tracemalloc.start()
+    counts = convert_file(args.xml_file, 'output', args.jobs, cache=cache,
+                          profiler=profiler)
+    print(SUMMARY_FORMAT % (('output', ) + counts))
+    if profiler:
+        tracemalloc.stop()
+        profiler.write_table(sys.stdout)
+        with open(args.profile_json, 'w') as f_out:
+            profiler.write_json(f_out)
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-from collections import deque, OrderedDict
+from collections import OrderedDict
 import os
 import re
 import sys
@@ -9,7 +9,7 @@ from node import Node, Element, Comment, Text, NoopVisitor
 
 DTD_LINE = '<!DOCTYPE texinfo PUBLIC "-//GNU//DTD TexinfoML V5.0//EN" "http://www.gnu.org/software/texinfo/dtd/5.0/texinfo.dtd">'
 
-FULL_LINE_COMMANDS = (
+FULL_LINE_COMMANDS = frozenset((
     'author',
     'c',
     'chapter',
@@ -45,7 +45,76 @@ FULL_LINE_COMMANDS = (
     'titlepage',
     'top',
     'vskip',
-)
+))
+
+# Environments, opened by @NAME and closed by @end NAME
+ENVIRONMENTS = frozenset((
+    'copying',
+    'display',
+    'enumerate',
+    'group',
+    'ifnottex',
+    'iftex',
+    'itemize',
+    'menu',
+    'smallexample',
+    'table',
+    'titlepage',
+))
+
+# '@' followed by one of these characters becomes an entity
+SYMBOL_ENTITIES = {'.': 'eosperiod',
+                   '{': 'lbrace',
+                   '*': 'linebreak',
+                   '}': 'rbrace',
+                   '/': 'slashbreak',
+                   ':': 'noeos'}
+
+# Accent commands, and the type of the <accent> each becomes
+ACCENTS = {"'": 'acute',
+           ',': 'cedil',
+           '~': 'tilde',
+           '"': 'uml'}
+
+# The possible name of a full-line command at the start of the token
+# after an '@', and the rest of that token
+FULL_LINE_COMMAND_PATTERN = re.compile(r'^([a-z]*)(\s*.*)$')
+
+# An inline command without braces, and the rest of its token
+INLINE_COMMAND_PATTERN = re.compile(r'(\S+)(.*)')
+
+MENU_ENTRY_PATTERN = re.compile(r'\* (.*)(::\s*)(.*)')
+
+# The name and formal argument of a macro, or just the name
+MACRO_WITH_ARG_PATTERN = re.compile(r'\s*(\S+)\{(.*)\}')
+MACRO_PATTERN = re.compile(r'\s*(\S+)\s*')
+
+BRACED_LINE_PATTERN = re.compile('^{(.*)}$')
+
+COMMAND_ARGS_PATTERN = re.compile(r'^\s*(\S+)\s+(.*)$')
+
+# Splitting texinfo source on this gives the special characters '@',
+# '{', '}' and newline, and the runs of everything else between them
+# (plus empty strings between adjacent special characters; see
+# Parser._tokenize)
+SPECIAL_CHAR_PATTERN = re.compile(r'([@{}\n])')
+
+# Character sequences within text that become entities
+TEXT_ENTITIES = {"@{": 'lbrace',
+                 "@}": 'rbrace',
+                 "@/": 'slashbreak',
+                 "@:": 'noeos',
+                 "---": 'textmdash',
+                 "``": 'textldquo',
+                 "''": 'textrdquo',
+                 "'":  'textrsquo',
+                 "@@": 'arobase'}
+
+# Matches any of TEXT_ENTITIES, trying the longest first (so that "''"
+# isn't taken as two "'")
+TEXT_ENTITY_PATTERN = re.compile(
+    '(%s)' % '|'.join(re.escape(seq)
+                      for seq in sorted(TEXT_ENTITIES, key=len, reverse=True)))
 
 def add_stripped_text(element, str_, attr_recipient=None):
     '''
@@ -64,7 +133,7 @@ def add_stripped_text(element, str_, attr_recipient=None):
     if attr_recipient is None:
         attr_recipient = element
     if spaces:
-        attr_recipient.attrs['spaces'] = spaces
+        attr_recipient.set_attr('spaces', spaces)
 
 def escape_text(text):
     text = text.replace(' ', '-')
@@ -76,6 +145,8 @@ class TexiNode(Element):
     """
     An @node within a .texi file.
     """
+    __slots__ = ('next', 'prev', 'up', 'name', 'args')
+
     def __init__(self):
         Element.__init__(self, 'node')
         # These attrs are all strings, for lookup within Parser.node_dict
@@ -90,11 +161,155 @@ class TexiNode(Element):
                 % (self.kind, self.attrs, self.rst_kind,
                    self.next, self.prev, self.up))
 
+class TokenStream:
+    """
+    The tokens still to be parsed, as a stack of sources: the content of
+    each file, macro expansion, or fragment pushed back by the parser,
+    each a list of tokens with a cursor into it.
+
+    Pushing a source in front of the others, and moving on from it once
+    it is used up, costs O(1), rather than copying its tokens (as
+    splicing them into a single deque would).
+    """
+    def __init__(self):
+        # The source currently being consumed, and the position within it
+        self.cur_tokens = []
+        self.pos = 0
+        self.on_end = None
+        # (tokens, pos, on_end) for each source below the current one
+        self.suspended = []
+
+    def push(self, tokens, on_end=None):
+        """
+        Put "tokens" (a list) in front of the remaining tokens.
+        "on_end" is called once they have all been consumed.
+        """
+        if self.pos < len(self.cur_tokens) or self.on_end:
+            self.suspended.append((self.cur_tokens, self.pos, self.on_end))
+        self.cur_tokens = tokens
+        self.pos = 0
+        self.on_end = on_end
+
+    def _next_source(self):
+        """
+        Move on from the current source (which has been used up) to the
+        next one with any tokens left; return False if there are none.
+        """
+        while self.pos >= len(self.cur_tokens):
+            if self.on_end:
+                on_end = self.on_end
+                self.on_end = None
+                on_end()
+            if not self.suspended:
+                return False
+            self.cur_tokens, self.pos, self.on_end = self.suspended.pop()
+        return True
+
+    def peek(self, n=0):
+        """
+        Get the nth token from the front, without consuming it, or None.
+        """
+        idx = self.pos + n
+        if idx < len(self.cur_tokens):
+            return self.cur_tokens[idx]
+        n = idx - len(self.cur_tokens)
+        for tokens, pos, _ in reversed(self.suspended):
+            idx = pos + n
+            if idx < len(tokens):
+                return tokens[idx]
+            n = idx - len(tokens)
+        return None
+
+    def lookahead(self):
+        """
+        Get the first three tokens, padded with None.
+        """
+        pos = self.pos
+        if pos + 3 <= len(self.cur_tokens):
+            return self.cur_tokens[pos:pos + 3]
+        return [self.peek(0), self.peek(1), self.peek(2)]
+
+    def consume(self):
+        """
+        Remove and return the first token, or return None.
+        """
+        if self.pos >= len(self.cur_tokens) and not self._next_source():
+            return None
+        token = self.cur_tokens[self.pos]
+        self.pos += 1
+        return token
+
+class IncludeCache:
+    """
+    Cache of where each @include was found, and of the tokens of each
+    included file, for sharing between Parsers (e.g. for the files
+    included by several of GCC's manuals, such as fdl.texi).
+
+    The tokens of a file are re-read if its mtime or size change.  A
+    file found via the include paths is assumed to stay the one found,
+    as long as it exists.
+    """
+    def __init__(self):
+        # (relpath, search dirs) -> path
+        self.paths = {}
+        # path -> (mtime, size, tokens)
+        self.files = {}
+
+    def get_tokens(self, relpath, dirnames, tokenize):
+        """
+        Find "relpath" in the first of "dirnames" that has it, returning
+        its path and its tokens (as given by "tokenize"), which must not
+        be modified, or (None, None) if it isn't found.
+        """
+        key = (relpath, tuple(dirnames))
+        path = self.paths.get(key)
+        if path is not None:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                del self.paths[key]
+                path = None
+        if path is None:
+            for dirname in dirnames:
+                candidate_path = os.path.join(dirname, relpath)
+                try:
+                    st = os.stat(candidate_path)
+                except FileNotFoundError:
+                    continue
+                path = candidate_path
+                self.paths[key] = path
+                break
+            else:
+                return None, None
+        cached = self.files.get(path)
+        if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+            return path, cached[2]
+        with open(path) as f:
+            content = f.read()
+        tokens = list(tokenize(content))
+        self.files[path] = (st.st_mtime_ns, st.st_size, tokens)
+        return path, tokens
+
+    def clear(self):
+        self.paths.clear()
+        self.files.clear()
+
+# The IncludeCache used by default, shared by all Parsers
+INCLUDE_CACHE = IncludeCache()
+
 class Parser:
-    def __init__(self, path, include_paths, debug=0, with_dtd=0, filename=None):
+    # The commands which take up the rest of their line (as opposed to
+    # inline commands); a subclass handling more of them can extend this
+    full_line_commands = FULL_LINE_COMMANDS
+
+    def __init__(self, path, include_paths, debug=0, with_dtd=0, filename=None,
+                 verbose=False, include_cache=INCLUDE_CACHE):
         self.path = path
         self.include_paths = include_paths
         self.debug = debug
+        # Whether to report the opening and closing of included files
+        self.verbose = verbose
+        self.include_cache = include_cache
         self.with_dtd = with_dtd
         self.filename = filename
         self._stack = []
@@ -102,7 +317,7 @@ class Parser:
         self.have_chapter = False
         self.have_section = False
         self.have_para = False
-        self.tokens = deque()
+        self.tokens = TokenStream()
         self.index_count = {}
         self.last_node = None
         self.top_node = None
@@ -110,6 +325,11 @@ class Parser:
         self.cur_macro_defn = None
         self.macros = OrderedDict()
         self.need_pre = False
+        # Command name -> handler (see _handle_command); these only
+        # hold the commands with methods of their own, so don't grow
+        # with the input
+        self._dispatch_commands = self._get_handlers('_command')
+        self._dispatch_inline = self._get_handlers('_inline')
 
     def parse_file(self, filename):
         with open(filename) as f:
@@ -122,12 +342,12 @@ class Parser:
         """
         self.texinfo = Element('texinfo')
         if self.with_dtd:
-            self.texinfo.attrs['xml:lang'] = "en"
+            self.texinfo.set_attr('xml:lang', "en")
         self.push(self.texinfo)
         if self.filename:
             self.stack_top.add_text('\n')
             filename = self.texinfo.add_element('filename')
-            filename.attrs['file'] = self.filename
+            filename.set_attr('file', self.filename)
             filename.add_text('')
             self.stack_top.add_text('\n')
         self._parse_content(content)
@@ -144,15 +364,10 @@ class Parser:
     def _parse_content(self, text):
         if self.debug:
             print(list(self._tokenize(text)))
-        # Add the tokens from "text" to the front of the deque
-        # (.extendleft reverses the order, so we need to pre-reverse them
-        # to get them in the correct order)
-        self.tokens.extendleft(list(self._tokenize(text))[::-1])
+        self.tokens.push(list(self._tokenize(text)))
         had_newline = 1
         while True:
-            tok0 = self.peek_token()
-            tok1 = self.peek_token(1)
-            tok2 = self.peek_token(2)
+            tok0, tok1, tok2 = self.tokens.lookahead()
             if self.debug:
                 print('tok0: %r' % tok0)
                 print('  tok1: %r' % tok1)
@@ -172,27 +387,21 @@ class Parser:
                 continue
             if tok0 == '@':
                 nextch = tok1[0]
-                if nextch in ('.', ':', '{', '}', '*', '/'):
-                    ENTITIES = {'.': 'eosperiod',
-                                '{': 'lbrace',
-                                '*': 'linebreak',
-                                '}': 'rbrace',
-                                '/': 'slashbreak',
-                                ':': 'noeos'}
-                    self.stack_top.add_entity(ENTITIES[nextch])
+                if nextch in SYMBOL_ENTITIES:
+                    self.stack_top.add_entity(SYMBOL_ENTITIES[nextch])
                     self.consume_n_tokens(2)
                     tok1 = tok1[1:]
                     if tok1:
-                        self.tokens.appendleft(tok1)
+                        self.tokens.push([tok1])
                     had_newline = 0
                     continue
                 if nextch == ' ':
                     spacecmd = self.stack_top.add_element('spacecmd')
-                    spacecmd.attrs['type'] = 'spc'
+                    spacecmd.set_attr('type', 'spc')
                     self.consume_n_tokens(2)
                     tok1 = tok1[1:]
                     if tok1:
-                        self.tokens.appendleft(tok1)
+                        self.tokens.push([tok1])
                     had_newline = 0
                     continue
                 if tok1 == '@':
@@ -204,16 +413,16 @@ class Parser:
                     # '@' on the end of a line: line continuation
                     # http://www.gnu.org/software/texinfo/manual/texinfo/html_node/Def-Cmd-Continuation-Lines.html
                     spacecmd = self.stack_top.add_element('spacecmd')
-                    spacecmd.attrs['type'] = 'nl'
+                    spacecmd.set_attr('type', 'nl')
                     self.consume_n_tokens(2)
                     had_newline = 0
                     continue
                 if tok1 and had_newline:
                     # Do we have a full-line command?
-                    m = re.match(r'^([a-z]*)(\s*.*)$', tok1)
+                    m = FULL_LINE_COMMAND_PATTERN.match(tok1)
                     if self.debug:
                         print(m.groups())
-                    if m and m.group(1) in FULL_LINE_COMMANDS:
+                    if m and m.group(1) in self.full_line_commands:
                         idx = 2
                         while 1:
                             tok = self.peek_token(idx)
@@ -262,20 +471,20 @@ class Parser:
                 self.consume_n_tokens(2)
                 if self.debug:
                     print('tok1: %r' % tok1)
-                m = re.match(r'(\S+)(.*)', tok1)
+                m = INLINE_COMMAND_PATTERN.match(tok1)
                 if not m:
                     raise ValueError('tok1: %r' % tok1)
                 command = m.group(1)
                 rest_of_tok1 = m.group(2)
                 if rest_of_tok1:
-                    self.tokens.appendleft(rest_of_tok1)
+                    self.tokens.push([rest_of_tok1])
                 self._handle_inline_markup(command, '')
                 had_newline = 0
                 continue
 
             if self.need_pre:
                 pre = self.stack_top.add_element('pre')
-                pre.attrs['xml:space'] = 'preserve'
+                pre.set_attr('xml:space', 'preserve')
                 self.push(pre)
                 self.need_pre = False
 
@@ -310,17 +519,17 @@ class Parser:
                     line += tok
                     tok = self.consume_token()
                 leadingtext = '* '
-                m = re.match(r'\* (.*)(::\s*)(.*)', line)
+                m = MENU_ENTRY_PATTERN.match(line)
                 if m:
                     title, separator, desc = m.groups()
                     menuentry = self.stack_top.add_element('menuentry')
-                    menuentry.attrs['leadingtext'] = leadingtext
+                    menuentry.set_attr('leadingtext', leadingtext)
                     menunode = menuentry.add_element('menunode')
                     menunode.add_text(title)
-                    menunode.attrs['separator'] = separator
+                    menunode.set_attr('separator', separator)
                     menudescription = menuentry.add_element('menudescription')
                     pre = menudescription.add_element('pre')
-                    pre.attrs['xml:space'] = 'preserve'
+                    pre.set_attr('xml:space', 'preserve')
                     pre.add_text(desc + '\n')
                     self._pre = pre
                 else:
@@ -333,17 +542,13 @@ class Parser:
             self.consume_token()
 
     def peek_token(self, n=0):
-        if len(self.tokens) >= n + 1:
-            return self.tokens[n]
-        else:
-            return None
+        return self.tokens.peek(n)
 
     def consume_token(self):
-        if self.tokens:
-            token = self.tokens.popleft()
-            if self.debug:
-                print('consuming: %r' % token)
-            return token
+        token = self.tokens.consume()
+        if self.debug and token is not None:
+            print('consuming: %r' % token)
+        return token
 
     def consume_n_tokens(self, n):
         for i in range(n):
@@ -354,18 +559,7 @@ class Parser:
         Split up text into '@', '{', '}', '\n', and runs of everything else,
         yielding the results.
         """
-        SPECIAL_CHARS = '@{}\n'
-        accum = ''
-        for ch in text:
-            if ch in SPECIAL_CHARS:
-                if accum:
-                    yield accum
-                accum = ''
-                yield ch
-            else:
-                accum += ch
-        if accum:
-            yield accum
+        return filter(None, SPECIAL_CHAR_PATTERN.split(text))
 
     def _insert_text_with_entities(self, element, text):
         """
@@ -374,44 +568,20 @@ class Parser:
         """
         if self.debug:
             print('_insert_text_with_entities: %r' % text)
-        # Entity replacement
-        ENTITIES = {"@{": 'lbrace',
-                    "@}": 'rbrace',
-                    "@/": 'slashbreak',
-                    "@:": 'noeos',
-                    "---": 'textmdash',
-                    "``": 'textldquo',
-                    "''": 'textrdquo',
-                    "'":  'textrsquo',
-                    "@@": 'arobase'}
-        # Split up "text" into fragments, either text,
-        # or things that must become entities
-        # Split it up one entity at a time.
-        split = [text]
-        for splitter in ENTITIES:
-            if self.debug:
-                print('splitter: %r' % splitter)
-                print('old split: %r' % split)
-            new_split = []
-            for s in split:
-                if s in ENTITIES:
-                    new_split.append(s)
-                    continue
-                for frag in s.split(splitter):
-                    new_split.append(frag)
-                    new_split.append(splitter)
-                # Remove stray final splitter:
-                new_split = new_split[:-1]
-            split = new_split
-            if self.debug:
-                print('new split: %r' % split)
+        # Most text has no entities at all
+        if ("'" not in text and '@' not in text and '`' not in text
+            and '---' not in text):
+            element.add_text(text)
+            return
+        # Split up "text" into fragments, alternately text and things
+        # that must become entities (the text may be empty)
+        split = TEXT_ENTITY_PATTERN.split(text)
         if self.debug:
             print(split)
-
-        for frag in split:
-            if frag in ENTITIES:
-                element.add_entity(ENTITIES[frag])
-            else:
+        for i, frag in enumerate(split):
+            if i % 2:
+                element.add_entity(TEXT_ENTITIES[frag])
+            elif frag:
                 element.add_text(frag)
 
     def _handle_text(self, text):
@@ -423,221 +593,276 @@ class Parser:
         self._insert_text_with_entities(self.stack_top, text)
 
     def _handle_command(self, name, line):
+        """
+        Handle the full-line command @NAME, with the rest of its line.
+
+        Each command is handled by a method _command_NAME(name, line),
+        or by _handle_other_command if there isn't one, so that support
+        for a new command can be added by defining its method (and
+        adding it to full_line_commands).  The methods are collected
+        into a dict when the Parser is created.
+        """
         if self.debug:
             print('_handle_command(%r, %r)' % (name, line))
-        if name in ('c', 'comment'):
-            line = line.replace('--', '-')
-            if '--' in line:
-                line = '-'
-            self.stack_top.add_comment(' ' + name + line + ' ')
-            self.stack_top.add_text('\n')
-        elif name in ('cindex', 'findex', 'opindex'):
-            kind = name
-            if name == 'opindex':
-                kind = 'indexcommand'
-            outer = self.stack_top.add_element(kind)
-            index = {'cindex': 'cp',
-                     'findex': 'fn',
-                     'opindex': 'op'}
-            if name == 'opindex':
-                outer.attrs['command'] = name
-            outer.attrs['index'] = index[name]
-            indexterm = outer.add_element('indexterm')
-            indexterm.attrs['index'] = index[name]
-            if name in self.index_count:
-                self.index_count[name] += 1
-            else:
-                self.index_count[name] = 1
-            indexterm.attrs['number'] = '%i' % self.index_count[name]
-            if name == 'findex':
-                indexterm.attrs['mergedindex'] = 'cp'
-            if name == 'opindex':
-                indexterm.attrs['incode'] = '1'
-            add_stripped_text(indexterm, line, outer)
-            self.stack_top.add_text('\n')
-        elif name == 'include':
-            self._handle_include(line)
-        elif name == 'chapter':
-            # Close any existing chapter:
-            while self.have_chapter:
-                self.pop(why='chapter')
-            chapter = self.stack_top.add_element('chapter')
-            self.push(chapter)
-            sectiontitle = chapter.add_element('sectiontitle')
-            add_stripped_text(sectiontitle, line, chapter)
-            self.stack_top.add_text('\n')
-        elif name == 'section':
-            # Close any existing section:
-            while self.have_section:
-                self.pop()
-            section = self.stack_top.add_element('section')
-            self.push(section)
-            sectiontitle = section.add_element('sectiontitle')
-            add_stripped_text(sectiontitle, line, section)
-            self.stack_top.add_text('\n')
-        elif name == 'macro':
-            m = re.match(r'\s*(\S+)\{(.*)\}', line)
-            if m:
-                macro_name, formalarg = m.groups()
-            else:
-                m = re.match(r'\s*(\S+)\s*', line)
-                macro_name = m.group(1)
-                formalarg = None
+        handler = self._dispatch_commands.get(name)
+        if handler is None:
+            handler = self._handle_other_command
+        handler(name, line)
+
+    def _get_handlers(self, prefix):
+        """
+        Get a dict from NAME to the method PREFIX_NAME, for each such
+        method.
+        """
+        start = prefix + '_'
+        return dict((attr[len(start):], getattr(self, attr))
+                    for attr in dir(self) if attr.startswith(start))
+
+    def _command_c(self, name, line):
+        line = line.replace('--', '-')
+        if '--' in line:
+            line = '-'
+        self.stack_top.add_comment(' ' + name + line + ' ')
+        self.stack_top.add_text('\n')
+
+    _command_comment = _command_c
 
-            # Capture tokens up to the next "@end macro"
-            tokens = []
+    def _command_cindex(self, name, line):
+        kind = name
+        if name == 'opindex':
+            kind = 'indexcommand'
+        outer = self.stack_top.add_element(kind)
+        index = {'cindex': 'cp',
+                 'findex': 'fn',
+                 'opindex': 'op'}
+        if name == 'opindex':
+            outer.set_attr('command', name)
+        outer.set_attr('index', index[name])
+        indexterm = outer.add_element('indexterm')
+        indexterm.set_attr('index', index[name])
+        if name in self.index_count:
+            self.index_count[name] += 1
+        else:
+            self.index_count[name] = 1
+        indexterm.set_attr('number', '%i' % self.index_count[name])
+        if name == 'findex':
+            indexterm.set_attr('mergedindex', 'cp')
+        if name == 'opindex':
+            indexterm.set_attr('incode', '1')
+        add_stripped_text(indexterm, line, outer)
+        self.stack_top.add_text('\n')
+
+    _command_findex = _command_cindex
+    _command_opindex = _command_cindex
+
+    def _command_include(self, name, line):
+        self._handle_include(line)
+
+    def _command_chapter(self, name, line):
+        # Close any existing chapter:
+        while self.have_chapter:
+            self.pop(why='chapter')
+        chapter = self.stack_top.add_element('chapter')
+        self.push(chapter)
+        sectiontitle = chapter.add_element('sectiontitle')
+        add_stripped_text(sectiontitle, line, chapter)
+        self.stack_top.add_text('\n')
+
+    def _command_section(self, name, line):
+        # Close any existing section:
+        while self.have_section:
+            self.pop()
+        section = self.stack_top.add_element('section')
+        self.push(section)
+        sectiontitle = section.add_element('sectiontitle')
+        add_stripped_text(sectiontitle, line, section)
+        self.stack_top.add_text('\n')
+
+    def _command_macro(self, name, line):
+        m = MACRO_WITH_ARG_PATTERN.match(line)
+        if m:
+            macro_name, formalarg = m.groups()
+        else:
+            m = MACRO_PATTERN.match(line)
+            macro_name = m.group(1)
+            formalarg = None
+
+        # Capture tokens up to the next "@end macro"
+        tokens = []
+        while 1:
+            tok0 = self.peek_token()
+            tok1 = self.peek_token(1)
+            tok2 = self.peek_token(2)
+            if tok0 == '@' and tok1 == 'end macro' and tok2 == '\n':
+                break
+            tokens.append(tok0)
+            self.consume_token()
+        macro_el = self.stack_top.add_element('macro')
+        macro_el.set_attr('name', macro_name)
+        macro_el.set_attr('line', line)
+        if formalarg:
+            formalarg_el = macro_el.add_element('formalarg')
+            formalarg_el.add_text(formalarg)
+        macro_el.add_text(''.join(tokens))
+        if self.debug:
+            print('defined macro %r as %r' % (macro_name, tokens))
+        self.macros[macro_name] = tokens
+
+    def _open_environment(self, name, line):
+        if self.debug:
+            print('name: %r' % name)
+        env = self.stack_top.add_element(name)
+        self.push(env)
+        if name in ('itemize', 'table', 'enumerate'):
+            line = line.strip()
+            if line.startswith('@'):
+                commandarg = line[1:]
+                env.set_attr('commandarg', commandarg)
+                env.set_attr('spaces', ' ')
+                if name == 'itemize':
+                    itemprepend = env.add_element('itemprepend')
+                    formattingcommand = \
+                                        itemprepend.add_element('formattingcommand')
+                    formattingcommand.set_attr('command', commandarg)
+            if name == 'enumerate':
+                env.set_attr('first', '1')
+        env.set_attr('endspaces', ' ')
+        self.stack_top.add_text('\n')
+        if name in ('smallexample', 'display'):
+            self.need_pre = True
+
+    _command_copying = _open_environment
+    _command_display = _open_environment
+    _command_enumerate = _open_environment
+    _command_group = _open_environment
+    _command_ifnottex = _open_environment
+    _command_iftex = _open_environment
+    _command_itemize = _open_environment
+    _command_menu = _open_environment
+    _command_smallexample = _open_environment
+    _command_table = _open_environment
+    _command_titlepage = _open_environment
+
+    def _command_end(self, name, line):
+        env = line.strip()
+        if self.debug:
+            print('@end of env: %r' % env)
+        if env in ENVIRONMENTS:
+            if self.debug:
+                print('stack: %r' % (self._stack, ))
             while 1:
-                tok0 = self.peek_token()
-                tok1 = self.peek_token(1)
-                tok2 = self.peek_token(2)
-                if tok0 == '@' and tok1 == 'end macro' and tok2 == '\n':
+                inject_newline = False
+                if env in ('itemize', 'enumerate', 'menu', 'smallexample'):
+                    inject_newline = True
+                old_top = self.pop(inject_newline, why=env)
+                if old_top.kind == env:
                     break
-                tokens.append(tok0)
-                self.consume_token()
-            macro_el = self.stack_top.add_element('macro')
-            macro_el.attrs['name'] = macro_name
-            macro_el.attrs['line'] = line
-            if formalarg:
-                formalarg_el = macro_el.add_element('formalarg')
-                formalarg_el.add_text(formalarg)
-            macro_el.add_text(''.join(tokens))
-            if self.debug:
-                print('defined macro %r as %r' % (macro_name, tokens))
-            self.macros[macro_name] = tokens
-            return
-        elif name in ('copying', 'titlepage', 'itemize', 'enumerate', 'menu',
-                      'smallexample', 'table', 'group', 'display',
-                      'iftex', 'ifnottex'):
-            if self.debug:
-                print('name: %r' % name)
-            env = self.stack_top.add_element(name)
-            self.push(env)
-            if name in ('itemize', 'table', 'enumerate'):
-                line = line.strip()
-                if line.startswith('@'):
-                    commandarg = line[1:]
-                    env.attrs['commandarg'] = commandarg
-                    env.attrs['spaces'] = ' '
-                    if name == 'itemize':
-                        itemprepend = env.add_element('itemprepend')
-                        formattingcommand = \
-                                            itemprepend.add_element('formattingcommand')
-                        formattingcommand.attrs['command'] = commandarg
-                if name == 'enumerate':
-                    env.attrs['first'] = '1'
-            env.attrs['endspaces'] =' '
-            self.stack_top.add_text('\n')
-            if name in ('smallexample', 'display'):
-                self.need_pre = True
-        elif name == 'end':
-            env = line.strip()
-            if self.debug:
-                print('@end of env: %r' % env)
-            if env in ('copying', 'titlepage', 'itemize', 'enumerate', 'menu',
-                       'smallexample', 'table', 'iftex', 'ifnottex',
-                       'group', 'display'):
-                if self.debug:
-                    print('stack: %r' % (self._stack, ))
-                while 1:
-                    inject_newline = False
-                    if env in ('itemize', 'enumerate', 'menu', 'smallexample'):
-                        inject_newline = True
-                    old_top = self.pop(inject_newline, why=env)
-                    if old_top.kind == env:
-                        break
-        elif name in ('set', 'clear'):
-            key, value = self._parse_command_args(line)
-            command = self.stack_top.add_element(name)
-            command.attrs['name'] = key
-            command.attrs['line'] = line
-            command.add_text(value)
-            self.stack_top.add_text('\n')
-        elif name in ('defcodeindex', 'paragraphindent'):
-            key, value = self._parse_command_args(line)
-            command = self.stack_top.add_element(name)
-            command.attrs['value'] = key
-            command.attrs['line'] = line
-            command.add_text(value)
-            self.stack_top.add_text('\n')
-        elif name == 'syncodeindex':
-            key, value = self._parse_command_args(line)
-            command = self.stack_top.add_element(name)
-            command.attrs['from'] = key
-            command.attrs['to'] = value
-            command.attrs['line'] = line
-            command.add_text('')
+
+    def _command_set(self, name, line):
+        key, value = self._parse_command_args(line)
+        command = self.stack_top.add_element(name)
+        command.set_attr('name', key)
+        command.set_attr('line', line)
+        command.add_text(value)
+        self.stack_top.add_text('\n')
+
+    _command_clear = _command_set
+
+    def _command_defcodeindex(self, name, line):
+        key, value = self._parse_command_args(line)
+        command = self.stack_top.add_element(name)
+        command.set_attr('value', key)
+        command.set_attr('line', line)
+        command.add_text(value)
+        self.stack_top.add_text('\n')
+
+    _command_paragraphindent = _command_defcodeindex
+
+    def _command_syncodeindex(self, name, line):
+        key, value = self._parse_command_args(line)
+        command = self.stack_top.add_element(name)
+        command.set_attr('from', key)
+        command.set_attr('to', value)
+        command.set_attr('line', line)
+        command.add_text('')
+        self.stack_top.add_text('\n')
+
+    def _command_item(self, name, line):
+        key, value = self._parse_command_args(line)
+        if self.stack_top.kind == 'listitem':
+            self.pop(inject_newline=False)
+        if self.stack_top.kind == 'tableitem':
+            self.pop(inject_newline=False)
+            self.pop(inject_newline=False)
+        if self.stack_top.kind == 'itemize':
+            listitem = self.stack_top.add_element('listitem')
+            self.push(listitem)
+            prepend = listitem.add_element('prepend')
+            prepend.add_entity('bullet') # FIXME
             self.stack_top.add_text('\n')
-        elif name == 'item':
-            key, value = self._parse_command_args(line)
-            if self.stack_top.kind == 'listitem':
-                self.pop(inject_newline=False)
-            if self.stack_top.kind == 'tableitem':
-                self.pop(inject_newline=False)
-                self.pop(inject_newline=False)
-            if self.stack_top.kind == 'itemize':
-                listitem = self.stack_top.add_element('listitem')
-                self.push(listitem)
-                prepend = listitem.add_element('prepend')
-                prepend.add_entity('bullet') # FIXME
-                self.stack_top.add_text('\n')
-            if self.stack_top.kind == 'enumerate':
-                listitem = self.stack_top.add_element('listitem')
-                self.push(listitem)
-                if self.debug:
-                    print('line: %r' % line)
-                    print(key, value)
-                if line.startswith(' '):
-                    listitem.attrs['spaces'] = ' '
-                    line = line[1:]
-                line += '\n'
-                self.tokens.extendleft(list(self._tokenize(line))[::-1])
-                return
-            elif self.stack_top.kind == 'table':
-                table = self.stack_top
-                tableentry = self.stack_top.add_element('tableentry')
-                self.push(tableentry)
-                tableterm = tableentry.add_element('tableterm')
-                item = tableterm.add_element('item')
-                itemformat = item.add_element('itemformat')
-                itemformat.attrs['command'] = table.attrs['commandarg']
-                add_stripped_text(itemformat, line, item)
-                tableterm.add_text('\n')
-                tableitem = self.stack_top.add_element('tableitem')
-                self.push(tableitem)
-                return
-        elif name == 'node':
-            args = line.split(',')
+        if self.stack_top.kind == 'enumerate':
+            listitem = self.stack_top.add_element('listitem')
+            self.push(listitem)
             if self.debug:
-                print('node args: %r' % args)
-            node = TexiNode()
-            self.stack_top.children.append(node)
-            node.attrs['name'] = escape_text(args[0].strip())
-            self.stack_top.add_text('\n')
-            self.last_node = node
-            nodename = node.add_element('nodename')
-            add_stripped_text(nodename, args[0], node)
-            self.node_dict[args[0].strip()] = node
-            node.name = args[0].strip()
-            node.args = args
-            # (we create the other child elements in _fixup_nodes)
-        elif name == 'top':
-            self.top_node = self.last_node
-        else:
-            m = re.match('^{(.*)}$', line)
-            if m:
-                line = m.group(1)
-            command = self.stack_top.add_element(name)
-            if name != 'vskip':
-                line = line.strip()
-            command.add_text(line)
-            if name in ('settitle', 'author'):
-                command.attrs['spaces'] = ' '
-            self.stack_top.add_text('\n')
+                print('line: %r' % line)
+                print(key, value)
+            if line.startswith(' '):
+                listitem.set_attr('spaces', ' ')
+                line = line[1:]
+            line += '\n'
+            self.tokens.push(list(self._tokenize(line)))
+        elif self.stack_top.kind == 'table':
+            table = self.stack_top
+            tableentry = self.stack_top.add_element('tableentry')
+            self.push(tableentry)
+            tableterm = tableentry.add_element('tableterm')
+            item = tableterm.add_element('item')
+            itemformat = item.add_element('itemformat')
+            itemformat.set_attr('command', table.attrs['commandarg'])
+            add_stripped_text(itemformat, line, item)
+            tableterm.add_text('\n')
+            tableitem = self.stack_top.add_element('tableitem')
+            self.push(tableitem)
+
+    def _command_node(self, name, line):
+        args = line.split(',')
+        if self.debug:
+            print('node args: %r' % args)
+        node = TexiNode()
+        self.stack_top.children.append(node)
+        node.set_attr('name', escape_text(args[0].strip()))
+        self.stack_top.add_text('\n')
+        self.last_node = node
+        nodename = node.add_element('nodename')
+        add_stripped_text(nodename, args[0], node)
+        self.node_dict[args[0].strip()] = node
+        node.name = args[0].strip()
+        node.args = args
+        # (we create the other child elements in _fixup_nodes)
+
+    def _command_top(self, name, line):
+        self.top_node = self.last_node
+
+    def _handle_other_command(self, name, line):
+        """
+        Handle a full-line command with no method of its own, as an
+        element containing the rest of the line.
+        """
+        m = BRACED_LINE_PATTERN.match(line)
+        if m:
+            line = m.group(1)
+        command = self.stack_top.add_element(name)
+        if name != 'vskip':
+            line = line.strip()
+        command.add_text(line)
+        if name in ('settitle', 'author'):
+            command.set_attr('spaces', ' ')
+        self.stack_top.add_text('\n')
 
     def _parse_command_args(self, line):
         if self.debug:
             print('line: %r' % line)
-        m = re.match(r'^\s*(\S+)\s+(.*)$', line)
+        m = COMMAND_ARGS_PATTERN.match(line)
         if m:
             key, value = m.groups()
             value = value.rstrip()
@@ -652,47 +877,107 @@ class Parser:
         inline.
         """
         relpath = line.strip()
-        for dirname in [self.path] + self.include_paths:
-            candidate_path = os.path.join(dirname, relpath)
-            if os.path.exists(candidate_path):
-                if 1:
-                    print('opening %r (for %r)' % (candidate_path, relpath))
-                with open(candidate_path) as f:
-                    content = f.read()
-                self._parse_content(content)
-                if 1:
-                    print('end of %r (for %r)' % (candidate_path, relpath))
-                return
-        if 0:
-            raise ValueError('file %r not found' % relpath)
-        else:
-            print('file %r not found' % relpath)
+        path, tokens = self.include_cache.get_tokens(
+            relpath, [self.path] + self.include_paths, self._tokenize)
+        if path is None:
+            if 0:
+                raise ValueError('file %r not found' % relpath)
+            else:
+                print('file %r not found' % relpath)
+            return
+        on_end = None
+        if self.verbose:
+            print('opening %r (for %r)' % (path, relpath))
+            def on_end():
+                print('end of %r (for %r)' % (path, relpath))
+        # The content is parsed by the loop in _parse_content that
+        # handled the @include
+        self.tokens.push(tokens, on_end)
 
     def _handle_inline_markup(self, command, inner):
+        """
+        Handle the inline command @COMMAND{INNER} (or @COMMAND, with an
+        empty "inner"), by expanding it if it's a macro, or else with a
+        method _inline_COMMAND(command, inner), or
+        _handle_other_inline_markup if there isn't one (dispatched as
+        for _handle_command).
+        """
         if self.debug:
             print('_handle_inline_markup: command: %r inner: %r'
                   % (command, inner))
         if command in self.macros:
-            if self.debug:
-                print('expanding macro: %r' % command)
-            macro_def = self.macros[command]
-            new_tokens = []
-            for token in macro_def:
-                if token == '\\body\\': # FIXME
-                    new_tokens += self._tokenize(inner)
-                else:
-                    new_tokens.append(token)
-            if self.debug:
-                print('adding tokens: %r' % new_tokens)
-            self.tokens.extendleft(new_tokens[::-1])
+            self._expand_macro(command, inner)
             return
-        if command in ('copyright', 'dots'):
-            self.stack_top.add_entity(command)
+        handler = self._dispatch_inline.get(command)
+        if handler is None:
+            handler = self._handle_other_inline_markup
+        handler(command, inner)
+
+    def _expand_macro(self, command, inner):
+        if self.debug:
+            print('expanding macro: %r' % command)
+        macro_def = self.macros[command]
+        new_tokens = []
+        for token in macro_def:
+            if token == '\\body\\': # FIXME
+                new_tokens += self._tokenize(inner)
+            else:
+                new_tokens.append(token)
+        if self.debug:
+            print('adding tokens: %r' % new_tokens)
+        self.tokens.push(new_tokens)
+
+    def _inline_copyright(self, command, inner):
+        self.stack_top.add_entity(command)
+
+    _inline_dots = _inline_copyright
+
+    def _inline_email(self, command, inner):
+        command_el = self.stack_top.add_element(command)
+        command_el = command_el.add_element('emailaddress')
+        self._insert_text_with_entities(command_el, inner)
+
+    def _inline_uref(self, command, inner):
+        command_el = self.stack_top.add_element(command)
+        command_el = command_el.add_element('urefurl')
+        self._insert_text_with_entities(command_el, inner)
+
+    def _inline_xref(self, command, inner):
+        command_el = self.stack_top.add_element(command)
+        args = inner.split(',')
+        if self.debug:
+            print('xref args: %r' % args)
+        label = escape_text(args[0])
+        command_el.set_attr('label', label)
+        if len(args) == 1:
+            command_el.add_element('xrefnodename').add_text(args[0])
+            return
+        if len(args) == 2:
+            command_el.add_element('xrefnodename').add_text(args[0])
+            command_el.add_element('xrefinfoname').add_text(args[1])
             return
-        ACCENTS = {"'": 'acute',
-                   ',': 'cedil',
-                   '~': 'tilde',
-                   '"': 'uml'}
+        if len(args) >= 3:
+            name = args[1]
+            desc = args[2]
+        if name == '' or name.isspace():
+            name = args[0]
+        command_el.add_element('xrefnodename').add_text(name)
+        xrefprinteddesc = command_el.add_element('xrefprinteddesc')
+        add_stripped_text(xrefprinteddesc, desc)
+        if len(args) == 5:
+            xrefinfofile = command_el.add_element('xrefinfofile')
+            add_stripped_text(xrefinfofile, args[3])
+            xrefprintedname = command_el.add_element('xrefprintedname')
+            add_stripped_text(xrefprintedname, args[4])
+            command_el.set_attr('manual', args[3].lstrip())
+
+    _inline_pxref = _inline_xref
+
+    def _handle_other_inline_markup(self, command, inner):
+        """
+        Handle an inline command with no method of its own: an accent
+        (with or without braces), or else an element containing "inner".
+        """
         if command in ACCENTS:
             accent = self.stack_top.add_element('accent', type=ACCENTS[command])
             accent.add_text(inner)
@@ -701,43 +986,11 @@ class Parser:
             ch = command[0]
             if ch in ACCENTS:
                 accent = self.stack_top.add_element('accent', type=ACCENTS[ch])
-                accent.attrs['bracketed'] = 'off'
+                accent.set_attr('bracketed', 'off')
                 accent.add_text(command[1])
-                self.tokens.appendleft(command[2:])
+                self.tokens.push([command[2:]])
                 return
         command_el = self.stack_top.add_element(command)
-        if command == 'email':
-            command_el = command_el.add_element('emailaddress')
-        if command == 'uref':
-            command_el = command_el.add_element('urefurl')
-        if command in ('xref', 'pxref'):
-            args = inner.split(',')
-            if self.debug:
-                print('xref args: %r' % args)
-            label = escape_text(args[0])
-            command_el.attrs['label'] = label
-            if len(args) == 1:
-                command_el.add_element('xrefnodename').add_text(args[0])
-                return
-            if len(args) == 2:
-                command_el.add_element('xrefnodename').add_text(args[0])
-                command_el.add_element('xrefinfoname').add_text(args[1])
-                return
-            if len(args) >= 3:
-                name = args[1]
-                desc = args[2]
-            if name == '' or name.isspace():
-                name = args[0]
-            command_el.add_element('xrefnodename').add_text(name)
-            xrefprinteddesc = command_el.add_element('xrefprinteddesc')
-            add_stripped_text(xrefprinteddesc, desc)
-            if len(args) == 5:
-                xrefinfofile = command_el.add_element('xrefinfofile')
-                add_stripped_text(xrefinfofile, args[3])
-                xrefprintedname = command_el.add_element('xrefprintedname')
-                add_stripped_text(xrefprintedname, args[4])
-                command_el.attrs['manual'] = args[3].lstrip()
-            return
         self._insert_text_with_entities(command_el, inner)
 
     def push(self, element):
@@ -800,7 +1053,7 @@ class Parser:
                 else:
                     if auto_name:
                         ptrnode = node.add_element(name)
-                        ptrnode.attrs['automatic'] = 'on'
+                        ptrnode.set_attr('automatic', 'on')
                         ptrnode.add_text(auto_name)
 
             # For now, put everything after top in one list below the